@@ -1,19 +1,37 @@
+import time
+_BOOT_T0 = time.perf_counter()
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, ReplyKeyboardRemove
 import re
 import random
 import os
+import sys
 import io
 import uuid
+import hashlib
+import hmac
 import json
-import time
 import threading
 import logging
+import atexit
+import queue
+import itertools
+import functools
+import heapq
+import sqlite3
+import signal
+import asyncio
+import tempfile
+import zipfile
+import multiprocessing
+import importlib
+import contextlib
 from datetime import datetime
-from fpdf import FPDF
-import PyPDF2
-from flask import Flask
-from deep_translator import GoogleTranslator
+from collections import OrderedDict, Counter, defaultdict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+import pdf_worker
 
 # ==============================
 # ⚙️ الإعدادات العامة
@@ -21,42 +39,1561 @@ from deep_translator import GoogleTranslator
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# عمليات PDF_WORKERS (forkserver/spawn) تستورد هذا الملف باسم __mp_main__ قبل تنفيذ مهامها من pdf_worker:
+# تأخذ التعريفات فقط، بلا تحميل المخازن أو الترحيل أو كتابة stats.json أو تشغيل الخيوط.
+# الشاردات تُستورد بنفس الاسم لكنها البوت نفسه (أسماء عملياتها shard-N)
+WORKER_PROCESS = __name__ == '__mp_main__' and not multiprocessing.current_process().name.startswith('shard-')
+
 TOKEN = os.getenv('BOT_TOKEN')
+# لتوجيه الطلبات لخادم Bot API محلي/وهمي (مثلاً tools/fake_bot_api.py): http://127.0.0.1:8081/bot{0}/{1}
+TG_API_URL = os.getenv('TG_API_URL')
+if TG_API_URL:
+    telebot.apihelper.API_URL = TG_API_URL
+    telebot.apihelper.FILE_URL = TG_API_URL.replace('/bot{0}/{1}', '/file/bot{0}/{1}')
 ADMIN_ID = 782049835
 REQUIRED_CHANNELS = ['@ahmedaqe', '@am2up']
 BOT_NAME = "Quizni | كويزني"
 
 bot = telebot.TeleBot(TOKEN)
-app = Flask('')
+api = bot  # للطلبات غير الإرسالية (get_chat_member, get_file...) — يُستبدل بجسر aiohttp في وضع asyncio
+
+# ==============================
+# 🚀 الإقلاع السريع (استيراد وتحميل عند الطلب)
+# ==============================
+# fpdf و PyPDF2 و flask و deep_translator تُستورد عند أول استخدام لميزتها، ومخازن الأرشيف/المشاركة/الجاهزة
+# تُحمّل عند أول وصول. LAZY_START=0 يعيد التحميل الكامل عند الإقلاع. زمن كل مكون يُسجل عند الجاهزية وفي /metrics
+LAZY_START = os.getenv('LAZY_START', '1') == '1'
+
+class StartupReport:
+    def __init__(self):
+        self.steps = []  # (المكون، ثوانٍ، بعد الإقلاع؟)
+        self.ready_at = None
+
+    @contextlib.contextmanager
+    def step(self, name):
+        t0 = time.perf_counter()
+        try: yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.steps.append((name, dt, self.ready_at is not None))
+            if self.ready_at is not None: logger.info(f"Lazy load: {name} {dt * 1000:.0f}ms")
+
+    def total_ms(self): return ((self.ready_at or time.perf_counter()) - _BOOT_T0) * 1000
+
+    def ready(self):
+        if self.ready_at is None: self.ready_at = time.perf_counter()
+        logger.info(self.report())
+
+    def report(self):
+        out = f"Startup {self.total_ms():.0f}ms: " + ", ".join(f"{n} {s * 1000:.0f}ms" for n, s, lazy in self.steps if not lazy)
+        later = [f"{n} {s * 1000:.0f}ms" for n, s, lazy in self.steps if lazy]
+        return out + (" | on demand: " + ", ".join(later) if later else "")
+
+startup = StartupReport()
+startup.steps.append(('import telebot+stdlib', time.perf_counter() - _BOOT_T0, False))
+
+_lazy_mods = {}
+_lazy_lock = threading.RLock()
+
+def lazy_import(name):
+    m = _lazy_mods.get(name)
+    if m is None:
+        with _lazy_lock:
+            m = _lazy_mods.get(name)
+            if m is None:
+                with startup.step(f"import {name}"): m = _lazy_mods[name] = importlib.import_module(name)
+    return m
+
+# مسارات Flask تُجمع هنا وتُضاف للتطبيق عند إنشائه في get_app()
+_routes = []
+app = request = None
+
+def route(rule, **kw):
+    def deco(fn):
+        _routes.append((rule, fn, kw))
+        return fn
+    return deco
+
+def get_app():
+    global app, request
+    with _lazy_lock:
+        if app is None:
+            flask = lazy_import('flask')
+            request = flask.request
+            app = flask.Flask('')
+            for rule, fn, kw in _routes: app.add_url_rule(rule, view_func=fn, **kw)
+    return app
+
+class LazyStore(MutableMapping):
+    # مجموعة JSON تُحمّل من ملفها عند أول وصول
+    def __init__(self, name):
+        self.name, self._d = name, None
+
+    @property
+    def data(self):
+        if self._d is None:
+            with _lazy_lock:
+                if self._d is None:
+                    with startup.step(f"load {self.name}"): self._d = load_collection(self.name)
+        return self._d
+
+    def __getitem__(self, k): return self.data[k]
+    def __setitem__(self, k, v): self.data[k] = v
+    def __delitem__(self, k): del self.data[k]
+    def __contains__(self, k): return k in self.data
+    def __iter__(self): return iter(self.data)
+    def __len__(self): return len(self.data)
+
+# ==============================
+# 📈 المقاييس (Prometheus على /metrics)
+# ==============================
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # /metrics?token=... و /profile?token=... (بدونه /profile مغلق)
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', '') == '1'  # فتح /metrics بلا token صراحة (شبكة داخلية مثلاً)
+SLOW_HANDLER_MS = float(os.getenv('SLOW_HANDLER_MS', '2000'))  # المعالج الأبطأ من هذا يُسجل في اللوج
+PROFILE = os.getenv('PROFILE', '') == '1'  # تشغيل المحلل بالعينات من البداية
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # ثوانٍ
+
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+
+def _label_str(names, values):
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+    parts = [f'{n}="{esc(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metric:
+    def __init__(self, name, doc, kind, labels=(), fn=None):
+        self.name, self.doc, self.kind, self.labels, self.fn = name, doc, kind, labels, fn
+        self.values = {}
+
+    def inc(self, *lv, by=1):
+        with _metrics_lock: self.values[lv] = self.values.get(lv, 0) + by
+
+    def observe(self, seconds, *lv):
+        with _metrics_lock:
+            h = self.values.get(lv)
+            if h is None: h = self.values[lv] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+            for i, b in enumerate(METRIC_BUCKETS):
+                if seconds <= b: h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        if self.fn:
+            v = self.fn()
+            for lv, x in (v if isinstance(v, list) else [((), v)]): out.append(f"{self.name}{_label_str(self.labels, lv)} {x}")
+            return out
+        with _metrics_lock: items = [(lv, list(v) if isinstance(v, list) else v) for lv, v in self.values.items()]
+        for lv, v in items:
+            if self.kind != 'histogram':
+                out.append(f"{self.name}{_label_str(self.labels, lv)} {v}")
+                continue
+            names = self.labels + ('le',)
+            for b, n in zip(METRIC_BUCKETS, v): out.append(f"{self.name}_bucket{_label_str(names, lv + (b,))} {n}")
+            out.append(f"{self.name}_bucket{_label_str(names, lv + ('+Inf',))} {v[-1]}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, lv)} {v[-2]:.6f}")
+            out.append(f"{self.name}_count{_label_str(self.labels, lv)} {v[-1]}")
+        return out
+
+def counter(name, doc, labels=()): return _metrics.setdefault(name, Metric(name, doc, 'counter', labels))
+def histogram(name, doc, labels=()): return _metrics.setdefault(name, Metric(name, doc, 'histogram', labels))
+def gauge(name, doc, fn, labels=()): _metrics[name] = Metric(name, doc, 'gauge', labels, fn)
+
+HANDLER_SECONDS = histogram('quiz_handler_seconds', "مدة المعالجات", ('handler', 'action'))
+HANDLER_ERRORS = counter('quiz_handler_errors_total', "استثناءات المعالجات", ('handler', 'action'))
+API_SECONDS = histogram('quiz_telegram_api_seconds', "زمن طلبات Bot API", ('method',))
+API_ERRORS = counter('quiz_telegram_api_errors_total', "أخطاء Bot API", ('method', 'code'))
+PARSE_SECONDS = histogram('quiz_parse_seconds', "زمن تحليل النص إلى أسئلة", ('engine',))
+PDF_SECONDS = histogram('quiz_pdf_seconds', "زمن استخراج/رسم PDF", ('stage',))
+SAVE_SECONDS = histogram('quiz_save_seconds', "زمن كتابة ملف بيانات", ('file',))
+SAVE_BYTES = counter('quiz_save_bytes_total', "البايتات المكتوبة", ('file',))
+SEARCH_SECONDS = histogram('quiz_search_seconds', "زمن البحث في الفهرس")
+TTFQ_SECONDS = histogram('quiz_time_to_first_question_seconds', "من استلام الملف حتى إرسال أول سؤال", ('path',))
+
+def instrumented(name, action=None):
+    # يلف المعالج: مدة + عدد الأخطاء (بدل ابتلاعها بصمت) + تسجيل المعالجات البطيئة
+    def deco(fn):
+        @functools.wraps(fn)
+        def run(*a, **k):
+            lv = (name, action(*a) if action else "")
+            t0 = time.perf_counter()
+            try: return fn(*a, **k)
+            except Exception:
+                HANDLER_ERRORS.inc(*lv)
+                raise
+            finally:
+                dt = time.perf_counter() - t0
+                HANDLER_SECONDS.observe(dt, *lv)
+                if dt * 1000 > SLOW_HANDLER_MS: logger.warning(f"Slow handler {lv[0]}/{lv[1]}: {dt * 1000:.0f}ms")
+        return run
+    return deco
+
+class Profiler:
+    # محلل بالعينات: يأخذ مكدس كل خيط كل PROFILE_INTERVAL ويعد المسارات (صيغة collapsed لـ flamegraph)
+    def __init__(self):
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.lock = threading.Lock()  # خيط العينات يعدل stacks بينما /profile يقرؤها
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+
+    def stop(self): self.running = False
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.running:
+            keys = []
+            for tid, frame in sys._current_frames().items():
+                if tid == me: continue
+                stack = []
+                while frame is not None and len(stack) < 60:
+                    stack.append(f"{frame.f_code.co_name}@{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}")
+                    frame = frame.f_back
+                keys.append(";".join(reversed(stack)))
+            with self.lock:
+                for key in keys: self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+                if len(self.stacks) > 20000: self.stacks = dict(sorted(self.stacks.items(), key=lambda x: -x[1])[:5000])
+            time.sleep(PROFILE_INTERVAL)
+
+    def reset(self):
+        with self.lock: self.stacks, self.samples = {}, 0
+
+    def report(self, top=200):
+        with self.lock: items = list(self.stacks.items())
+        return "\n".join(f"{k} {v}" for k, v in sorted(items, key=lambda x: -x[1])[:top])
+
+profiler = Profiler()
+if PROFILE and not WORKER_PROCESS: profiler.start()
+
+def _token_ok():
+    return bool(METRICS_TOKEN) and hmac.compare_digest(request.args.get('token', ''), METRICS_TOKEN)
+
+@route('/metrics')
+def metrics():
+    if not (METRICS_PUBLIC or _token_ok()): return "forbidden", 403
+    lines = []
+    for m in list(_metrics.values()):
+        try: lines += m.render()
+        except Exception as e: logger.error(f"Metric {m.name}: {e}")
+    return "\n".join(lines) + "\n", 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@route('/profile')
+def profile():
+    # /profile?on=1 تشغيل، ?on=0 إيقاف، وبدونها تقرير المسارات الأكثر تكراراً. يكشف الكود ويغير الحالة فلا يُفتح بلا token
+    if not _token_ok(): return "forbidden", 403
+    on = request.args.get('on')
+    if on == '1': profiler.start()
+    elif on == '0': profiler.stop()
+    if request.args.get('reset'): profiler.reset()
+    head = f"# running={profiler.running} samples={profiler.samples}\n"
+    return head + profiler.report(int(request.args.get('top', 200))), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+# ==============================
+# 📮 جدولة الإرسال (حدود Telegram)
+# ==============================
+# كل الإرسال يمر عبر tg بدل bot مباشرة: حد عام + حد لكل محادثة، احترام retry_after عند 429،
+# وأولوية لرسائل الاختبار التفاعلية على الإرسال الكبير (PDF، روابط المشاركة)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))  # رسالة/ثانية لكل البوت
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))  # رسالة/ثانية للمحادثة الخاصة
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', str(20 / 60)))  # المجموعات: 20 بالدقيقة
+SEND_BURST = float(os.getenv('SEND_BURST', '3'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+SEND_MAX_RETRIES = 3
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '5'))  # عند الإيقاف: مهلة إرسال ما بقي في الطوابير
+PRIO_INTERACTIVE, PRIO_BULK = 0, 1
+
+# طرق لا ترسل رسالة للمحادثة: لا تخضع لحد المحادثة
+_NO_CHAT_LIMIT = {'answer_callback_query', 'get_me', 'set_my_commands', 'delete_message'}
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def wait_time(self, now):
+        # كم ثانية حتى يتوفر توكن (بدون حجز)
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class Outbound:
+    # لكل محادثة طابورها (بالأولوية ثم الترتيب). المحادثة الجاهزة تدخل ready، وغير الجاهزة (حد/429) تنتظر
+    # في delayed حسب وقت جاهزيتها. العامل لا ينام وهو يحمل مهمة: يأخذ أول مهمة جاهزة من أي محادثة،
+    # فمحادثة محظورة بـ retry_after لا تؤخر غيرها. مهمة واحدة قيد التنفيذ لكل محادثة للحفاظ على الترتيب
+    def __init__(self, bot, workers=SEND_WORKERS):
+        self.bot = bot
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.chats = {}  # مفتاح المحادثة -> heap من (أولوية، تسلسل، مهمة)
+        self.ready = []  # heap: (أولوية أول مهمة، تسلسلها، المفتاح)
+        self.delayed = []  # heap: (وقت الجاهزية، تسلسل، المفتاح)
+        self.n_pending = 0
+        self.inflight = 0  # مهام أُخذت من الطوابير ولم يرجع ردها (مع AsyncBridge تنتظر على الحلقة لا على عامل)
+        self.stopping = False
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chat_buckets = OrderedDict()
+        self.workers, self.n_workers = [], workers
+        self.stats = {'sent': 0, 'retries': 0, 'rate_limited': 0, 'errors': 0, 'wait_ms': 0.0, 'max_wait_ms': 0.0}
+        self.latency = {}  # method -> [عدد، مجموع ms، أقصى ms]
+        self.bulk = _Proxy(self, PRIO_BULK)
+        self.nowait = _Proxy(self, PRIO_INTERACTIVE, wait=False)
+
+    def _bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            rate = SEND_CHAT_RATE if isinstance(chat_id, int) and chat_id > 0 else SEND_GROUP_RATE
+            b = self.chat_buckets[chat_id] = TokenBucket(rate, SEND_BURST)
+            if len(self.chat_buckets) > 50000: self.chat_buckets.popitem(last=False)
+        self.chat_buckets.move_to_end(chat_id)
+        return b
+
+    @staticmethod
+    def _chat_of(method, args, kw):
+        if 'chat_id' in kw: return kw['chat_id']
+        if method in _NO_CHAT_LIMIT or not args: return None
+        if method == 'reply_to': return args[0].chat.id
+        if method in ('edit_message_text', 'edit_message_caption'): return args[1] if len(args) > 1 else None
+        return args[0]
+
+    def call(self, method, *args, _prio=PRIO_INTERACTIVE, _wait=True, **kw):
+        # _wait=False (tg.nowait): يرجع Future فوراً، فانتظار حد المحادثة يقع على خيط الإرسال لا على المعالج
+        fut = Future()
+        if self.stopping:
+            if _wait: raise RuntimeError("send queue stopped")
+            fut.set_exception(RuntimeError("send queue stopped"))
+            return fut
+        if not self.workers: self._start()
+        seq = next(self.seq)
+        chat = self._chat_of(method, args, kw)
+        # الطلبات بلا محادثة لا تُسلسل مع غيرها
+        key = chat if chat is not None else ('job', seq)
+        with self.cond:
+            jobs = self.chats.get(key)
+            idle = jobs is None
+            if idle: jobs = self.chats[key] = []
+            heapq.heappush(jobs, (_prio, seq, [chat, time.monotonic(), method, args, kw, 0, fut]))
+            self.n_pending += 1
+            if idle: self._schedule(key, 0)
+        if _wait: return fut.result()
+        fut.add_done_callback(lambda f: f.exception() and logger.debug(f"Send {method} failed: {f.exception()}"))
+        return fut
+
+    def __getattr__(self, method):
+        return lambda *a, **k: self.call(method, *a, **k)
+
+    def _start(self):
+        with self.lock:
+            if self.workers: return
+            for i in range(self.n_workers):
+                t = threading.Thread(target=self._worker, name=f"tg-send-{i}", daemon=True)
+                t.start()
+                self.workers.append(t)
+
+    def depth(self): return self.n_pending
+
+    def drain(self, timeout):
+        # ينتظر حتى تفرغ الطوابير ويرجع رد كل طلب جارٍ. True = فرغت خلال المهلة
+        with self.cond: return self.cond.wait_for(lambda: not self.n_pending and not self.inflight, timeout)
+
+    def stop(self, timeout=5):
+        # ما في الطوابير يُرسل أولاً (حتى timeout)، ثم يخرج العمال بعد إنهاء ما بيدهم، وما بقي يفشل بدل أن
+        # يعلق مستدعوه. يرجع عدد الطلبات التي لم تُرسل
+        self.drain(timeout)
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for t in self.workers: t.join(timeout)
+        dropped = 0
+        with self.cond:
+            self.cond.wait_for(lambda: not self.inflight, timeout)
+            for jobs in self.chats.values():
+                for _, _, job in jobs:
+                    if not job[6].done():
+                        job[6].set_exception(RuntimeError("send queue stopped"))
+                        dropped += 1
+            return dropped + self.inflight
+
+    def _schedule(self, key, at):
+        # تحت self.cond: المحادثة تدخل ready أو delayed حسب وقت جاهزيتها
+        if at <= time.monotonic():
+            prio, seq, _ = self.chats[key][0]
+            heapq.heappush(self.ready, (prio, seq, key))
+        else: heapq.heappush(self.delayed, (at, next(self.seq), key))
+        self.cond.notify()
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                if self.stopping: return None
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    key = heapq.heappop(self.delayed)[2]
+                    prio, seq, _ = self.chats[key][0]
+                    heapq.heappush(self.ready, (prio, seq, key))
+                if self.ready:
+                    key = heapq.heappop(self.ready)[2]
+                    chat, method = self.chats[key][0][2][0], self.chats[key][0][2][2]
+                    limited = chat is not None and method not in _NO_CHAT_LIMIT
+                    wait = self._bucket(chat).wait_time(now) if chat is not None else 0.0
+                    if limited: wait = max(wait, self.global_bucket.wait_time(now))
+                    if wait > 0:
+                        heapq.heappush(self.delayed, (now + wait, next(self.seq), key))
+                        continue
+                    if chat is not None: self._bucket(chat).take(now)
+                    if limited: self.global_bucket.take(now)
+                    prio, seq, job = heapq.heappop(self.chats[key])
+                    self.n_pending -= 1
+                    self.inflight += 1
+                    return key, prio, seq, job
+                self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _done(self, key, requeue=None, at=0):
+        # انتهت مهمة المحادثة: نعيدها (429) أو نجدول التالية أو نحذف الطابور الفارغ
+        with self.cond:
+            self.inflight -= 1
+            if requeue:
+                heapq.heappush(self.chats[key], requeue)
+                self.n_pending += 1
+            if self.chats[key]: self._schedule(key, at)
+            else: del self.chats[key]
+            if not self.inflight: self.cond.notify_all()
+
+    def _worker(self):
+        # AsyncBridge.submit: الطلب يُرسل على حلقة asyncio والرد يُعالج في callback، فالعامل لا ينتظره
+        submit = self.bot.submit if isinstance(self.bot, AsyncBridge) else None
+        while True:
+            nxt = self._next_job()
+            if nxt is None: return
+            method, args, kw = nxt[3][2:5]
+            t0 = time.monotonic()
+            if submit is not None:
+                try: submit(method, *args, **kw).add_done_callback(lambda f, nxt=nxt, t0=t0: self._settled(nxt, t0, f))
+                except Exception as e: self._finish(nxt, t0, None, e)
+                continue
+            try: res = getattr(self.bot, method)(*args, **kw)
+            except Exception as e:
+                self._finish(nxt, t0, None, e)
+                continue
+            self._finish(nxt, t0, lambda: res, None)
+
+    def _settled(self, nxt, t0, f):
+        # على خيط الحلقة: الحلقة أُغلقت قبل الرد = فشل الطلب، حتى لا يبقى inflight معلقاً
+        e = RuntimeError("event loop stopped") if f.cancelled() else f.exception()
+        self._finish(nxt, t0, f.result, e)
+
+    def _finish(self, nxt, t0, result, e):
+        key, prio, seq, job = nxt
+        chat, t_in, method, args, kw, tries, fut = job
+        if e is not None:
+            # نفس المعالجة لاستثناء apihelper واستثناء asyncio_helper (صنفان مختلفان)
+            code = getattr(e, 'error_code', None)
+            API_ERRORS.inc(method, str(code or type(e).__name__))
+            if code == 429 and tries < SEND_MAX_RETRIES:
+                retry = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                self.stats['rate_limited'] += 1
+                self.stats['retries'] += 1
+                until = time.monotonic() + retry
+                with self.lock:
+                    b = self._bucket(chat) if chat is not None else self.global_bucket
+                    b.blocked_until = until
+                job[5] = tries + 1
+                self._done(key, (prio, seq, job), until)
+                return
+            self.stats['errors'] += 1
+            self._done(key)
+            fut.set_exception(e)
+            return
+        self._done(key)
+        self._record(method, (time.monotonic() - t0) * 1000, (t0 - t_in) * 1000)
+        fut.set_result(result())
+
+    def _record(self, method, api_ms, wait_ms):
+        API_SECONDS.observe(api_ms / 1000, method)
+        self.stats['sent'] += 1
+        self.stats['wait_ms'] += wait_ms
+        self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], round(wait_ms, 1))
+        l = self.latency.setdefault(method, [0, 0.0, 0.0])
+        l[0] += 1
+        l[1] += api_ms
+        l[2] = max(l[2], api_ms)
+
+class _Proxy:
+    # tg.bulk (أولوية منخفضة)، tg.nowait (بلا انتظار)، tg.bulk.nowait
+    def __init__(self, out, prio, wait=True): self.out, self.prio, self.wait = out, prio, wait
+    @property
+    def nowait(self): return _Proxy(self.out, self.prio, wait=False)
+    def __getattr__(self, method): return lambda *a, **k: self.out.call(method, *a, _prio=self.prio, _wait=self.wait, **k)
+
+def edit_or_send(cid, msg_id, text, **kw):
+    # تعديل الرسالة وإن فشل (رسالة قديمة أو ليست من البوت) رسالة جديدة، بدون انتظار أي منهما
+    def fallback(f):
+        if f.exception() is not None: tg.nowait.send_message(cid, text, **kw)
+    tg.nowait.edit_message_text(text, cid, msg_id, **kw).add_done_callback(fallback)
+
+def edit_sent(cid, sent, text, **kw):
+    # تعديل رسالة أُرسلت عبر tg.nowait حين يصل ردها (sent: Future)
+    def edit(f):
+        if f.exception() is None: tg.nowait.edit_message_text(text, cid, f.result().message_id, **kw)
+    sent.add_done_callback(edit)
+
+tg = Outbound(bot)
+
+_bot_username = None
+def bot_username():
+    global _bot_username
+    if _bot_username is None: _bot_username = tg.get_me().username
+    return _bot_username
 
 # ==============================
 # 💾 إدارة البيانات
 # ==============================
 FILES = {
     'users': 'users.json', 
+    'questions': 'questions.json',
     'saved': 'saved.json', 
     'history': 'history.json',
     'shared': 'shared.json', 
     'fixed': 'fixed_quizzes.json'
 }
 
+# الكتابة المؤجلة: save_data تسجل الملف كـ "متسخ" فقط، وخيط الحفظ يكتبه مرة واحدة كل فترة
+SAVE_INTERVAL = float(os.getenv('SAVE_INTERVAL', '2'))  # 0 = كتابة فورية (السلوك القديم)
+SAVE_MAX_PENDING = int(os.getenv('SAVE_MAX_PENDING', '500'))  # عدد الطلبات قبل فرض الكتابة
+
+_pending = {}
+_pending_count = 0
+_pending_lock = threading.Lock()
+_flush_lock = threading.RLock()  # RLock: معالج SIGTERM قد يقاطع flush_data في نفس الخيط
+_flush_wakeup = threading.Event()
+_flusher = None
+_umask = os.umask(0)
+os.umask(_umask)  # يُقرأ مرة عند الإقلاع: os.umask يغيّر القيمة للعملية كلها
+persist_stats = {'requests': 0, 'coalesced': 0, 'flushes': 0, 'writes': 0, 'bytes': 0, 'errors': 0, 'last_ms': 0.0, 'max_ms': 0.0}
+
 def load_data(f, d):
+    with _pending_lock: pending = _pending.pop(f, None)
+    if pending is not None: _write_file(f, pending)
     if os.path.exists(f):
         try: return json.load(open(f, 'r', encoding='utf-8'))
         except: pass
     return d
 
+def _write_file(f, d):
+    # المخازن المدعومة بقاعدة بيانات تكتب السجلات المتغيرة فقط
+    if hasattr(d, 'flush'): return d.flush()
+    # مخزن يبني نصه بنفسه (الجلسات: يعيد ترميز المتغير منها فقط)
+    if hasattr(d, 'dump'): raw = d.dump()
+    else:
+        # القاموس قد يتغير من خيط آخر أثناء التحويل، نعيد المحاولة
+        for _ in range(3):
+            try:
+                raw = json.dumps(pack_collection(f, d), ensure_ascii=False, indent=2)
+                break
+            except RuntimeError: time.sleep(0.01)
+        else: return 0
+    # ملف مؤقت باسم فريد لكل كاتب (الحفظ الفوري والترحيل قد يكتبان نفس الملف مع خيط الحفظ)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(f) + '.', suffix='.tmp', dir=os.path.dirname(f) or '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            fh.write(raw)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # mkstemp ينشئ الملف بصلاحية 0600: نعيد صلاحية الملف القديم (أو الافتراضية حسب umask) قبل الاستبدال
+        try: mode = os.stat(f).st_mode & 0o7777
+        except FileNotFoundError: mode = 0o666 & ~_umask
+        os.chmod(tmp, mode)
+        # الاستبدال ذري: الانهيار أثناء الكتابة لا يقطع الملف الأصلي
+        os.replace(tmp, f)
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+    return len(raw)
+
 def save_data(f, d):
-    try: json.dump(d, open(f, 'w', encoding='utf-8'), ensure_ascii=False, indent=2)
-    except: pass
+    global _pending_count, _flusher
+    if SAVE_INTERVAL <= 0:
+        try: _write_file(f, d)
+        except: persist_stats['errors'] += 1
+        return
+    with _pending_lock:
+        persist_stats['requests'] += 1
+        if f in _pending: persist_stats['coalesced'] += 1
+        _pending[f] = d
+        _pending_count += 1
+        if _pending_count >= SAVE_MAX_PENDING: _flush_wakeup.set()
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="save-flusher", daemon=True)
+            _flusher.start()
+
+def flush_data():
+    global _pending_count
+    with _flush_lock:
+        with _pending_lock:
+            # مخزن الأسئلة أولاً حتى لا تشير المجموعات إلى أسئلة غير مكتوبة بعد
+            batch = dict(sorted(_pending.items(), key=lambda x: x[0] != FILES['questions']))
+            _pending.clear()
+            _pending_count = 0
+        if not batch: return
+        t0 = time.perf_counter()
+        for f, d in batch.items():
+            try:
+                tf = time.perf_counter()
+                n = _write_file(f, d) or 0
+                SAVE_SECONDS.observe(time.perf_counter() - tf, os.path.basename(f))
+                SAVE_BYTES.inc(os.path.basename(f), by=n)
+                persist_stats['bytes'] += n
+                persist_stats['writes'] += 1
+            except Exception as e:
+                persist_stats['errors'] += 1
+                logger.error(f"Save {f}: {e}")
+                with _pending_lock: _pending.setdefault(f, d)
+        ms = (time.perf_counter() - t0) * 1000
+        persist_stats['flushes'] += 1
+        persist_stats['last_ms'] = round(ms, 2)
+        persist_stats['max_ms'] = round(max(persist_stats['max_ms'], ms), 2)
+        logger.debug(f"Flush: {len(batch)} files in {ms:.1f}ms (coalesced {persist_stats['coalesced']})")
+
+def _flush_loop():
+    while True:
+        _flush_wakeup.wait(SAVE_INTERVAL)
+        _flush_wakeup.clear()
+        flush_data()
+
+# تفريغ ما تبقى عند إغلاق البوت. atexit لا يعمل مع SIGTERM (طريقة الإيقاف في الاستضافات)
+# لذلك نعالج الإشارات أيضاً: حفظ ثم خروج فوري (خيط keep_alive غير daemon ويمنع الخروج العادي)
+atexit.register(flush_data)
+
+_child_procs = []  # وضع التقسيم: العمليات الفرعية تُبلغ بالإيقاف لتحفظ بياناتها قبل خروج الموجه
+_shard_queues = []  # طوابير الشاردات: None فيها = أنهِ ما وصلك ثم اخرج
+
+_stopping = threading.Event()  # الموجه لا يعيد تشغيل شارد أُنهي عمداً
+
+def stop_workers(timeout=SEND_DRAIN_TIMEOUT):
+    # قبل os._exit: العمليات الفرعية (الشاردات، pool الـ PDF) لا تنتهي بموت الأب فتبقى يتيمة.
+    # الشارد ينهي ما في طابوره ويفرغ إرساله ثم يخرج، وهنا تُنهى التحديثات المستلمة ثم الإرسال قبل إيقاف
+    # العمال. يرجع عدد المشاكل: رسائل لم تُرسل، تحديثات لم تُعالج، شارد خرج بخطأ أو أُنهي بالقوة
+    _stopping.set()
+    bad = 0
+    for q in _shard_queues:
+        try: q.put(None, timeout=timeout)
+        except queue.Full: pass
+    for p in _child_procs:
+        if p: p.join(timeout * 2)
+    for p in _child_procs:
+        if p and p.is_alive():
+            p.terminate()
+            p.join(timeout)
+            bad += 1
+        elif p and p.exitcode: bad += 1
+    if not drain_updates(timeout): bad += 1
+    _reset_pdf_pool(kill=True)
+    return bad + tg.stop(timeout)
+
+def _exit_on_signal(signum, frame):
+    logger.info(f"Signal {signum}: flushing data before exit")
+    bad = 0
+    try:
+        bad = stop_workers()
+        flush_data()
+    finally: os._exit(1 if bad else 0)
+
+def install_exit_handlers():
+    for sig in (signal.SIGTERM, signal.SIGINT): signal.signal(sig, _exit_on_signal)
+
+# ==============================
+# 🗄 محرك SQLite (اختياري)
+# ==============================
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')  # json | sqlite
+# يُضبط فقط داخل عمليات وضع التقسيم (RUN_MODE=sharded): عدة عمليات تكتب نفس قاعدة البيانات
+SHARD_ID = os.getenv('SHARD_ID')
+SHARED_DB = SHARD_ID is not None
+DB_FILE = os.getenv('DB_FILE', 'quizni.db')
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+DB_CACHE_MAX = int(os.getenv('DB_CACHE_MAX', '5000'))  # أقصى عدد سجلات محملة في الذاكرة لكل جدول
+
+# اسم الجدول -> (مفتاح، أعمدة إضافية تُستخرج من السجل لأجل الفهارس)
+DB_TABLES = {
+    'users': ('uid', {'xp': lambda v: v.get('xp', 0), 'ts': lambda v: time.time()}),  # ts: وقت آخر كتابة
+    'questions': ('h', {'refs': lambda v: v[1]}),
+    'saved': ('uid', {}),
+    'history': ('uid', {}),
+    'shared': ('qid', {}),
+    'fixed': ('qid', {'name': lambda v: v.get('name', ''), 'date': lambda v: v.get('date', '')}),
+}
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, xp INTEGER NOT NULL DEFAULT 0, ts REAL NOT NULL DEFAULT 0, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS users_xp ON users (xp DESC);
+CREATE TABLE IF NOT EXISTS questions (h TEXT PRIMARY KEY, refs INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS saved (uid TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS history (uid TEXT NOT NULL, pos INTEGER NOT NULL, fid TEXT, date TEXT, data TEXT NOT NULL, PRIMARY KEY (uid, pos));
+CREATE INDEX IF NOT EXISTS history_uid_date ON history (uid, date DESC, pos);
+CREATE TABLE IF NOT EXISTS shared (qid TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS fixed (qid TEXT PRIMARY KEY, name TEXT, date TEXT, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (k TEXT PRIMARY KEY, v INTEGER NOT NULL DEFAULT 0);
+"""
+
+class SqliteBackend:
+    # اتصال كتابة واحد + مجموعة اتصالات قراءة (WAL يسمح بالقراءة أثناء الكتابة)
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.wlock = threading.Lock()
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.executescript(DB_SCHEMA)
+        # قواعد أقدم: users بلا ts (وبعضها حُذف منه users_xp، فيعيده DB_SCHEMA)
+        try: self.writer.execute("ALTER TABLE users ADD COLUMN ts REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError: pass
+        self.writer.execute("CREATE INDEX IF NOT EXISTS users_ts ON users (ts)")
+        self.writer.commit()
+        self.readers = queue.Queue()
+        self.max_readers = readers
+        self.opened = 0
+
+    def _reader(self):
+        try: return self.readers.get_nowait()
+        except queue.Empty: pass
+        with self.wlock:
+            if self.opened < self.max_readers:
+                self.opened += 1
+                return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return self.readers.get()
+
+    def read(self, sql, args=()):
+        conn = self._reader()
+        try: return conn.execute(sql, args).fetchall()
+        finally: self.readers.put(conn)
+
+    def write(self, ops):
+        with self.wlock:
+            try:
+                for sql, args in ops:
+                    if args and isinstance(args[0], (list, tuple)): self.writer.executemany(sql, args)
+                    else: self.writer.execute(sql, args)
+                self.writer.commit()
+            except:
+                self.writer.rollback()
+                raise
+
+    def get_meta(self, k):
+        r = self.read("SELECT v FROM meta WHERE k=?", (k,))
+        return r[0][0] if r else None
+
+class SqlStore(MutableMapping):
+    # قاموس مدعوم بـ SQLite: يحمل السجلات عند الطلب فقط ويكتب السجلات المتغيرة فقط عند save_data
+    def __init__(self, db, table, cache_max=DB_CACHE_MAX):
+        self.db, self.table = db, table
+        self.key, self.extra = DB_TABLES[table]
+        self.multi = table == 'history'  # كل ملف في الأرشيف صف مستقل
+        self.cache = OrderedDict()
+        self.cache_max = cache_max
+        self.touched, self.prev_touched, self.deleted = set(), set(), set()
+        self.seen, self.prev_seen = set(), set()  # قُرئت مؤخراً: لا تُكتب لكنها لا تُطرد (قد يعيد المستدعي كتابتها)
+        self.lock = threading.RLock()
+
+    def _decode(self, raw):
+        return unpack_record(self.table, json.loads(raw))
+
+    def _decode_rows(self, rows):
+        if self.multi: return unpack_record('history', [json.loads(r[0]) for r in rows])
+        return self._decode(rows[0][0])
+
+    def _load(self, k):
+        if self.multi: rows = self.db.read("SELECT data FROM history WHERE uid=? ORDER BY date DESC, pos", (k,))
+        else: rows = self.db.read(f"SELECT data FROM {self.table} WHERE {self.key}=?", (k,))
+        if not rows and not self.multi: raise KeyError(k)
+        if not rows and not self.db.read("SELECT 1 FROM meta WHERE k=?", (f"history:{k}",)): raise KeyError(k)
+        return self._decode_rows(rows)
+
+    def __getitem__(self, k):
+        with self.lock:
+            if k in self.cache:
+                self.cache.move_to_end(k)
+            else:
+                if k in self.deleted: raise KeyError(k)
+                self.cache[k] = self._load(k)
+            # القراءة لا تجعل السجل متغيراً: من يعدله يعيد كتابته (user_data[uid] = ud) قبل save_data
+            self.seen.add(k)
+            return self.cache[k]
+
+    def __setitem__(self, k, v):
+        with self.lock:
+            self.cache[k] = v
+            self.cache.move_to_end(k)
+            self.deleted.discard(k)
+            self.touched.add(k)
+
+    def __delitem__(self, k):
+        with self.lock:
+            if k not in self: raise KeyError(k)
+            self.cache.pop(k, None)
+            self.touched.discard(k)
+            self.deleted.add(k)
+
+    def __contains__(self, k):
+        with self.lock:
+            if k in self.cache: return True
+            if k in self.deleted: return False
+        if self.multi: return bool(self.db.read("SELECT 1 FROM meta WHERE k=?", (f"history:{k}",)))
+        return bool(self.db.read(f"SELECT 1 FROM {self.table} WHERE {self.key}=?", (k,)))
+
+    def __iter__(self):
+        self.flush()
+        if self.multi: rows = self.db.read("SELECT substr(k, 9) FROM meta WHERE k LIKE 'history:%'")
+        else: rows = self.db.read(f"SELECT {self.key} FROM {self.table}")
+        return iter([r[0] for r in rows])
+
+    def __len__(self):
+        self.flush()
+        if self.multi: return self.db.read("SELECT COUNT(*) FROM meta WHERE k LIKE 'history:%'")[0][0]
+        return self.db.read(f"SELECT COUNT(*) FROM {self.table}")[0][0]
+
+    def items(self):
+        # قراءة متدفقة دون تحميل كل السجلات في الذاكرة، مع تفضيل النسخ المحملة
+        self.flush()
+        if self.multi:
+            groups = OrderedDict((k, []) for k in self)
+            for uid, data in self.db.read("SELECT uid, data FROM history ORDER BY uid, date DESC, pos"):
+                groups.setdefault(uid, []).append(data)
+            for k, rows in groups.items():
+                yield k, self.cache[k] if k in self.cache else unpack_record('history', [json.loads(x) for x in rows])
+            return
+        for k, data in self.db.read(f"SELECT {self.key}, data FROM {self.table}"):
+            yield k, self.cache[k] if k in self.cache else self._decode(data)
+
+    def values(self):
+        for _, v in self.items(): yield v
+
+    def changed_since(self, ts):
+        # السجلات المكتوبة بعد ts عبر الفهرس users_ts (من أي عملية). النسخة المحملة تُفضل فقط إن كانت
+        # بانتظار الكتابة هنا، وإلا فنسخة القاعدة أحدث (كتبتها عملية أخرى)
+        rows = self.db.read(f"SELECT {self.key}, data FROM {self.table} WHERE ts > ?", (ts,))
+        with self.lock: return [(k, self.cache[k] if k in self.touched and k in self.cache else self._decode(d)) for k, d in rows]
+
+    def dirty(self):
+        # السجلات المعدلة التي لم تُكتب بعد (أحدث من نسخة القاعدة)
+        with self.lock: return [(k, self.cache[k]) for k in self.touched if k in self.cache]
 
-user_data = load_data(FILES['users'], {})
-user_saved = load_data(FILES['saved'], {})
-user_history = load_data(FILES['history'], {})
-shared_quizzes = load_data(FILES['shared'], {})
-fixed_quizzes = load_data(FILES['fixed'], {})
+    def period_xp(self, field, key):
+        # [(uid، النقاط)] لمن field عندهم [key، نقاط]: json_extract داخل SQLite بدل فك كل السجلات
+        return self.db.read(f"SELECT {self.key}, json_extract(data, '$.{field}[1]') FROM {self.table} "
+                            f"WHERE json_extract(data, '$.{field}[0]') = ?", (key,))
+
+    def _ops(self, k, v):
+        v = pack_record(self.table, v)
+        if self.multi:
+            rows = [(k, i, x.get('id'), x.get('date', ''), json.dumps(x, ensure_ascii=False)) for i, x in enumerate(v)]
+            ops = [("DELETE FROM history WHERE uid=?", (k,)), ("INSERT OR REPLACE INTO meta (k, v) VALUES (?, '')", (f"history:{k}",))]
+            if rows: ops.append(("INSERT INTO history (uid, pos, fid, date, data) VALUES (?, ?, ?, ?, ?)", rows))
+            return ops, sum(len(r[-1]) for r in rows)
+        cols = [self.key] + list(self.extra) + ['data']
+        raw = json.dumps(v, ensure_ascii=False)
+        vals = [k] + [fn(v) for fn in self.extra.values()] + [raw]
+        if SHARED_DB and 'refs' in self.extra:
+            # عدد المراجع تملكه قاعدة البيانات عند تعدد العمليات (انظر _shared_refs)، لا نكتب فوقه
+            return [(f"INSERT INTO {self.table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+                     f"ON CONFLICT({self.key}) DO UPDATE SET data=excluded.data", vals)], len(raw)
+        return [(f"INSERT OR REPLACE INTO {self.table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", vals)], len(raw)
+
+    def flush(self):
+        with self.lock:
+            ops, size = [], 0
+            for k in self.touched:
+                if k not in self.cache: continue
+                for _ in range(3):
+                    try: op = self._ops(k, self.cache[k]); break
+                    except RuntimeError: time.sleep(0.01)
+                else: continue
+                ops += op[0]
+                size += op[1]
+            for k in self.deleted:
+                if self.multi: ops += [("DELETE FROM history WHERE uid=?", (k,)), ("DELETE FROM meta WHERE k=?", (f"history:{k}",))]
+                else: ops.append((f"DELETE FROM {self.table} WHERE {self.key}=?", (k,)))
+            if ops: self.db.write(ops)
+            # نطرد فقط السجلات التي لم تُلمس في آخر دورتين حتى لا نفقد تعديلات جارية
+            recent = self.touched | self.prev_touched | self.seen | self.prev_seen
+            self.prev_touched, self.touched = self.touched, set()
+            self.prev_seen, self.seen = self.seen, set()
+            self.deleted.clear()
+            for k in list(self.cache):
+                if len(self.cache) <= self.cache_max: break
+                if k not in recent: del self.cache[k]
+            return size
+
+def migrate_json_to_sqlite(db):
+    # ترحيل لمرة واحدة من ملفات JSON القديمة، ثم إعادة تسميتها إلى .migrated
+    for name, f in FILES.items():
+        if db.get_meta(f"migrated:{name}") or not os.path.exists(f): continue
+        try: data = json.load(open(f, 'r', encoding='utf-8'))
+        except: continue
+        store = question_store if name == 'questions' else SqlStore(db, name)
+        for k, v in data.items(): store[str(k)] = unpack_record(name, v)
+        store.flush()
+        question_store.flush()
+        db.write([("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", (f"migrated:{name}", datetime.now().isoformat()))])
+        os.replace(f, f"{f}.migrated")
+        logger.info(f"Migrated {f}: {len(data)} records")
+
+# ==============================
+# 🧩 مخزن الأسئلة الموحد
+# ==============================
+# كل سؤال يُخزن مرة واحدة: question_store[hash] = [السؤال، عدد المراجع]
+# والأرشيف/المفضلة/المشاركة/الجاهزة تحفظ على القرص قائمة hashes فقط
+# id(سؤال مخزن) -> (hash، السؤال) لتجنب إعادة الحساب عند كل حفظ. مع SQLite لا نخزنه
+# لأن المرجع القوي يمنع طرد الأسئلة من الذاكرة، والحفظ هناك يشمل السجلات المتغيرة فقط
+_qhash_ids = {}
+
+def _remember_hash(q, h):
+    if STORAGE_BACKEND != 'sqlite': _qhash_ids[id(q)] = (h, q)
+
+def q_hash(q):
+    e = _qhash_ids.get(id(q))
+    if e and e[1] is q: return e[0]
+    raw = json.dumps([q['q'], q['opts'], q['correct_txt']], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def _shared_refs(recs, delta):
+    # وضع التقسيم: عدة عمليات تغير نفس العدادات، فالزيادة والنقص تتم ذرياً داخل SQLite
+    if delta > 0:
+        db.write([("INSERT INTO questions (h, refs, data) VALUES (?, 1, ?) ON CONFLICT(h) DO UPDATE SET refs = refs + 1",
+                   [(h, json.dumps(rec, ensure_ascii=False)) for h, rec in recs])])
+        return
+    hs = [(h,) for h, _ in recs]
+    db.write([("UPDATE questions SET refs = refs - 1 WHERE h=?", hs), ("DELETE FROM questions WHERE h=? AND refs <= 0", hs)])
+    with question_store.lock:
+        for h, _ in recs: question_store.cache.pop(h, None)
+
+# الفحص ثم الإضافة أو تعديل العدد عملية واحدة: خيطان يضيفان نفس السؤال معاً كانا يكتبان [q, 1] فوق بعض
+# فينقص العدد، ثم يحذف release سؤالاً ما زالت تشير إليه سجلات أخرى
+_qstore_lock = threading.RLock()
+
+def intern_questions(qs):
+    # يرجع نفس الأسئلة لكن بالنسخ المخزنة (مشاركة الكائن نفسه) ويزيد عدد المراجع
+    out, recs = [], []
+    with _qstore_lock:
+        for q in qs:
+            h = q_hash(q)
+            if h in question_store:
+                rec = question_store[h]
+                rec[1] += 1
+            else:
+                rec = [q, 1]
+                _remember_hash(q, h)
+            # الكتابة بعد التعديل: مع SQLite تسجل السجل كمتغير حتى لو كُتب قبل الزيادة
+            question_store[h] = rec
+            out.append(rec[0])
+            recs.append((h, rec))
+        if SHARED_DB and recs: _shared_refs(recs, 1)
+    save_data(FILES['questions'], question_store)
+    return out
+
+def release_questions(qs):
+    with _qstore_lock:
+        if SHARED_DB:
+            _shared_refs([(q_hash(q), None) for q in qs], -1)
+            return
+        for q in qs:
+            h = q_hash(q)
+            if h not in question_store: continue
+            rec = question_store[h]
+            rec[1] -= 1
+            if rec[1] <= 0:
+                del question_store[h]
+                _qhash_ids.pop(id(rec[0]), None)
+            else: question_store[h] = rec
+    save_data(FILES['questions'], question_store)
+
+_legacy_found = False
+
+def _resolve(x):
+    # hash -> السؤال المخزن. القواميس (صيغة الملفات القديمة) تُضاف للمخزن عند أول تحميل
+    global _legacy_found
+    if isinstance(x, dict):
+        _legacy_found = True
+        return intern_questions([x])[0]
+    rec = question_store.get(x)
+    return rec[0] if rec else None
+
+def _unpack_qs(hs): return [q for q in map(_resolve, hs) if q is not None]
+
+def _pack_qs(qs): return [q_hash(q) for q in qs]
+
+def text_hash(q): return hashlib.sha1(q['q'].encode('utf-8')).hexdigest()[:16]
+
+class SavedQuestions:
+    # مفضلة مستخدم: ترتيب الإضافة + فهرس بـ hash نص السؤال، فالحفظ والإلغاء والفحص O(1) بلا مسح.
+    # تُخزن كقائمة (pack_record يمر عليها بالترتيب) وتتحول لقائمة عند فتح المفضلة
+    __slots__ = ('items', 'by_text', 'seq')
+
+    def __init__(self, qs=()):
+        self.items = {}  # رقم تسلسلي -> السؤال (القاموس يحفظ ترتيب الإضافة)
+        self.by_text = {}  # text_hash -> [الأرقام]، أكثر من رقم فقط في بيانات قديمة مكررة
+        self.seq = itertools.count()
+        for q in qs: self.add(q)
+
+    def __len__(self): return len(self.items)
+
+    def __iter__(self): return iter(self.items.values())
+
+    def __contains__(self, h): return h in self.by_text
+
+    def add(self, q):
+        n = next(self.seq)
+        self.items[n] = q
+        self.by_text.setdefault(text_hash(q), []).append(n)
+
+    def remove(self, h):
+        ns = self.by_text[h]
+        q = self.items.pop(ns.pop(0))
+        if not ns: del self.by_text[h]
+        return q
+
+def unpack_record(name, v):
+    if name == 'saved': return SavedQuestions(_unpack_qs(v))
+    if name == 'shared': return _unpack_qs(v)
+    if name == 'history': return [dict(e, questions=_unpack_qs(e.get('questions', []))) for e in v]
+    if name == 'fixed': return dict(v, questions=_unpack_qs(v.get('questions', [])))
+    return v
+
+def pack_record(name, v):
+    if name in ('saved', 'shared'): return _pack_qs(v)
+    if name == 'history': return [dict(e, questions=_pack_qs(e.get('questions', []))) for e in v]
+    if name == 'fixed': return dict(v, questions=_pack_qs(v.get('questions', [])))
+    return v
+
+_FILE_NAMES = {f: name for name, f in FILES.items()}
+
+def pack_collection(f, d):
+    if hasattr(d, 'snapshot'): return d.snapshot()
+    name = _FILE_NAMES.get(f)
+    if name in ('saved', 'shared', 'history', 'fixed'): return {k: pack_record(name, v) for k, v in d.items()}
+    return d
+
+def load_collection(name):
+    global _legacy_found
+    _legacy_found = False
+    d = {k: unpack_record(name, v) for k, v in load_data(FILES[name], {}).items()}
+    # ملف بالصيغة القديمة: نعيد كتابته بالـ hashes فوراً حتى لا تُحسب مراجعه مرة ثانية في التشغيل القادم
+    if _legacy_found: save_data(FILES[name], d)
+    return d
+
+if WORKER_PROCESS:
+    user_data, question_store, user_saved, user_history, shared_quizzes, fixed_quizzes = {}, {}, {}, {}, {}, {}
+elif STORAGE_BACKEND == 'sqlite':
+    db = SqliteBackend(DB_FILE)
+    question_store = SqlStore(db, 'questions')
+    with startup.step("sqlite migrate"): migrate_json_to_sqlite(db)
+    user_data = SqlStore(db, 'users')
+    user_saved = SqlStore(db, 'saved')
+    user_history = SqlStore(db, 'history')
+    shared_quizzes = SqlStore(db, 'shared')
+    fixed_quizzes = SqlStore(db, 'fixed')
+else:
+    with startup.step("load users"): user_data = load_data(FILES['users'], {})
+    with startup.step("load questions"):
+        question_store = load_data(FILES['questions'], {})
+        for h, rec in question_store.items(): _remember_hash(rec[0], h)
+    with startup.step("load saved"): user_saved = load_collection('saved')
+    _stores = {}
+    for _name in ('history', 'shared', 'fixed'):
+        if LAZY_START: _stores[_name] = LazyStore(_name)
+        else:
+            with startup.step(f"load {_name}"): _stores[_name] = load_collection(_name)
+    user_history, shared_quizzes, fixed_quizzes = _stores['history'], _stores['shared'], _stores['fixed']
+
+# ==============================
+# ⭐️ فهرس المفضلة
+# ==============================
+# المفضلة محفوظة كـ SavedQuestions لكل مستخدم (ترتيب + فهرس بنص السؤال)، فلا مسح خطي لكل سؤال يُعرض
+# ولا عند الإلغاء
+_saved_lock = threading.Lock()
+
+def is_saved(uid, q):
+    with _saved_lock: return text_hash(q) in user_saved.get(uid, ())
+
+def toggle_saved(uid, q):
+    # يرجع True عند الحفظ و False عند الإلغاء
+    with _saved_lock:
+        sv, h = user_saved.get(uid), text_hash(q)
+        if sv is None: sv = SavedQuestions()
+        added = h not in sv
+        if added: sv.add(intern_questions([q])[0])
+        else: release_questions([sv.remove(h)])
+        user_saved[uid] = sv
+    save_data(FILES['saved'], user_saved)
+    counters.bump(saved=1 if added else -1)
+    return added
+
+# ==============================
+# 🔎 فهرس البحث
+# ==============================
+# فهرس مقلوب (كلمة -> hashes الأسئلة) فوق نص السؤال والخيارات في الاختبارات الجاهزة والمشاركة.
+# يُبنى كاملاً عند أول بحث ثم يتحدث مع كل إضافة/حذف، فالبحث لا يمسح الاختبارات المخزنة.
+# في وضع التقسيم لكل عملية فهرسها: ما يضيفه غيرها يظهر بعد إعادة تشغيلها
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', '500'))
+SEARCH_PAGE = int(os.getenv('SEARCH_PAGE', '8'))
+FIXED_PAGE = int(os.getenv('FIXED_PAGE', '10'))  # أزرار صفحة الاختبارات الجاهزة
+SEARCH_SESSIONS_MAX = int(os.getenv('SEARCH_SESSIONS_MAX', '1000'))
+_AR_MARKS = re.compile(r'[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')  # التشكيل والتطويل
+_AR_FOLD = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه'})
+
+def normalize_ar(text): return _AR_MARKS.sub('', text.lower()).translate(_AR_FOLD)
+
+def search_tokens(text):
+    out = set()
+    for w in re.findall(r'\w+', normalize_ar(text)):
+        if len(w) > 4 and w.startswith('ال'): w = w[2:]  # "الخلية" و"خلية" كلمة واحدة
+        if len(w) > 1: out.add(w)
+    return out
+
+def _index_text(q): return q['q'] + " " + " ".join(q['opts'])
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.docs = {}  # hash -> [السؤال، {المصادر ('fix'|'sh', qid)}]
+        self.names = {}  # ('fix', qid) -> اسم الاختبار للعرض
+        self.built = False
+        self.lock = threading.RLock()
+
+    def _add(self, src, qs):
+        for q in qs: self._add_doc(q_hash(q), q).add(src)
+
+    def _add_doc(self, h, q):
+        doc = self.docs.get(h)
+        if doc is None:
+            doc = self.docs[h] = [q, set()]
+            for w in search_tokens(_index_text(q)): self.postings[w].add(h)
+        return doc[1]
+
+    def add(self, kind, qid, qs, name=None):
+        with self.lock:
+            if not self.built: return  # البناء الكامل عند أول بحث سيشملها
+            if name: self.names[(kind, qid)] = name
+            self._add((kind, qid), qs)
+
+    def remove(self, kind, qid, qs):
+        with self.lock:
+            if not self.built: return
+            src = (kind, qid)
+            self.names.pop(src, None)
+            for q in qs:
+                h = q_hash(q)
+                doc = self.docs.get(h)
+                if not doc: continue
+                doc[1].discard(src)
+                if doc[1]: continue
+                del self.docs[h]
+                for w in search_tokens(_index_text(q)):
+                    p = self.postings.get(w)
+                    if p is None: continue
+                    p.discard(h)
+                    if not p: del self.postings[w]
+
+    def ensure(self):
+        with self.lock:
+            if self.built: return
+            t0 = time.time()
+            if isinstance(fixed_quizzes, SqlStore): self._build_sql()
+            else:
+                for qid, data in fixed_quizzes.items():
+                    self.names[('fix', qid)] = data['name']
+                    self._add(('fix', qid), data['questions'])
+                for qid, qs in shared_quizzes.items(): self._add(('sh', qid), qs)
+            self.built = True
+            logger.info(f"Search index: {len(self.docs)} questions, {len(self.postings)} terms in {time.time() - t0:.2f}s")
+
+    def _build_sql(self):
+        # مع SQLite: السجلات المخزنة قوائم hashes، فنجمع المصادر منها ثم نقرأ الأسئلة بمسح واحد لجدول
+        # questions، بدل فك كل اختبار وجلب أسئلته واحداً واحداً عبر مخزن الأسئلة
+        for store in (fixed_quizzes, shared_quizzes, question_store): store.flush()
+        srcs = defaultdict(set)
+        for qid, name, data in db.read("SELECT qid, name, data FROM fixed"):
+            self.names[('fix', qid)] = name
+            for h in json.loads(data).get('questions', []): srcs[h].add(('fix', qid))
+        for qid, data in db.read("SELECT qid, data FROM shared"):
+            for h in json.loads(data): srcs[h].add(('sh', qid))
+        for h, data in db.read("SELECT h, data FROM questions"):
+            if h in srcs: self._add_doc(h, json.loads(data)[0]).update(srcs[h])
+
+    def label(self, srcs):
+        for src in srcs:
+            if src in self.names: return f"📑 {self.names[src]}"
+        return "⚔️ تحدي مشترك"
+
+    def search(self, query, limit=SEARCH_MAX_RESULTS):
+        # [(السؤال، المصدر)] مرتبة بعدد كلمات البحث المطابقة (المطابق لكل الكلمات أولاً)
+        words = search_tokens(query)
+        if not words: return []
+        self.ensure()
+        t0 = time.perf_counter()
+        with self.lock:
+            hits = Counter()
+            for w in words: hits.update(self.postings.get(w, ()))
+            top = sorted(hits, key=lambda h: (-hits[h], h))[:limit]
+            res = [(self.docs[h][0], self.label(self.docs[h][1])) for h in top]
+        SEARCH_SECONDS.observe(time.perf_counter() - t0)
+        return res
+
+search_index = SearchIndex()
+search_results = OrderedDict()  # chat -> (الاستعلام، النتائج، الزمن ms)
+
+# ==============================
+# 📊 العدادات والتجميع اليومي
+# ==============================
+# الإجماليات تتحدث مع كل حدث بدل مسح كل المستخدمين في /admin، ومعها سلسلة يومية مضغوطة لآخر ROLLUP_DAYS يوم
+STATS_FILE = os.getenv('STATS_FILE', 'stats.json')
+ROLLUP_DAYS = int(os.getenv('ROLLUP_DAYS', '30'))
+DAY_FIELDS = ('active', 'new_users', 'uploads', 'answers', 'correct')
+
+class Counters:
+    def __init__(self):
+        self.totals = {'users': 0, 'files': 0, 'saved': 0, 'fixed': 0}
+        self.days = OrderedDict()  # "YYYY-MM-DD" -> [قيمة لكل حقل في DAY_FIELDS]
+        self.lock = threading.Lock()
+        self.stale = False  # نتيجة rebuild لم تُحفظ بعد
+
+    def persist(self):
+        # حفظ ما بناه rebuild: عند الإقلاع (__main__)، وإلا مع أول bump (يحفظ الحالة كاملة)
+        if self.stale:
+            self.stale = False
+            save_data(STATS_FILE, self)
+
+    def bump(self, **kw):
+        # مفاتيح totals تُضاف للإجماليات، ومفاتيح DAY_FIELDS لخانة اليوم
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            row = self.days.get(today)
+            for k, v in kw.items():
+                if k in self.totals:
+                    self.totals[k] += v
+                    continue
+                if row is None:
+                    row = self.days[today] = [0] * len(DAY_FIELDS)
+                    while len(self.days) > ROLLUP_DAYS: self.days.popitem(last=False)
+                row[DAY_FIELDS.index(k)] += v
+        save_data(STATS_FILE, self)
+
+    def day(self, key=None):
+        row = self.days.get(key or datetime.now().strftime("%Y-%m-%d"))
+        return dict(zip(DAY_FIELDS, row or [0] * len(DAY_FIELDS)))
+
+    def series(self, field, n=ROLLUP_DAYS):
+        # قيم آخر n يوم بالترتيب، والأيام بلا نشاط = 0
+        i, now = DAY_FIELDS.index(field), datetime.now()
+        keys = [datetime.fromordinal(now.toordinal() - d).strftime("%Y-%m-%d") for d in range(n - 1, -1, -1)]
+        with self.lock: return [(self.days.get(k) or [0] * len(DAY_FIELDS))[i] for k in keys]
+
+    def snapshot(self):
+        with self.lock: return {'totals': dict(self.totals), 'days': {k: list(v) for k, v in self.days.items()}}
+
+    def rebuild(self):
+        # مرة واحدة عند غياب الملف: نفس الحساب القديم، ونشاط اليوم من last_active
+        today = datetime.now().strftime("%Y-%m-%d")
+        if isinstance(user_data, SqlStore):
+            # العد داخل SQLite بدل فك كل السجلات (الحفظ أولاً لأن الكتابة مؤجلة)
+            for store in (user_data, user_history, user_saved, fixed_quizzes): store.flush()
+            self.totals['users'] = db.read("SELECT COUNT(*) FROM users")[0][0]
+            active = db.read("SELECT COUNT(*) FROM users WHERE json_extract(data, '$.last_active') = ?", (today,))[0][0]
+            self.totals['files'] = db.read("SELECT COUNT(*) FROM history")[0][0]
+            self.totals['saved'] = db.read("SELECT COALESCE(SUM(json_array_length(data)), 0) FROM saved")[0][0]
+        else:
+            active = 0
+            for ud in user_data.values():
+                self.totals['users'] += 1
+                active += ud.get('last_active') == today
+            self.totals['files'] = sum(len(v) for v in user_history.values())
+            self.totals['saved'] = sum(len(v) for v in user_saved.values())
+        self.totals['fixed'] = len(fixed_quizzes)
+        if active: self.days[today] = [active] + [0] * (len(DAY_FIELDS) - 1)
+        self.stale = True  # الحساب يقرأ فقط، والحفظ في persist: استيراد الوحدة لا يكتب stats.json
+
+class SharedCounters(Counters):
+    # وضع التقسيم: كل عملية تجمع فروقها محلياً وتضيفها ذرياً لجدول counters عند الحفظ،
+    # و refresh يقرأ المجموع من كل العمليات (عدد صفوف ثابت: الإجماليات + ROLLUP_DAYS يوم)
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.delta = {}
+
+    def bump(self, **kw):
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            for k, v in kw.items():
+                key = f"total:{k}" if k in self.totals else f"day:{today}:{k}"
+                self.delta[key] = self.delta.get(key, 0) + v
+        super().bump(**kw)
+
+    def flush(self):
+        with self.lock: delta, self.delta = self.delta, {}
+        if delta: self.db.write([("INSERT INTO counters (k, v) VALUES (?, ?) ON CONFLICT(k) DO UPDATE SET v = v + excluded.v", list(delta.items()))])
+        return 0
+
+    def refresh(self):
+        rows = self.db.read("SELECT k, v FROM counters")
+        totals, days = {k: 0 for k in self.totals}, {}
+        with self.lock:
+            for k, v in rows + list(self.delta.items()):
+                parts = k.split(':')
+                if parts[0] == 'total': totals[parts[1]] = totals.get(parts[1], 0) + v
+                elif parts[0] == 'day' and parts[2] in DAY_FIELDS:
+                    days.setdefault(parts[1], [0] * len(DAY_FIELDS))[DAY_FIELDS.index(parts[2])] += v
+            self.totals = totals
+            self.days = OrderedDict(sorted(days.items())[-ROLLUP_DAYS:])
+
+    def rebuild(self):
+        # مرة واحدة من العملية الرئيسية قبل تشغيل العمليات الفرعية
+        super().rebuild()
+        with self.lock:
+            for k, v in self.totals.items(): self.delta[f"total:{k}"] = v
+            for d, row in self.days.items():
+                for f, v in zip(DAY_FIELDS, row): self.delta[f"day:{d}:{f}"] = v
+
+    def persist(self):
+        # مباشرة لا عبر save_data: العمليات الفرعية تقرأ الجدول فور تشغيلها
+        if self.stale:
+            self.stale = False
+            self.flush()
+
+def sparkline(vals):
+    top = max(vals) or 1
+    return "".join("▁▂▃▄▅▆▇█"[min(7, v * 8 // (top + 1))] for v in vals)
+
+with startup.step("counters"):
+    if WORKER_PROCESS: counters = Counters()
+    elif STORAGE_BACKEND == 'sqlite' and (SHARED_DB or os.getenv('RUN_MODE') == 'sharded'):
+        STATS_FILE = 'counters@db'  # مفتاح في _pending فقط، الحفظ يمر عبر SharedCounters.flush
+        counters = SharedCounters(db)
+        if not SHARED_DB and not db.read("SELECT 1 FROM counters WHERE k='total:users'"): counters.rebuild()
+        counters.refresh()
+    else:
+        counters = Counters()
+        _snap = load_data(STATS_FILE, None)
+        if _snap:
+            counters.totals.update(_snap.get('totals', {}))
+            counters.days.update(sorted(_snap.get('days', {}).items())[-ROLLUP_DAYS:])
+        else: counters.rebuild()
+
+# ==============================
+# ⏱ المؤقتات (خيط واحد)
+# ==============================
+# بدل threading.Timer (خيط جديد لكل رسالة): كومة مواعيد يديرها خيط واحد، والدوال تُنفذ على منفذ صغير
+# حتى لا يؤخر مؤقت بطيء بقية المواعيد
+TIMER_WORKERS = int(os.getenv('TIMER_WORKERS', '4'))
+
+class TimerHandle:
+    __slots__ = ('when', 'fn', 'args', 'cancelled')
+
+    def __init__(self, when, fn, args):
+        self.when, self.fn, self.args, self.cancelled = when, fn, args, False
+
+    def cancel(self): self.cancelled = True
+
+    def _fire(self):
+        if self.cancelled: return
+        try: self.fn(*self.args)
+        except Exception: logger.exception(f"Timer {getattr(self.fn, '__name__', self.fn)} failed")
+
+class Scheduler:
+    def __init__(self, workers=TIMER_WORKERS):
+        self.heap = []
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+        self.thread = None
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='timer')
+        self.fired = 0
+
+    def call_later(self, delay, fn, *args):
+        h = TimerHandle(time.monotonic() + delay, fn, args)
+        with self.cv:
+            heapq.heappush(self.heap, (h.when, next(self.seq), h))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+                self.thread.start()
+            self.cv.notify()
+        return h
+
+    def every(self, interval, fn, *args):
+        # مهمة دورية: تعيد جدولة نفسها بعد كل تنفيذ
+        def tick():
+            try: fn(*args)
+            finally: self.call_later(interval, tick)
+        return self.call_later(interval, tick)
+
+    def pending(self):
+        with self.cv: return sum(1 for _, _, h in self.heap if not h.cancelled)
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled: heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cv.wait()
+                        continue
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0: break
+                    self.cv.wait(wait)
+                h = heapq.heappop(self.heap)[2]
+            self.fired += 1
+            self.pool.submit(h._fire)
+
+timers = Scheduler()
+
+# ==============================
+# 🎯 إدارة الجلسات
+# ==============================
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(6 * 3600)))  # الجلسة الخاملة تُحذف بعدها
+SESSION_MAX = int(os.getenv('SESSION_MAX', '20000'))
+SESSION_MAX_QUESTIONS = int(os.getenv('SESSION_MAX_QUESTIONS', '1000000'))  # سقف الذاكرة: مجموع الأسئلة في كل الجلسات
+POLL_MAP_MAX = int(os.getenv('POLL_MAP_MAX', '30'))  # الاستفتاءات القديمة جداً لا تُحتسب
+SESSION_SNAPSHOT = os.getenv('SESSION_SNAPSHOT', '')  # مسار ملف لاستئناف الاختبارات بعد إعادة التشغيل
+if SESSION_SNAPSHOT and SHARED_DB: SESSION_SNAPSHOT += f".shard{SHARD_ID}"  # كل عملية تملك جلساتها
+SESSION_SWEEP = float(os.getenv('SESSION_SWEEP', '600'))  # كل كم ثانية تُحذف الجلسات المنتهية
+
+class Session:
+    # الأسئلة مراجع لنفس القائمة في الأرشيف/المفضلة وليست نسخاً
+    __slots__ = ('questions', 'current', 'score', 'wrong_indices', 'poll_map', 'finished', 'last_used', 'loading', 'waiting', 'refs')
+
+    def __init__(self, questions, current=0, score=0, wrong_indices=None, poll_map=None, finished=False):
+        self.questions = questions
+        self.current = current
+        self.score = score
+        self.wrong_indices = wrong_indices if wrong_indices is not None else []
+        self.poll_map = poll_map if poll_map is not None else {}  # poll_id -> (رقم الخيار الصحيح، رقم السؤال)
+        self.finished = finished
+        self.last_used = time.time()
+        self.loading = False  # باقي أسئلة الملف ما زالت تُحلل (البدء التدريجي)
+        self.waiting = False  # المستخدم وصل لآخر سؤال جاهز وينتظر الدفعة التالية
+        self.refs = []  # صيغة اللقطة للأسئلة (hash المخزن أو السؤال نفسه)، تُحسب مرة لكل سؤال
+
+    def add_poll(self, poll_id, correct, q_index):
+        self.poll_map[poll_id] = (correct, q_index)
+        while len(self.poll_map) > POLL_MAP_MAX: del self.poll_map[next(iter(self.poll_map))]
+
+class SessionStore:
+    # LRU مع انتهاء صلاحية: أقدم جلسة تُطرد عند تجاوز العدد أو مجموع الأسئلة
+    def __init__(self):
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.n_questions = 0
+        self.evicted = 0
+        self.dirty = set()  # جلسات تغيرت (أو حُذفت) منذ آخر لقطة
+        self.frags = {}  # cid -> نص JSON الجلسة في آخر لقطة
+
+    def get(self, cid):
+        with self.lock:
+            s = self.data.get(cid)
+            if s is None: return None
+            now = time.time()
+            if now - s.last_used > SESSION_TTL:
+                self._drop(cid)
+                return None
+            s.last_used = now
+            self.data.move_to_end(cid)
+            return s
+
+    def __contains__(self, cid): return self.get(cid) is not None
+
+    def __getitem__(self, cid):
+        s = self.get(cid)
+        if s is None: raise KeyError(cid)
+        return s
+
+    def __len__(self): return len(self.data)
+
+    def start(self, cid, questions, **kw):
+        s = Session(questions, **kw)
+        with self.lock:
+            if cid in self.data: self._drop(cid)
+            self.data[cid] = s
+            self.n_questions += len(questions)
+            self.sweep()
+        self.changed(cid)
+        pretranslate(questions)
+        return s
+
+    def _drop(self, cid):
+        s = self.data.pop(cid)
+        self.n_questions -= len(s.questions)
+        if SESSION_SNAPSHOT: self.dirty.add(cid)
+
+    def sweep(self):
+        with self.lock:
+            now = time.time()
+            while self.data:
+                cid, s = next(iter(self.data.items()))
+                if now - s.last_used <= SESSION_TTL and len(self.data) <= SESSION_MAX and self.n_questions <= SESSION_MAX_QUESTIONS: break
+                self._drop(cid)
+                self.evicted += 1
+
+    def changed(self, cid):
+        if not SESSION_SNAPSHOT: return
+        with self.lock: self.dirty.add(cid)
+        save_data(SESSION_SNAPSHOT, self)
+
+    def _refs(self, s):
+        # الأسئلة لا تتغير إلا بالإضافة (البدء التدريجي)، فالـ hash وفحص المخزن للجديد منها فقط
+        for q in s.questions[len(s.refs):]:
+            h = q_hash(q)
+            s.refs.append(h if h in question_store else q)
+        return s.refs
+
+    def dump(self):
+        # يعاد ترميز الجلسات المتغيرة فقط، والباقي من نصه السابق
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            items = [(cid, self.data.get(cid)) for cid in dirty]
+        for cid, s in items:
+            if s is None:
+                self.frags.pop(cid, None)
+                continue
+            self.frags[cid] = json.dumps({'questions': self._refs(s), 'current': s.current, 'score': s.score, 'wrong_indices': s.wrong_indices,
+                                          'poll_map': [[p, c, i] for p, (c, i) in list(s.poll_map.items())], 'finished': s.finished,
+                                          'last_used': s.last_used}, ensure_ascii=False)
+        return "{" + ",\n".join(f'"{cid}": {frag}' for cid, frag in list(self.frags.items())) + "}"
+
+    def restore(self, path):
+        snap = load_data(path, {})
+        for cid, d in snap.items():
+            qs = [x if isinstance(x, dict) else (question_store.get(x) or [None])[0] for x in d['questions']]
+            if None in qs: continue
+            s = Session(qs, d['current'], d['score'], d['wrong_indices'], {p: (c, i) for p, c, i in d['poll_map']}, d['finished'])
+            s.last_used = d.get('last_used', s.last_used)
+            s.refs = d['questions']
+            self.data[int(cid)] = s
+            self.dirty.add(int(cid))
+            self.n_questions += len(qs)
+        self.sweep()
+        if snap: logger.info(f"Sessions restored: {len(self.data)}")
+
+user_sessions = SessionStore()
+if not WORKER_PROCESS:
+    if SESSION_SNAPSHOT:
+        with startup.step("restore sessions"): user_sessions.restore(SESSION_SNAPSHOT)
+    timers.every(SESSION_SWEEP, user_sessions.sweep)
+    timers.every(SESSION_SWEEP, lambda: sweep_group_boards())
 
-user_sessions = {}
 user_settings = {}
 default_settings = {'timer': False, 'clean_mode': True}
 
@@ -88,28 +1625,50 @@ def get_rank_info(xp):
             
     return current_rank, next_rank, next_xp
 
-def update_stats(user_id, name="User", is_correct=False, file_uploaded=False):
-    uid = str(user_id)
-    if uid not in user_data: user_data[uid] = {}
+def _touch_user(uid, name, ev):
+    # إنشاء المستخدم/إكمال حقوله وتحديث الاسم وأيام النشاط، والأحداث تُجمع في ev للعدادات
+    # يرجع (السجل، هل تغير). المستدعي يعيد كتابته في user_data إن تغير
+    ud = user_data.get(uid)
+    changed = ud is None
+    if changed:
+        ud = {}
+        ev['users'] = ev['new_users'] = 1
     
     defaults = {
         'name': name, 'xp': 0, 'total_correct': 0, 'files_uploaded': 0, 
         'streak': 0, 'badges': [], 'last_active': '', 'active_days': 0
     }
     for k, v in defaults.items():
-        if k not in user_data[uid]: user_data[uid][k] = v
+        if k not in ud:
+            ud[k] = v
+            changed = True
     
     # تحديث الاسم دائماً
-    user_data[uid]['name'] = name
+    if ud['name'] != name:
+        ud['name'] = name
+        changed = True
     
-    ud = user_data[uid]
     today = datetime.now().strftime("%Y-%m-%d")
     
     if ud['last_active'] != today:
         ud['last_active'] = today
         ud['active_days'] += 1
+        ev['active'] = 1
+        changed = True
+    return ud, changed
+
+def _award_badges(ud):
+    if ud['total_correct'] >= 50 and 'sniper' not in ud['badges']: ud['badges'].append('sniper')
+    if ud['total_correct'] >= 200 and 'genius' not in ud['badges']: ud['badges'].append('genius')
+    if ud['streak'] >= 10 and 'fire' not in ud['badges']: ud['badges'].append('fire')
+
+def update_stats(user_id, name="User", is_correct=False, file_uploaded=False, answered=False):
+    uid = str(user_id)
+    ev = {}
+    ud, changed = _touch_user(uid, name, ev)
     
     if file_uploaded:
+        ev['uploads'] = 1
         ud['files_uploaded'] += 1
         if ud['files_uploaded'] >= 1 and 'bookworm' not in ud['badges']: ud['badges'].append('bookworm')
 
@@ -117,19 +1676,205 @@ def update_stats(user_id, name="User", is_correct=False, file_uploaded=False):
         ud['total_correct'] += 1
         ud['streak'] += 1
         ud['xp'] += 10
-        
-        # الشارات
-        if ud['total_correct'] >= 50 and 'sniper' not in ud['badges']: ud['badges'].append('sniper')
-        if ud['total_correct'] >= 200 and 'genius' not in ud['badges']: ud['badges'].append('genius')
-        if ud['streak'] >= 10 and 'fire' not in ud['badges']: ud['badges'].append('fire')
-    else:
-        if not file_uploaded: ud['streak'] = 0
+        _award_badges(ud)
+    elif not file_uploaded and ud['streak']:
+        ud['streak'] = 0
+        changed = True
 
+    if answered:
+        ev['answers'] = 1
+        if is_correct: ev['correct'] = 1
+    if ev: counters.bump(**ev)
+    _lb_record(uid, ud, 10 if is_correct else 0)
+    # فتح الملف الشخصي مثلاً لا يغير شيئاً: لا كتابة ولا تحديث لـ ts (sync_leaderboards)
+    if not (changed or file_uploaded or is_correct): return
+    user_data[uid] = ud
     save_data(FILES['users'], user_data)
 
-@app.route('/')
+# ==============================
+# 🏆 فهرس المتصدرين
+# ==============================
+# عرض خانة الشجرة بالنقاط. 1 = خانة لكل قيمة نقاط، فالترتيب دقيق حتى مع نقاط ليست من مضاعفات 10 (سجلات
+# مرحّلة أو معدّلة يدوياً). خانة أعرض تجمع قيماً مختلفة تُرتب داخلها بترتيب الوصول لا بالنقاط.
+# حجم الشجرة يتبع أعلى نقاط (مليون نقطة ≈ 8MB)
+XP_STEP = 1
+LB_TOP = 10  # طول قائمة المتصدرين المحفوظة جاهزة
+
+class XPIndex:
+    # شجرة Fenwick على خانات النقاط: الترتيب O(log N) بدون فرز. أفضل LB_TOP قائمة جاهزة تتحدث مع كل
+    # update بـ O(K) فيُقرأ المتصدرون بـ O(K)، ولا يُعاد حسابها من الشجرة (O(K log N)) إلا إذا نقصت نقاط أحدهم
+    def __init__(self, key=None):
+        self.key = key
+        self.xp = {}
+        self.buckets = {}
+        self.n = 64
+        self.tree = [0] * (self.n + 1)
+        self.total = 0
+        self.leaders = []  # [(uid, xp)] بنفس ترتيب _walk_top، أو None حتى يُعاد حسابها
+
+    def _grow(self, b):
+        # عند تجاوز أعلى خانة نضاعف الحجم ونعيد البناء (نادر)
+        if b < self.n: return
+        while b >= self.n: self.n *= 2
+        self.tree = [0] * (self.n + 1)
+        for ob, us in self.buckets.items(): self._add(ob, len(us))
+
+    def _add(self, b, delta):
+        i = b + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, b):
+        # عدد المستخدمين في الخانات 0..b
+        s, i = 0, min(b + 1, self.n)
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    def _kth(self, k):
+        # الخانة التي تحتوي المستخدم رقم k (تصاعدياً)
+        pos, step = 0, self.n
+        while step:
+            if pos + step <= self.n and self.tree[pos + step] < k:
+                pos += step
+                k -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    def update(self, uid, xp):
+        old = self.xp.get(uid)
+        if old == xp: return
+        if old is not None:
+            ob = old // XP_STEP
+            self.buckets[ob].pop(uid, None)
+            if not self.buckets[ob]: del self.buckets[ob]
+            self._add(ob, -1)
+            self.total -= 1
+        b = xp // XP_STEP
+        self._grow(b)
+        self.xp[uid] = xp
+        self.buckets.setdefault(b, {})[uid] = None
+        self._add(b, 1)
+        self.total += 1
+        self._update_leaders(uid, old, xp)
+
+    def _update_leaders(self, uid, old, xp):
+        # القادم لخانة يُرتب بعد من سبقه إليها (نفس ترتيب buckets)، وأقل من LB_TOP عنصر = كل المستخدمين
+        c = self.leaders
+        if c is None: return
+        i = next((j for j, (u, _) in enumerate(c) if u == uid), None)
+        if i is not None:
+            if xp < old:
+                self.leaders = None
+                return
+            del c[i]
+        elif len(c) >= LB_TOP and xp // XP_STEP <= c[-1][1] // XP_STEP: return
+        b = xp // XP_STEP
+        pos = next((j for j, (_, x) in enumerate(c) if x // XP_STEP < b), len(c))
+        if i is not None and pos == len(c) == LB_TOP - 1:
+            # آخر القائمة الممتلئة: قد يسبقه في خانته مستخدم خارجها
+            self.leaders = None
+            return
+        c.insert(pos, (uid, xp))
+        del c[LB_TOP:]
+
+    def rank(self, uid):
+        if uid not in self.xp: return None
+        return self.total - self._prefix(self.xp[uid] // XP_STEP) + 1
+
+    def top(self, k=LB_TOP):
+        if k > LB_TOP: return self._walk_top(k)
+        if self.leaders is None: self.leaders = self._walk_top(LB_TOP)
+        return self.leaders[:k]
+
+    def _walk_top(self, k):
+        res, remaining = [], self.total
+        while remaining > 0 and len(res) < k:
+            b = self._kth(remaining)
+            us = self.buckets.get(b, {})
+            for uid in us:
+                res.append((uid, self.xp[uid]))
+                if len(res) >= k: break
+            remaining -= len(us) or 1
+        return res
+
+class SqlBoard:
+    # الترتيب الكلي مع SQLite مباشرة من الفهرس users_xp (بنفس واجهة XPIndex) بدل تحميل كل المستخدمين.
+    # يعكس ما كُتب في القاعدة، أي متأخر عن الذاكرة بـ SAVE_INTERVAL على الأكثر
+    key = None
+
+    def __init__(self, db): self.db = db
+
+    def update(self, uid, xp): pass  # النقاط تصل مع كتابة السجل نفسه
+
+    @property
+    def total(self): return self.db.read("SELECT COUNT(*) FROM users")[0][0]
+
+    def rank(self, uid):
+        r = self.db.read("SELECT xp FROM users WHERE uid=?", (uid,))
+        if not r: return None
+        return self.db.read("SELECT COUNT(*) FROM users WHERE xp > ?", (r[0][0],))[0][0] + 1
+
+    def top(self, k=LB_TOP): return self.db.read("SELECT uid, xp FROM users ORDER BY xp DESC LIMIT ?", (k,))
+
+lb_lock = threading.Lock()
+leaderboards = {}
+_lb_built = 0.0  # وقت آخر بناء/مزامنة (time.time) لـ sync_leaderboards
+
+def _period_keys():
+    now = datetime.now()
+    y, w, _ = now.isocalendar()
+    return {'day': now.strftime("%Y-%m-%d"), 'week': f"{y}-W{w:02d}"}
+
+def _lb_apply(uid, ud, keys):
+    leaderboards['all'].update(uid, ud.get('xp', 0))
+    for p, k in keys.items():
+        if leaderboards[p].key != k: leaderboards[p] = XPIndex(k)
+        pk, pxp = ud.get(f'xp_{p}', ['', 0])
+        if pk == k and pxp: leaderboards[p].update(uid, pxp)
+
+def get_leaderboard(period='all'):
+    global _lb_built
+    with lb_lock:
+        if not leaderboards:
+            # البناء مرة واحدة عند أول طلب، بعدها يتحدث مع كل نقطة في update_stats
+            keys = _period_keys()
+            _lb_built = time.time()
+            for p, k in keys.items(): leaderboards[p] = XPIndex(k)
+            if isinstance(user_data, SqlStore):
+                # مع SQLite: الكلي من الفهرس users_xp، واليومي/الأسبوعي من نشطي الفترة فقط، بدون فك كل السجلات
+                pending = user_data.dirty()
+                leaderboards['all'] = SqlBoard(db)
+                for p, k in keys.items():
+                    for uid, pxp in user_data.period_xp(f'xp_{p}', k): leaderboards[p].update(uid, pxp)
+                for uid, ud in pending: _lb_apply(uid, ud, keys)
+            else:
+                leaderboards['all'] = XPIndex()
+                for uid, ud in user_data.items(): _lb_apply(uid, ud, keys)
+        if period != 'all':
+            k = _period_keys()[period]
+            if leaderboards[period].key != k: leaderboards[period] = XPIndex(k)
+        return leaderboards[period]
+
+def _lb_record(uid, ud, gained):
+    if gained:
+        for p, k in _period_keys().items():
+            pk, pxp = ud.get(f'xp_{p}', ['', 0])
+            ud[f'xp_{p}'] = [k, (pxp if pk == k else 0) + gained]
+    with lb_lock:
+        if not leaderboards: return
+        leaderboards['all'].update(uid, ud['xp'])
+        if not gained: return
+        for p, k in _period_keys().items():
+            # انتهاء اليوم/الأسبوع = فهرس جديد فارغ، بدون إعادة مسح المستخدمين
+            if leaderboards[p].key != k: leaderboards[p] = XPIndex(k)
+            leaderboards[p].update(uid, ud[f'xp_{p}'][1])
+
+@route('/')
 def home(): return "V39 Ultimate Running"
-def run(): app.run(host='0.0.0.0', port=8080)
+def run(): get_app().run(host='0.0.0.0', port=8080)
 def keep_alive(): threading.Thread(target=run).start()
   # ==============================
 # 🚜 FUNDAMENTAL PARSER (V4)
@@ -202,6 +1947,85 @@ def parse_questions_from_text(text):
     
     save()
     return questions
+
+# ==============================
+# ⚡ FAST PARSER (نفس مخرجات V4 حرفياً)
+# ==============================
+# محرك بديل: أنماط مترجمة مسبقاً، مرور واحد على الأسطر، ومفتاح الإجابات
+# لا يُمسح إلا إذا وُجد سؤال بدون نجمة. راجع tools/parser_equivalence.py
+PARSER_ENGINE = os.getenv('PARSER_ENGINE', 'fast')  # fast | v4
+
+_P_KEY = re.compile(r'(\d+)[\s\.\-\):]+([a-eA-E1-5])(?!\w)')
+_P_SKIP = re.compile(r'(?:Answer|Key|مفتاح|Page|صفحة)', re.IGNORECASE)
+_P_OPT = re.compile(r'^\s*(\*?)\s*[\(\[]?\s*([a-eA-E]|[1-5]|[\-\*])[\.\)\]\-:\s]+(.+)', re.IGNORECASE)
+_P_QS = re.compile(r'^\s*(?:Q|س|S)?\s*(\d+)[\.\)\-:\s]+(.+)', re.IGNORECASE)
+_KEY_IDX = {'a':0,'b':1,'c':2,'d':3,'e':4,'1':0,'2':1,'3':2,'4':3,'5':4}
+# الحروف الأولى الممكنة لأسطر التخطي والأسئلة (مع مكافئات IGNORECASE: K=U+212A, ſ=U+017F)
+_SKIP_FIRST = frozenset('AaKkPpمص\u212a')
+_QS_FIRST = frozenset('QqSsſس')
+
+def parse_questions_fast(text, resolve=True, cut=None):
+    # cut (قائمة): تُملأ بـ [النص من آخر سؤال مقبول، عدد الأسئلة قبله] للتحليل التدريجي؛
+    # ما قبل آخر رأس سؤال نهائي لأن الرأس يصفّر الحالة، فيكفي لاحقاً تحليل الذيل مع النص الجديد
+    text = text.replace('\ufeff', '').replace('\r', '')
+    questions = []
+    unresolved = False
+    txt, opts, mark = [], [], None
+    expected_q_num = 1
+    lines, last_q, n_before = text.split('\n'), 0, 0
+    skip, match_q, match_opt = _P_SKIP.match, _P_QS.match, _P_OPT.match
+    skip_first, qs_first = _SKIP_FIRST, _QS_FIRST
+
+    def save():
+        nonlocal unresolved
+        if not txt or len(opts) < 2: return
+        # بدون نجمة: الحل من مفتاح الإجابات (قد يأتي في آخر الملف) أو عشوائي، يُحسم بعد المرور
+        if mark is None: unresolved = True
+        questions.append({'q': "\n".join(txt).strip(), 'opts': opts, 'correct_txt': mark})
+
+    for n, line in enumerate(lines):
+        line = line.strip()
+        if not line: continue
+        c0 = line[0]
+        if (c0 in skip_first and skip(line)) or line.isdigit(): continue
+
+        m_q = match_q(line) if c0 in qs_first or c0.isdigit() else None
+        if m_q:
+            q_num = int(m_q.group(1))
+            if q_num == expected_q_num or opts or not txt: expected_q_num = q_num + 1
+            elif q_num == 1: expected_q_num = 2
+            else: m_q = None
+
+        if m_q:
+            save()
+            last_q, n_before = n, len(questions)
+            txt, opts, mark = [m_q.group(2).strip()], [], None
+        else:
+            m_opt = match_opt(line) if len(line) < 300 else None
+            if m_opt:
+                content = m_opt.group(3).strip()
+                if not content: content = m_opt.group(2) + " " + m_opt.group(3)
+                opts.append(content)
+                if mark is None and (c0 == '*' or m_opt.group(1) == '*'): mark = content
+            elif not opts: txt.append(line)
+    save()
+    if cut is not None: cut[:] = ["\n".join(lines[last_q:]), n_before]
+
+    if unresolved and resolve:
+        answer_key = {}
+        for m in _P_KEY.finditer(text): answer_key[int(m.group(1))] = _KEY_IDX.get(m.group(2).lower(), 0)
+        for i, q in enumerate(questions, 1):
+            if q['correct_txt'] is not None: continue
+            c = answer_key.get(i)
+            q['correct_txt'] = q['opts'][c] if c is not None and c < len(q['opts']) else random.choice(q['opts'])
+    return questions
+
+def parse_questions(text):
+    t0 = time.perf_counter()
+    try:
+        if PARSER_ENGINE == 'v4': return parse_questions_from_text(text)
+        return parse_questions_fast(text)
+    finally: PARSE_SECONDS.observe(time.perf_counter() - t0, PARSER_ENGINE)
   # ==============================
 # 🎨 UI & Helpers
 # ==============================
@@ -246,121 +2070,813 @@ def settings_markup(chat_id):
     mk.add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
     return mk
 
-class PDF(FPDF):
-    def header(self):
-        try:
-            self.set_font('Arial', 'B', 14)
-            self.cell(0, 10, 'Quizni Exam', 0, 1, 'C')
-            self.ln(5)
-        except: pass
+def render_pdf(questions):
+    # الرسم نفسه في pdf_worker (يُنفذ أيضاً داخل عمليات PDF_WORKERS)، وهنا يُسجل زمن أول استيراد لـ fpdf
+    lazy_import('fpdf')
+    return pdf_worker.render_pdf(questions)
 
-def create_pdf_file(questions, filename):
+# كاش الاشتراك: (القناة، المستخدم) -> (مشترك؟، وقت الانتهاء)
+SUB_TTL_OK = float(os.getenv('SUB_TTL_OK', '600'))
+SUB_TTL_FAIL = float(os.getenv('SUB_TTL_FAIL', '20'))
+SUB_CACHE_MAX = int(os.getenv('SUB_CACHE_MAX', '50000'))
+_sub_cache = {}
+_sub_lock = threading.Lock()  # الكتابة والتنظيف من عدة خيوط معالجة؛ القراءة بـ get لا تحتاجه
+_sub_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="sub-check")
+sub_stats = {'hits': 0, 'misses': 0, 'api_calls': 0, 'prefetched': 0}
+
+def _is_member(ch, user_id):
+    sub_stats['api_calls'] += 1
+    t0 = time.perf_counter()
     try:
-        pdf = PDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=11)
-        for i, q in enumerate(questions):
-            try:
-                q_txt = q['q'].encode('latin-1', 'replace').decode('latin-1')
-                corr = q['correct_txt'].encode('latin-1', 'replace').decode('latin-1')
-                pdf.set_font("Arial", 'B', 11)
-                pdf.multi_cell(0, 8, f"Q{i+1}: {q_txt}")
-                pdf.set_font("Arial", size=10)
-                for opt in q['opts']:
-                    o_txt = opt.encode('latin-1', 'replace').decode('latin-1')
-                    pdf.cell(0, 5, f" - {o_txt}", 0, 1)
-                pdf.set_font("Arial", 'B', 10)
-                pdf.cell(0, 8, f" [Ans]: {corr}", 0, 1)
-                pdf.ln(3)
-            except: continue
-        pdf.output(filename)
-        return True
-    except: return False
+        ok = api.get_chat_member(ch, user_id).status in ['creator', 'administrator', 'member']
+        API_SECONDS.observe(time.perf_counter() - t0, 'get_chat_member')
+        return ok
+    except Exception as e:
+        API_ERRORS.inc('get_chat_member', str(getattr(e, 'error_code', None) or type(e).__name__))
+        # إذا لم يتمكن البوت من التحقق (ليس أدمن)، نعتبر المستخدم غير مشترك للأمان
+        return False
+
+def _sub_store(user_id, missing, results, now):
+    with _sub_lock:
+        if missing and len(_sub_cache) > SUB_CACHE_MAX:
+            for k in [k for k, v in _sub_cache.items() if v[1] <= now]: del _sub_cache[k]
+            # كلها صالحة: الأقدم إدخالاً يخرج حتى لا يُعاد المسح الكامل مع كل فحص
+            for k in list(itertools.islice(_sub_cache, max(0, len(_sub_cache) - SUB_CACHE_MAX))): del _sub_cache[k]
+        for ch, ok in zip(missing, results): _sub_cache[(ch, user_id)] = (ok, now + (SUB_TTL_OK if ok else SUB_TTL_FAIL))
+
+def invalidate_sub(user_id):
+    with _sub_lock:
+        for ch in REQUIRED_CHANNELS: _sub_cache.pop((ch, user_id), None)
 
 def check_sub(chat_id, user_id):
-    not_joined = []
+    now = time.monotonic()
+    status, missing = {}, []
     for ch in REQUIRED_CHANNELS:
-        try:
-            status = bot.get_chat_member(ch, user_id).status
-            if status not in ['creator', 'administrator', 'member']: not_joined.append(ch)
-        except: 
-            # إذا لم يتمكن البوت من التحقق (ليس أدمن)، نعتبر المستخدم غير مشترك للأمان
-            not_joined.append(ch)
-            
+        hit = _sub_cache.get((ch, user_id))
+        if hit and hit[1] > now:
+            sub_stats['hits'] += 1
+            status[ch] = hit[0]
+        else:
+            sub_stats['misses'] += 1
+            missing.append(ch)
+
+    # القنوات غير المخزنة تُفحص بالتوازي
+    if len(missing) > 1: results = list(_sub_pool.map(lambda ch: _is_member(ch, user_id), missing))
+    else: results = [_is_member(ch, user_id) for ch in missing]
+    status.update(zip(missing, results))
+    _sub_store(user_id, missing, results, now)
+
+    not_joined = [ch for ch in REQUIRED_CHANNELS if not status[ch]]
     if not_joined:
         mk = InlineKeyboardMarkup(row_width=1)
         for ch in not_joined: mk.add(InlineKeyboardButton(f"🔔 اشتراك في {ch}", url=f"https://t.me/{ch.replace('@', '')}"))
         mk.add(InlineKeyboardButton("✅ تم الاشتراك (تحقق)", callback_data="check_sub_again"))
-        try: bot.send_message(chat_id, "⛔️ **عذراً، يجب الاشتراك في القنوات التالية:**", reply_markup=mk, parse_mode="Markdown")
-        except: pass
+        tg.nowait.send_message(chat_id, "⛔️ **عذراً، يجب الاشتراك في القنوات التالية:**", reply_markup=mk, parse_mode="Markdown")
         return False
     return True
 
 def save_to_history(user_id, file_name, questions):
     uid = str(user_id)
-    if uid not in user_history: user_history[uid] = []
-    user_history[uid].insert(0, {'id': str(uuid.uuid4())[:8], 'name': file_name, 'date': datetime.now().strftime("%Y-%m-%d"), 'count': len(questions), 'questions': questions})
+    hist = user_history.get(uid) or []
+    questions = intern_questions(questions)
+    hist.insert(0, {'id': str(uuid.uuid4())[:8], 'name': file_name, 'date': datetime.now().strftime("%Y-%m-%d"), 'count': len(questions), 'questions': questions})
     # يحتفظ بآخر 5 ملفات فقط
-    if len(user_history[uid]) > 5: user_history[uid].pop()
+    if len(hist) > 5: release_questions(hist.pop()['questions'])
+    else: counters.bump(files=1)
+    user_history[uid] = hist
     save_data(FILES['history'], user_history)
+    return questions
+
+# ==============================
+# 📄 استخراج PDF (متوازي، صفحة بصفحة)
+# ==============================
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', str(os.cpu_count() or 2)))
+PDF_CHUNK_PAGES = int(os.getenv('PDF_CHUNK_PAGES', '16'))
+PDF_PAGE_TIMEOUT = float(os.getenv('PDF_PAGE_TIMEOUT', '10'))
+MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', '400'))
+MAX_FILE_MB = float(os.getenv('MAX_FILE_MB', '20'))
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _pool_context():
+    # لا fork من عملية فيها خيوط: الابن قد يرث قفلاً محجوزاً (_metrics_lock، _lazy_lock...) فيعلق للأبد.
+    # forkserver يبدأ عملية نظيفة تستورد bot مرة (التعريفات فقط، انظر WORKER_PROCESS) ثم يتفرع منها، وspawn حيث لا يتوفر.
+    # المهام نفسها دوال pdf_worker
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+def get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            ctx = _pool_context()
+            started = ctx.Queue()  # العمال يبلغون عبره ببدء كل مهمة فعلياً
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx, initializer=pdf_worker.init_worker, initargs=(started,))
+            threading.Thread(target=_watch_started, args=(_pdf_pool, started), name="pdf-started", daemon=True).start()
+        return _pdf_pool
+
+# المهلة تُحسب من بدء العامل بالمهمة لا من إرسالها: تحت الضغط تنتظر الأجزاء السليمة في طابور الـ pool
+_pdf_started = {}  # رقم المهمة -> وقت بدئها (None ما دامت في الطابور)
+_pdf_started_lock = threading.Lock()
+_pdf_tokens = itertools.count()
+
+def _watch_started(pool, started):
+    # طابور لكل pool: بعد إعادة إنشائه يخرج خيط القديم
+    while _pdf_pool is pool:
+        try: token = started.get(timeout=1)
+        except queue.Empty: continue
+        except (EOFError, OSError): return
+        with _pdf_started_lock:
+            if token in _pdf_started: _pdf_started[token] = time.monotonic()
+
+def submit_pdf(fn, *args):
+    # fn دالة من pdf_worker. المستقبل يحمل رقمه فيُعرف متى بدأ (pdf_started)
+    token = next(_pdf_tokens)
+    with _pdf_started_lock: _pdf_started[token] = None
+    try: fut = get_pdf_pool().submit(pdf_worker.tracked, token, fn, *args)
+    except BaseException:
+        with _pdf_started_lock: _pdf_started.pop(token, None)
+        raise
+    fut.token = token
+    def forget(_):
+        with _pdf_started_lock: _pdf_started.pop(token, None)
+    fut.add_done_callback(forget)
+    return fut
+
+def pdf_started(fut):
+    with _pdf_started_lock: return _pdf_started.get(fut.token)
+
+def pdf_result(fut, timeout):
+    # ينتظر النتيجة مع مهلة تبدأ عند بدء العامل بالمهمة، والانتظار في الطابور لا يُحتسب
+    while True:
+        t0 = pdf_started(fut)
+        if t0 is not None: return fut.result(timeout=max(0.0, t0 + timeout - time.monotonic()))
+        try: return fut.result(timeout=0.5)
+        except FuturesTimeout: continue
+
+def _reset_pdf_pool(kill=False):
+    # kill: إنهاء العمليات العالقة نفسها، فـ shutdown وحده لا يوقف مهمة جارية
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            procs = list((_pdf_pool._processes or {}).values()) if kill else []
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+            for p in procs:
+                try: p.terminate()
+                except Exception: pass
+        _pdf_pool = None
+
+def iter_pdf_pages(path, n):
+    # يُرجع نص الصفحات بالترتيب فور جاهزيتها، مع نافذة محدودة من الأجزاء لكل ملف حتى لا يحتكر الـ pool
+    pending = deque()
+    for s in range(0, n, PDF_CHUNK_PAGES):
+        e = min(s + PDF_CHUNK_PAGES, n)
+        pending.append((s, e, submit_pdf(pdf_worker.extract_range, path, s, e, PDF_PAGE_TIMEOUT)))
+        if len(pending) >= PDF_WORKERS: yield from _chunk_result(*pending.popleft())
+    while pending: yield from _chunk_result(*pending.popleft())
+
+def _chunk_result(s, e, fut):
+    try: return pdf_result(fut, PDF_PAGE_TIMEOUT * (e - s) + 5)
+    except BrokenProcessPool:
+        _reset_pdf_pool()
+    except Exception as ex:
+        logger.error(f"PDF pages {s}-{e}: {ex}")
+    return [""] * (e - s)
+
+def extract_pdf_text(data, max_pages=MAX_PDF_PAGES, on_chunk=None):
+    # الملف يُكتب مرة واحدة على القرص وتقرأه العمليات بالمسار بدل نسخ البايتات لكل جزء.
+    # on_chunk(نص الصفحات الجديدة) يُستدعى بعد كل PDF_CHUNK_PAGES صفحة عدا الأخيرة (البدء التدريجي)
+    tmp = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        tmp.write(data)
+        tmp.close()
+        t0 = time.perf_counter()
+        try: total = len(lazy_import('PyPDF2').PdfReader(tmp.name).pages)
+        except: return "", 0
+        n, parts, sent = min(total, max_pages), [], 0
+        for i, t in enumerate(iter_pdf_pages(tmp.name, n), 1):
+            parts.append(t + "\n")
+            if on_chunk and i < n and i % PDF_CHUNK_PAGES == 0:
+                try: on_chunk("".join(parts[sent:]))
+                except Exception: logger.exception("PDF on_chunk")
+                sent = i
+        text = "".join(parts)
+        PDF_SECONDS.observe(time.perf_counter() - t0, 'extract')
+        return text, total
+    finally:
+        try: os.remove(tmp.name)
+        except OSError: pass
+
+# ==============================
+# 🚀 البدء التدريجي (أول سؤال قبل اكتمال الملف)
+# ==============================
+# مع كل دفعة صفحات نحلل نصها الجديد فقط ونبدأ الجلسة بأول الأسئلة المكتملة، ثم نضيف الباقي تباعاً.
+# السؤال الأخير في الدفعة قد يكمل في الصفحة التالية فيبقى نصه (الذيل) ويُحلل مع الدفعة التالية،
+# وأول سؤال بلا نجمة يوقف الإضافة والتحليل
+# لأن مفتاح الإجابات قد يكون في آخر الملف. التحليل الكامل في النهاية يحسم القائمة النهائية
+PROGRESSIVE = os.getenv('PROGRESSIVE', '1') == '1'
+PROGRESSIVE_MIN_Q = int(os.getenv('PROGRESSIVE_MIN_Q', '3'))  # أقل عدد أسئلة جاهزة لبدء الجلسة
+_progress_lock = threading.Lock()
+
+class ProgressiveStart:
+    def __init__(self, cid, status, t0):
+        self.cid, self.status, self.t0 = cid, status, t0
+        self.session = None
+        self.tail = ""  # النص من آخر رأس سؤال (قد لا يكون اكتمل)
+        self.ready = []  # الأسئلة المكتملة بالترتيب حتى أول سؤال بلا نجمة
+        self.stalled = False
+
+    def _extend(self, qs):
+        # يضيف ما بعد الموجود في الجلسة، ويكمل للمستخدم إن كان ينتظر
+        s = self.session
+        with _progress_lock:
+            new = qs[len(s.questions):]
+            s.questions.extend(new)
+            resume, s.waiting = s.waiting, False
+        with user_sessions.lock: user_sessions.n_questions += len(new)
+        if new: user_sessions.changed(self.cid)
+        if resume: send_question(self.cid)
+
+    def __call__(self, text):
+        # text: نص الصفحات الجديدة فقط
+        if self.stalled: return
+        if self.session is not None and user_sessions.get(self.cid) is not self.session: return  # بدأ المستخدم اختباراً آخر
+        cut = []
+        qs = parse_questions_fast(self.tail + text, resolve=False, cut=cut)
+        self.tail = cut[0]
+        for q in qs[:cut[1]]:
+            if q['correct_txt'] is None:
+                self.stalled = True
+                break
+            self.ready.append(q)
+        ready = self.ready
+        if self.session is not None: return self._extend(ready)
+        if len(ready) < PROGRESSIVE_MIN_Q: return
+        self.session = user_sessions.start(self.cid, list(ready))
+        self.session.loading = True
+        send_question(self.cid)
+        TTFQ_SECONDS.observe(time.perf_counter() - self.t0, 'progressive')
+        edit_sent(self.cid, self.status, f"✅ **بدأ الاختبار!** ({len(ready)} سؤال، جاري قراءة الباقي...)")
+
+    def finish(self, qs):
+        # qs: القائمة النهائية (بعد حسم مفتاح الإجابات وإضافتها للأرشيف)
+        s = self.session
+        if s is None: return False
+        if user_sessions.get(self.cid) is s:
+            if [q['q'] for q in qs[:len(s.questions)]] == [q['q'] for q in s.questions]:
+                with _progress_lock: s.questions[:], s.refs = qs[:len(s.questions)], []  # صارت النسخ المخزنة: تُعاد صيغة اللقطة
+            self._extend(qs)
+        self.stop()
+        return True
+
+    def stop(self):
+        s = self.session
+        if s is None: return
+        with _progress_lock:
+            resume = s.loading and s.waiting
+            s.loading = s.waiting = False
+        if resume and user_sessions.get(self.cid) is s: send_question(self.cid)
+
+# ==============================
+# 🗃 كاش التحليل (حسب هوية الملف)
+# ==============================
+# نفس محاضرة PDF يرفعها عشرات الطلاب: نخزن الأسئلة المحللة حسب file_unique_id (أو hash المحتوى)
+PARSE_CACHE_DIR = os.getenv('PARSE_CACHE_DIR', 'parse_cache')
+PARSE_CACHE_MB = float(os.getenv('PARSE_CACHE_MB', '200'))
+
+_parse_index = None  # key -> حجم الملف، مرتب من الأقدم استخداماً للأحدث
+_parse_lock = threading.Lock()
+parse_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+def _parse_cache_index():
+    global _parse_index
+    if _parse_index is None:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        entries = []
+        for name in os.listdir(PARSE_CACHE_DIR):
+            if not name.endswith('.json'): continue
+            st = os.stat(os.path.join(PARSE_CACHE_DIR, name))
+            entries.append((st.st_mtime, name[:-5], st.st_size))
+        _parse_index = OrderedDict((k, size) for _, k, size in sorted(entries))
+        parse_cache_stats['bytes'] = sum(_parse_index.values())
+    return _parse_index
+
+def _parse_cache_path(key): return os.path.join(PARSE_CACHE_DIR, f"{key}.json")
+
+def parse_cache_get(key):
+    with _parse_lock:
+        idx = _parse_cache_index()
+        if key not in idx:
+            parse_cache_stats['misses'] += 1
+            return None
+        idx.move_to_end(key)
+    try:
+        path = _parse_cache_path(key)
+        entry = json.load(open(path, 'r', encoding='utf-8'))
+        os.utime(path)  # الترتيب يبقى صحيحاً بعد إعادة التشغيل
+        parse_cache_stats['hits'] += 1
+        return entry
+    except:
+        with _parse_lock: parse_cache_stats['bytes'] -= _parse_index.pop(key, 0)
+        parse_cache_stats['misses'] += 1
+        return None
+
+def parse_cache_put(key, entry):
+    raw = json.dumps(entry, ensure_ascii=False)
+    with _parse_lock:
+        idx = _parse_cache_index()
+        path = _parse_cache_path(key)
+        try:
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as fh: fh.write(raw)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error(f"Parse cache: {e}")
+            return
+        size = len(raw.encode('utf-8'))
+        parse_cache_stats['bytes'] += size - idx.pop(key, 0)
+        idx[key] = size
+        while parse_cache_stats['bytes'] > PARSE_CACHE_MB * 1024 * 1024 and len(idx) > 1:
+            old, old_size = idx.popitem(last=False)
+            parse_cache_stats['bytes'] -= old_size
+            parse_cache_stats['evictions'] += 1
+            try: os.remove(_parse_cache_path(old))
+            except OSError: pass
+
+# ==============================
+# 📥 الاستيراد الجماعي للاختبارات الجاهزة
+# ==============================
+# /import <مسار zip أو مجلد> أو رفع zip بتعليق /import: كل ملف يُقرأ في عمليات PDF_WORKERS بالتوازي
+# ويُحلل نصه هنا عند وصوله، ثم تُضاف كل الاختبارات إلى fixed_quizzes دفعة واحدة (كتابة واحدة)
+IMPORT_EXTS = ('.pdf', '.txt')
+IMPORT_MAX_FILES = int(os.getenv('IMPORT_MAX_FILES', '2000'))
+IMPORT_MAX_MB = float(os.getenv('IMPORT_MAX_MB', '50'))  # حد الملف الواحد بعد فك الضغط
+IMPORT_FILE_TIMEOUT = float(os.getenv('IMPORT_FILE_TIMEOUT', '120'))  # مهلة الملف الواحد من بدء عامل بقراءته
+# الاستيراد يشارك عمليات PDF_WORKERS مع رفع المستخدمين: لا يشغل منها أكثر من هذا العدد، والباقي يبقى متاحاً
+IMPORT_INFLIGHT = int(os.getenv('IMPORT_INFLIGHT', str(max(1, PDF_WORKERS // 2))))
+_import_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-import")
+
+def _import_sources(path):
+    # [(اسم الاختبار، المصدر، الملف داخل zip أو None، الحجم)] مرتبة بالاسم
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            infos = [i for i in z.infolist() if i.filename.lower().endswith(IMPORT_EXTS) and '__MACOSX' not in i.filename]
+        return [(os.path.splitext(os.path.basename(i.filename))[0], path, i.filename, i.file_size) for i in sorted(infos, key=lambda i: i.filename)]
+    out = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(IMPORT_EXTS):
+                full = os.path.join(root, f)
+                out.append((os.path.splitext(f)[0], full, None, os.path.getsize(full)))
+    return out
+
+def bulk_import(cid, path, cleanup=False):
+    try:
+        t0 = time.time()
+        srcs = _import_sources(path)[:IMPORT_MAX_FILES]
+        if not srcs: return tg.send_message(cid, "❌ لا توجد ملفات PDF/TXT")
+        status = tg.send_message(cid, f"📥 **جاري استيراد {len(srcs)} ملف...**", parse_mode="Markdown")
+        results, failed, todo = {}, [], deque()
+        for i, (name, src, member, size) in enumerate(srcs):
+            if size > IMPORT_MAX_MB * 1024 * 1024: failed.append((name, "حجم كبير"))
+            else: todo.append(i)
+        # نافذة من IMPORT_INFLIGHT ملف في الـ pool: ملف جديد يُرسل فقط حين ينتهي آخر، فرفع المستخدمين
+        # لا يصطف خلف مئات ملفات الاستيراد. الملف العالق لا يُقتل (الـ pool مشترك مع استخراج المستخدمين):
+        # يُسجل فاشلاً ويبقى محسوباً من النافذة حتى ينتهي، وإن علقت النافذة كلها يتوقف الاستيراد
+        inflight, hung, done, last = {}, set(), len(failed), time.time()
+        while todo or len(inflight) > len(hung):
+            while todo and len(inflight) < IMPORT_INFLIGHT:
+                i = todo.popleft()
+                inflight[submit_pdf(pdf_worker.import_file, srcs[i][1], srcs[i][2], MAX_PDF_PAGES, PDF_PAGE_TIMEOUT)] = i
+            finished, _ = wait(inflight, timeout=1, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                i = inflight.pop(fut)
+                if fut in hung:
+                    hung.discard(fut)
+                    continue
+                done += 1
+                try:
+                    text, _ = fut.result()
+                    qs = parse_questions(text)
+                    if qs: results[i] = qs
+                    else: failed.append((srcs[i][0], "لا أسئلة"))
+                except BrokenProcessPool:
+                    _reset_pdf_pool()
+                    failed.append((srcs[i][0], "تعطل المعالج"))
+                except Exception as e: failed.append((srcs[i][0], str(e)[:60] or type(e).__name__))
+            # العالق فقط ما بدأ فعلاً وتجاوز مهلته، لا ما ينتظر دوره في طابور الـ pool
+            now = time.monotonic()
+            for fut, i in inflight.items():
+                t = pdf_started(fut)
+                if fut in hung or t is None or now - t <= IMPORT_FILE_TIMEOUT: continue
+                hung.add(fut)
+                done += 1
+                failed.append((srcs[i][0], "انتهت المهلة"))
+                logger.warning(f"Bulk import: {srcs[i][0]} timed out")
+            if hung and len(hung) >= IMPORT_INFLIGHT and todo:
+                logger.warning(f"Bulk import: {len(hung)} hung file(s) hold every import slot, stopping")
+                failed += [(srcs[i][0], "توقف الاستيراد") for i in todo]
+                done += len(todo)
+                todo.clear()
+            if time.time() - last > 3:
+                last = time.time()
+                try: tg.edit_message_text(f"📥 **الاستيراد:** {done}/{len(srcs)} | ✅ {len(results)} | ❌ {len(failed)}", cid, status.message_id, parse_mode="Markdown")
+                except: pass
+
+        # كل الاختبارات في دفعة واحدة: intern واحد + حفظ واحد
+        order = sorted(results)
+        flat = intern_questions([q for i in order for q in results[i]])
+        today, pos = datetime.now().strftime("%Y-%m-%d"), 0
+        for i in order:
+            n = len(results[i])
+            qid = str(uuid.uuid4())[:8]
+            fixed_quizzes[qid] = {'name': srcs[i][0], 'questions': flat[pos:pos + n], 'date': today}
+            search_index.add('fix', qid, fixed_quizzes[qid]['questions'], srcs[i][0])
+            pos += n
+        if order:
+            save_data(FILES['fixed'], fixed_quizzes)
+            counters.bump(fixed=len(order))
+        txt = f"✅ تم الاستيراد: {len(order)} اختبار ({len(flat)} سؤال) من {len(srcs)} ملف في {time.time() - t0:.1f}ث"
+        if failed: txt += f"\n❌ فشل {len(failed)}:\n" + "\n".join(f"• {n}: {why}" for n, why in failed[:20])
+        if len(failed) > 20: txt += f"\n... و {len(failed) - 20} أخرى"
+        try: tg.edit_message_text(txt, cid, status.message_id)
+        except: tg.send_message(cid, txt)
+    except Exception as e:
+        logger.exception("Bulk import")
+        tg.send_message(cid, f"❌ فشل الاستيراد: {e}")
+    finally:
+        if cleanup:
+            try: os.remove(path)
+            except OSError: pass
+
+# ==============================
+# 📄 تصدير PDF (في الذاكرة + كاش)
+# ==============================
+# نفس قائمة الأسئلة = نفس الملف: المفتاح hash للأسئلة، وبعد أول إرسال نحتفظ بـ file_id فقط
+# فيصبح التصدير المتكرر (اختبار مشترك/جاهز) طلب send_document واحد بدون رسم
+PDF_CACHE_MAX = int(os.getenv('PDF_CACHE_MAX', '500'))
+PDF_RENDER_OFFLOAD = int(os.getenv('PDF_RENDER_OFFLOAD', '150'))  # من هذا العدد يُرسم في عملية منفصلة
+pdf_cache = OrderedDict()  # key -> file_id أو bytes (قبل أن يرجع Telegram الـ file_id)
+_pdf_cache_lock = threading.Lock()
+_export_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pdf-export")
+pdf_stats = {'renders': 0, 'hits': 0, 'render_ms': 0.0, 'max_render_ms': 0.0}
+
+def pdf_key(questions):
+    h = hashlib.sha1()
+    for q in questions: h.update(q_hash(q).encode())
+    return h.hexdigest()
+
+def _pdf_cache_put(key, val):
+    with _pdf_cache_lock:
+        pdf_cache[key] = val
+        pdf_cache.move_to_end(key)
+        while len(pdf_cache) > PDF_CACHE_MAX: pdf_cache.popitem(last=False)
+
+def get_pdf_bytes(questions):
+    t0 = time.time()
+    if len(questions) >= PDF_RENDER_OFFLOAD:
+        try: data = submit_pdf(pdf_worker.render_pdf, questions).result()
+        except BrokenProcessPool:
+            _reset_pdf_pool()
+            data = render_pdf(questions)
+    else: data = render_pdf(questions)
+    ms = (time.time() - t0) * 1000
+    PDF_SECONDS.observe(ms / 1000, 'render')
+    pdf_stats['renders'] += 1
+    pdf_stats['render_ms'] += ms
+    pdf_stats['max_render_ms'] = max(pdf_stats['max_render_ms'], round(ms, 1))
+    return data
+
+def export_pdf(cid, questions):
+    try:
+        key = pdf_key(questions)
+        with _pdf_cache_lock: hit = pdf_cache.get(key)
+        if isinstance(hit, str):
+            try:
+                tg.bulk.send_document(cid, hit)
+                pdf_stats['hits'] += 1
+                return
+            except Exception: pass  # file_id لم يعد صالحاً: نعيد الرسم
+        data = hit if isinstance(hit, bytes) else get_pdf_bytes(questions)
+        if not data: return tg.send_message(cid, "❌ مشكلة خطوط")
+        if hit: pdf_stats['hits'] += 1
+        _pdf_cache_put(key, data)
+        m = tg.bulk.send_document(cid, telebot.types.InputFile(io.BytesIO(data), "Quizni.pdf"))
+        fid = getattr(getattr(m, 'document', None), 'file_id', None)
+        if fid: _pdf_cache_put(key, fid)
+    except Exception as e: logger.error(f"PDF export: {e}")
+
+# ==============================
+# 🌐 الترجمة (كاش + ترجمة مسبقة)
+# ==============================
+TRANS_DB = os.getenv('TRANS_DB', 'translations.db')
+TRANS_LRU = int(os.getenv('TRANS_LRU', '5000'))
+TRANS_BATCH_CHARS = 4500  # حد Google لكل طلب 5000 حرف
+PRETRANSLATE = os.getenv('PRETRANSLATE', '0') == '1'  # ترجمة أسئلة الاختبار في الخلفية عند بدايته
+PRETRANSLATE_MAX = int(os.getenv('PRETRANSLATE_MAX', '50'))
+_TRANS_SEP = "\n\n[[#]]\n\n"
+
+def google_translate(texts, target):
+    # طلب واحد لعدة نصوص مفصولة بعلامة، وإن تغيرت العلامات نترجم كل نص لوحده
+    tr = lazy_import('deep_translator').GoogleTranslator(source='auto', target=target)
+    if len(texts) == 1: return [tr.translate(texts[0])]
+    parts = tr.translate(_TRANS_SEP.join(texts)).split("[[#]]")
+    if len(parts) == len(texts): return [p.strip() for p in parts]
+    return [tr.translate(t) for t in texts]
+
+# الواجهة: fn(قائمة نصوص، اللغة) -> قائمة ترجمات. يمكن استبدالها بنسخة وهمية للاختبار بدون إنترنت
+translator_backend = google_translate
+
+def set_translator(fn):
+    global translator_backend
+    translator_backend = fn
+
+_trans_lru = OrderedDict()
+_trans_lock = threading.Lock()
+_trans_db = None
+_trans_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="translate")
+trans_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'requests': 0, 'errors': 0}
+
+def _trans_key(text, target): return hashlib.sha1(f"{target}\0{text}".encode('utf-8')).hexdigest()
+
+def _trans_conn():
+    global _trans_db
+    if _trans_db is None:
+        _trans_db = sqlite3.connect(TRANS_DB, check_same_thread=False)
+        _trans_db.execute("CREATE TABLE IF NOT EXISTS tr (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+    return _trans_db
+
+def _trans_remember(k, v):
+    _trans_lru[k] = v
+    _trans_lru.move_to_end(k)
+    while len(_trans_lru) > TRANS_LRU: _trans_lru.popitem(last=False)
+
+def _trans_lookup(keys):
+    found = {}
+    with _trans_lock:
+        for k in keys:
+            if k in _trans_lru:
+                _trans_lru.move_to_end(k)
+                found[k] = _trans_lru[k]
+        trans_stats['hits'] += len(found)
+        rest = [k for k in keys if k not in found]
+        if rest:
+            rows = _trans_conn().execute(f"SELECT k, v FROM tr WHERE k IN ({','.join('?' * len(rest))})", rest).fetchall()
+            for k, v in rows:
+                found[k] = v
+                _trans_remember(k, v)
+            trans_stats['disk_hits'] += len(rows)
+    return found
+
+def translate_many(texts, target='ar'):
+    keys = [_trans_key(t, target) for t in texts]
+    found = _trans_lookup(list(dict.fromkeys(keys)))
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in found))
+    trans_stats['misses'] += len(missing)
+    batch, size = [], 0
+    for t in missing + [None]:
+        if t is not None and (not batch or size + len(t) < TRANS_BATCH_CHARS):
+            batch.append(t)
+            size += len(t)
+            continue
+        if batch:
+            trans_stats['requests'] += 1
+            try: out = translator_backend(batch, target)
+            except Exception as e:
+                trans_stats['errors'] += 1
+                logger.error(f"Translate: {e}")
+                out = [None] * len(batch)
+            rows = [(_trans_key(src, target), v) for src, v in zip(batch, out) if v]
+            with _trans_lock:
+                for k, v in rows:
+                    found[k] = v
+                    _trans_remember(k, v)
+                if rows:
+                    _trans_conn().executemany("INSERT OR REPLACE INTO tr (k, v) VALUES (?, ?)", rows)
+                    _trans_conn().commit()
+        batch, size = ([t], len(t)) if t is not None else ([], 0)
+    return [found.get(k) for k in keys]
+
+def question_text(q): return q['q'] + "\n\n" + "\n".join(q['opts'])
+
+def pretranslate(questions, target='ar'):
+    if not PRETRANSLATE or not questions: return
+    texts = [question_text(q) for q in questions[:PRETRANSLATE_MAX]]
+    _trans_pool.submit(translate_many, texts, target)
+
+def translate_text(text, target='ar'):
+    return translate_many([text], target)[0] or "خطأ ترجمة"
+# ==============================
+# 👥 مسابقات المجموعات
+# ==============================
+# في المجموعة الجلسة مفتاحها id المجموعة والإجابات من كل الأعضاء: group_polls يربط كل استطلاع بمجموعته،
+# والنتائج تُجمع في الذاكرة لكل مشارك (بدون update_stats لكل إجابة). لوحة النتائج تُعدل مرة كل
+# SCOREBOARD_DEBOUNCE ثانية مهما كثرت الإجابات، والـ XP يُحتسب دفعة واحدة عند نهاية الاختبار
+SCOREBOARD_DEBOUNCE = float(os.getenv('SCOREBOARD_DEBOUNCE', '3'))
+SCOREBOARD_TOP = int(os.getenv('SCOREBOARD_TOP', '10'))
+GROUP_POLLS_MAX = int(os.getenv('GROUP_POLLS_MAX', '100000'))
+group_polls = OrderedDict()  # poll_id -> (id المجموعة، رقم السؤال، الخيار الصحيح)
+group_boards = {}  # id المجموعة -> GroupBoard للاختبار الجاري
+_group_lock = threading.Lock()
+GROUP_ANSWERS = counter('quiz_group_answers_total', "إجابات مسابقات المجموعات")
+
+class GroupBoard:
+    def __init__(self, cid, session):
+        self.cid, self.session = cid, session
+        self.players = {}  # uid -> [الاسم، صحيح، مجاب، سلسلة الصحيح الحالية]
+        self.q_stats = {}  # رقم السؤال -> [إجابات، صحيح]
+        self.msg_id = None
+        self.timer = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def answer(self, q_index, uid, name, ok):
+        with self.lock:
+            if self.closed: return
+            p = self.players.get(uid)
+            if p is None: p = self.players[uid] = [name, 0, 0, 0]
+            p[0] = name
+            p[1] += ok
+            p[2] += 1
+            p[3] = p[3] + 1 if ok else 0
+            st = self.q_stats.setdefault(q_index, [0, 0])
+            st[0] += 1
+            st[1] += ok
+            if self.timer is None and self.msg_id: self.timer = timers.call_later(SCOREBOARD_DEBOUNCE, self.refresh)
+        GROUP_ANSWERS.inc()
+
+    def ranking(self): return sorted(self.players.items(), key=lambda x: (-x[1][1], x[1][2]))
+
+    def render(self, final=False):
+        with self.lock:
+            top = self.ranking()[:SCOREBOARD_TOP]
+            n = len(self.players)
+            cur = self.q_stats.get(max(self.q_stats)) if self.q_stats else None
+            last_q = max(self.q_stats) + 1 if self.q_stats else 0
+        lines = ["🏁 النتائج النهائية" if final else "🏆 النتائج المباشرة", f"👥 المشاركون: {n}"]
+        if cur and not final: lines.append(f"❓ السؤال {last_q}: {cur[0]} إجابة ({cur[1] * 100 // cur[0]}% صحيح)")
+        lines.append("━━━━━━━━━━━━")
+        medals = ["🥇", "🥈", "🥉"]
+        for i, (_, (name, correct, answered, _)) in enumerate(top):
+            lines.append(f"{medals[i] if i < 3 else f'{i + 1}.'} {name[:20]} — ✅ {correct}/{answered}")
+        if not top: lines.append("لا توجد إجابات بعد")
+        return "\n".join(lines)
+
+    def refresh(self):
+        self.timer = None
+        if self.closed or not self.msg_id: return
+        tg.bulk.nowait.edit_message_text(self.render(), self.cid, self.msg_id)
+
+def group_board(cid, s):
+    # لوحة الاختبار الجاري في المجموعة (اختبار جديد = لوحة جديدة)
+    with _group_lock:
+        old = group_boards.get(cid)
+        if old is not None and old.session is s: return old
+        b = group_boards[cid] = GroupBoard(cid, s)
+    # اختبار جديد في نفس المجموعة: نقاط الاختبار السابق تُحتسب قبل إغلاق لوحته
+    if old is not None: commit_group_xp(old)
+    def sent(f):
+        if f.exception() is None: b.msg_id = f.result().message_id
+    tg.nowait.send_message(cid, b.render()).add_done_callback(sent)
+    return b
+
+def track_group_poll(poll_id, cid, q_index, correct):
+    with _group_lock:
+        group_polls[poll_id] = (cid, q_index, correct)
+        if len(group_polls) > GROUP_POLLS_MAX: group_polls.popitem(last=False)
+
+def group_answer(g, ans):
+    cid, q_index, correct = g
+    b = group_boards.get(cid)
+    if b is None or not ans.option_ids: return
+    b.answer(q_index, ans.user.id, ans.user.first_name, ans.option_ids[0] == correct)
+
+def sweep_group_boards():
+    # لوحات جلساتها انتهت بالمهلة أو طُردت من الذاكرة: تُحتسب نقاطها ثم تُحذف
+    with _group_lock:
+        gone = [(cid, b) for cid, b in group_boards.items() if user_sessions.data.get(cid) is not b.session]
+        for cid, _ in gone: del group_boards[cid]
+    for _, b in gone: commit_group_xp(b)
+
+def commit_group_xp(b):
+    with b.lock:
+        if b.closed: return 0
+        b.closed = True
+        players = [(str(uid), *p) for uid, p in b.players.items()]
+        if b.timer: b.timer.cancel()
+    if _poll_report is None: apply_group_xp(players)
+    else:
+        # وضع التقسيم: سجل المستخدم تملكه عملية محادثته الخاصة (وتكتبه كاملاً من نسختها)،
+        # فالزيادة تُرسل لتلك العملية عبر الموجه بدل الكتابة فوق نقاط كسبها هناك
+        own, parts = int(SHARD_ID), {}
+        for p in players: parts.setdefault(abs(int(p[0])) % SHARDS, []).append(p)
+        for i, part in parts.items():
+            if i == own: apply_group_xp(part)
+            else: _poll_report.put(('xp', i, part))
+    return len(players)
+
+def apply_group_xp(players):
+    # كل المشاركين في مرور واحد: تحديث السجلات + عداد واحد + حفظ واحد
+    ev = Counter()
+    for uid, name, correct, answered, run in players:
+        e = {}
+        ud, _ = _touch_user(uid, name, e)
+        ev.update(e)
+        ud['total_correct'] += correct
+        ud['xp'] += 10 * correct
+        ud['streak'] = ud['streak'] + correct if correct == answered else run
+        _award_badges(ud)
+        _lb_record(uid, ud, 10 * correct)
+        user_data[uid] = ud
+        ev['answers'] += answered
+        ev['correct'] += correct
+    if ev: counters.bump(**ev)
+    if players: save_data(FILES['users'], user_data)
+    return len(players)
+
+def finish_group(chat_id, s):
+    with _group_lock:
+        b = group_boards.get(chat_id)
+        if b is None or b.session is not s: return False
+        del group_boards[chat_id]
+    n = commit_group_xp(b)
+    txt = b.render(final=True)
+    if b.msg_id: tg.nowait.edit_message_text(txt, chat_id, b.msg_id)
+    mk = InlineKeyboardMarkup().add(InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu"))
+    tg.nowait.send_message(chat_id, f"{txt}\n\n💎 تم احتساب النقاط لـ {n} مشارك", reply_markup=mk)
+    s.finished = True
+    user_sessions.changed(chat_id)
+    return True
 
-def translate_text(text):
-    try: return GoogleTranslator(source='auto', target='ar').translate(text)
-    except: return "خطأ ترجمة"
 # ==============================
 # 🎮 المنطق & الأدمن
 # ==============================
 def send_question(chat_id):
     s = user_sessions.get(chat_id)
     if not s: return
-    if s['current'] >= len(s['questions']):
+    with _progress_lock:
+        wait = s.loading and s.current >= len(s.questions)
+        if wait: s.waiting = True
+    if wait: return tg.nowait.send_message(chat_id, "⏳ جاري تجهيز باقي الأسئلة...")
+    if s.current >= len(s.questions):
         show_results(chat_id)
         return
 
-    q = s['questions'][s['current']]
-    current_num = s['current'] + 1
-    total = len(s['questions'])
+    q = s.questions[s.current]
+    current_num = s.current + 1
+    total = len(s.questions)
     
     # Progress Bar
     percent_bar = int((current_num / total) * 10)
     bar = "■" * percent_bar + "□" * (10 - percent_bar)
-    header_text = f"Q {current_num}/{total} [{bar}]"
+    header_text = f"Q {current_num}/{total}{'+' if s.loading else ''} [{bar}]"
 
     opts = q['opts'].copy()
     random.shuffle(opts)
     try: c_idx = opts.index(q['correct_txt'])
     except: c_idx = 0
     
-    s['poll_map'] = s.get('poll_map', {})
-    
     mk = InlineKeyboardMarkup()
     mk.row(InlineKeyboardButton("ترجمة 🇮🇶", callback_data="trans_q"))
     
     # زر الحفظ (Toggle)
     uid = str(chat_id)
-    is_saved = any(sv['q'] == q['q'] for sv in user_saved.get(uid, []))
-    save_txt = "✅ محفوظ (إلغاء)" if is_saved else "⭐️ حفظ"
+    save_txt = "✅ محفوظ (إلغاء)" if is_saved(uid, q) else "⭐️ حفظ"
     
     mk.row(InlineKeyboardButton(save_txt, callback_data="toggle_save"), InlineKeyboardButton("⏭️ تخطي", callback_data="skip"))
     mk.row(InlineKeyboardButton("🏠 إنهاء", callback_data="exit"), InlineKeyboardButton("📤 مشاركة", callback_data="share_current"))
 
     if chat_id not in user_settings: user_settings[chat_id] = default_settings.copy()
     timer = 45 if user_settings[chat_id]['timer'] else None
+    if chat_id < 0: group_board(chat_id, s)
 
-    try:
-        msg = bot.send_poll(chat_id, f"{header_text}\n{q['q']}", opts, type='quiz', correct_option_id=c_idx, reply_markup=mk, is_anonymous=False, open_period=timer)
-        s['poll_map'][msg.poll.id] = {'correct': c_idx, 'q_index': s['current']}
-    except:
-        txt = f"**{header_text}**\n{q['q']}\n\n"
-        for i, o in enumerate(opts): txt += f"{i+1}. {o}\n"
-        txt += f"\n|| الحل: {q['correct_txt']} ||"
-        bot.send_message(chat_id, txt, parse_mode="Markdown", reply_markup=mk)
+    idx = s.current
+
+    def sent(f):
+        # على خيط الإرسال: تسجيل الاستطلاع عند وصول رده، أو نسخة نصية إن فشل
+        try:
+            poll_id = f.result().poll.id
+            s.add_poll(poll_id, c_idx, idx)
+            if chat_id < 0: track_group_poll(poll_id, chat_id, idx, c_idx)
+            if _poll_report is not None: _poll_report.put((poll_id, int(SHARD_ID)))
+            user_sessions.changed(chat_id)
+        except:
+            txt = f"**{header_text}**\n{q['q']}\n\n"
+            for i, o in enumerate(opts): txt += f"{i+1}. {o}\n"
+            txt += f"\n|| الحل: {q['correct_txt']} ||"
+            tg.nowait.send_message(chat_id, txt, parse_mode="Markdown", reply_markup=mk)
+    tg.nowait.send_poll(chat_id, f"{header_text}\n{q['q']}", opts, type='quiz', correct_option_id=c_idx, reply_markup=mk, is_anonymous=False, open_period=timer).add_done_callback(sent)
 
 def show_results(chat_id):
     s = user_sessions.get(chat_id)
-    score = s.get('score', 0)
-    total = len(s['questions'])
-    wrong_count = len(s.get('wrong_indices', []))
+    if not s: return
+    if chat_id < 0:
+        # المجموعة: النتائج من لوحتها فقط (الضغط على "إنهاء" بعد إغلاقها لا يفعل شيئاً)
+        finish_group(chat_id, s)
+        return
+    score = s.score
+    total = len(s.questions)
+    wrong_count = len(s.wrong_indices)
     percent = int((score / total) * 100) if total > 0 else 0
     
     # التحديث النهائي للنقاط
@@ -377,23 +2893,22 @@ def show_results(chat_id):
     mk.add(InlineKeyboardButton("📥 تحميل PDF", callback_data="export_pdf"))
     mk.add(InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu"))
     
-    bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=mk)
-    if chat_id in user_sessions: s['finished'] = True
+    tg.nowait.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=mk)
+    s.finished = True
+    user_sessions.changed(chat_id)
 
 # --- لوحة الأدمن (المفصلة) ---
 @bot.message_handler(commands=['admin'])
 def admin_panel(msg):
     if str(msg.from_user.id) != str(ADMIN_ID): return
     
-    # تجميع الإحصائيات
-    total_users = len(user_data)
-    total_files = sum(len(v) for v in user_history.values())
-    total_saved_q = sum(len(v) for v in user_saved.values())
-    total_fixed_q = len(fixed_quizzes)
-    
-    # عدد المستخدمين النشطين اليوم (بناء على last_active)
-    today = datetime.now().strftime("%Y-%m-%d")
-    active_today = sum(1 for u in user_data.values() if u.get('last_active') == today)
+    # الإجماليات من العدادات (بدون مسح المستخدمين)
+    if hasattr(counters, 'refresh'): counters.refresh()
+    t, today = counters.totals, counters.day()
+    total_users, total_files, total_saved_q, total_fixed_q = t['users'], t['files'], t['saved'], t['fixed']
+    active_today = today['active']
+    active = counters.series('active')
+    answers, correct = sum(counters.series('answers')), sum(counters.series('correct'))
 
     txt = (
         "👮‍♂️ **لوحة التحكم المتقدمة:**\n"
@@ -403,71 +2918,147 @@ def admin_panel(msg):
         f"📂 الملفات المحللة: `{total_files}`\n"
         f"💾 الأسئلة المحفوظة: `{total_saved_q}`\n"
         f"📚 الاختبارات الجاهزة: `{total_fixed_q}`\n"
+        f"📈 آخر {ROLLUP_DAYS} يوم: `{sparkline(active)}`\n"
+        f"🆕 جدد اليوم: `{today['new_users']}` | ملفات اليوم: `{today['uploads']}` | إجابات اليوم: `{today['answers']}`\n"
+        f"🎯 الإجابات ({ROLLUP_DAYS} يوم): `{answers}` | نسبة الصحيح: `{(correct * 100 // answers) if answers else 0}%` | أقصى نشاط يومي: `{max(active)}`\n"
+        f"🔔 كاش الاشتراك: `{sub_stats['hits']}` إصابة / `{sub_stats['misses']}` فحص (`{sub_stats['api_calls']}` طلب API)\n"
+        f"🗃 كاش الملفات: `{parse_cache_stats['hits']}` إصابة / `{parse_cache_stats['misses']}` | `{parse_cache_stats['bytes'] // 1024}KB`\n"
+        f"💾 الحفظ: `{persist_stats['last_ms']}ms` (أقصى `{persist_stats['max_ms']}ms`) | مدموجة: `{persist_stats['coalesced']}`\n"
+        f"📄 PDF: `{pdf_stats['renders']}` رسم / `{pdf_stats['hits']}` من الكاش\n"
+        f"🚀 الإقلاع: `{startup.total_ms():.0f}ms`\n"
         "🤖 الحالة: **ممتاز ✅**"
     )
-    bot.reply_to(msg, txt, parse_mode="Markdown")
+    if _wh_queues:
+        n = webhook_stats['processed'] or 1
+        txt += (f"\n🪝 Webhook: `{webhook_stats['processed']}` معالجة / `{webhook_stats['rejected']}` مرفوضة | "
+                f"الطابور `{sum(q.qsize() for q in _wh_queues)}` | التأخير `{webhook_stats['lat_ms'] / n:.1f}ms` (أقصى `{webhook_stats['max_lat_ms']}ms`)")
+    tg.nowait.reply_to(msg, txt, parse_mode="Markdown")
+
+@bot.message_handler(commands=['import'])
+def import_cmd(msg):
+    if str(msg.from_user.id) != str(ADMIN_ID): return
+    try: path = msg.text.split(maxsplit=1)[1].strip()
+    except: return tg.nowait.reply_to(msg, "❌ الصيغة: `/import مسار_zip_أو_مجلد` أو أرسل ملف zip مع التعليق /import", parse_mode="Markdown")
+    if not os.path.exists(path): return tg.nowait.reply_to(msg, "❌ المسار غير موجود")
+    _import_pool.submit(bulk_import, msg.chat.id, path)
+
+@bot.message_handler(commands=['search'])
+@instrumented('search')
+def search_cmd(msg):
+    cid = msg.chat.id
+    if not check_sub(cid, msg.from_user.id): return
+    try: query = msg.text.split(maxsplit=1)[1]
+    except: return tg.nowait.reply_to(msg, "🔎 الصيغة: `/search كلمات البحث`", parse_mode="Markdown")
+    t0 = time.perf_counter()
+    res = search_index.search(query)
+    if not res: return tg.nowait.reply_to(msg, "🔎 لا توجد نتائج")
+    search_results[cid] = (query[:50], res, (time.perf_counter() - t0) * 1000)
+    search_results.move_to_end(cid)
+    if len(search_results) > SEARCH_SESSIONS_MAX: search_results.popitem(last=False)
+    txt, mk = search_page(cid, 0)
+    tg.nowait.send_message(cid, txt, reply_markup=mk)
+
+def search_page(cid, page):
+    query, res, ms = search_results[cid]
+    pages = -(-len(res) // SEARCH_PAGE)
+    page = max(0, min(page, pages - 1))
+    lines = [f"🔎 «{query}»: {len(res)} سؤال ({ms:.0f}ms) — صفحة {page + 1}/{pages}", ""]
+    for i, (q, label) in enumerate(res[page * SEARCH_PAGE:(page + 1) * SEARCH_PAGE], page * SEARCH_PAGE + 1):
+        t = " ".join(q['q'].split())
+        lines.append(f"{i}. {t[:90]}{'…' if len(t) > 90 else ''}\n    {label}")
+    mk = InlineKeyboardMarkup()
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("◀️", callback_data=f"srch_{page - 1}"))
+    if page < pages - 1: nav.append(InlineKeyboardButton("▶️", callback_data=f"srch_{page + 1}"))
+    if nav: mk.row(*nav)
+    sizes = [n for n in (10, 20, 50) if n < len(res)] + [min(len(res), 100)]
+    mk.row(*[InlineKeyboardButton(f"🚀 {n} سؤال", callback_data=f"srch_go_{n}") for n in sizes])
+    return "\n".join(lines), mk
 
 @bot.message_handler(commands=['add_quiz'])
 def add_fixed_quiz(msg):
     if str(msg.from_user.id) != str(ADMIN_ID): return
     cid = msg.chat.id
-    if cid not in user_sessions or not user_sessions[cid].get('questions'):
-        bot.reply_to(msg, "❌ **خطأ:** لا يوجد اختبار نشط لحفظه.")
+    if cid not in user_sessions or not user_sessions[cid].questions:
+        tg.nowait.reply_to(msg, "❌ **خطأ:** لا يوجد اختبار نشط لحفظه.")
         return
     try: name = msg.text.split(maxsplit=1)[1]
-    except: bot.reply_to(msg, "❌ الصيغة: `/add_quiz الاسم`"); return
+    except: tg.nowait.reply_to(msg, "❌ الصيغة: `/add_quiz الاسم`"); return
 
-    qs = user_sessions[cid]['questions']
+    qs = intern_questions(user_sessions[cid].questions)
     qid = str(uuid.uuid4())[:8]
     fixed_quizzes[qid] = {'name': name, 'questions': qs, 'date': datetime.now().strftime("%Y-%m-%d")}
     save_data(FILES['fixed'], fixed_quizzes)
-    bot.reply_to(msg, f"✅ **تم الحفظ:** {name}")
+    search_index.add('fix', qid, qs, name)
+    counters.bump(fixed=1)
+    tg.nowait.reply_to(msg, f"✅ **تم الحفظ:** {name}")
       # ==============================
 # 📦 BUFFER & HANDLERS
 # ==============================
-text_buffer = {}
+# Telegram يقسم النص الطويل لعدة رسائل: نجمعها لكل محادثة حتى تتوقف 1.5 ثانية
+TEXT_DEBOUNCE = float(os.getenv('TEXT_DEBOUNCE', '1.5'))
+TEXT_BUFFER_MAX = int(os.getenv('TEXT_BUFFER_MAX', '300000'))  # عند تجاوزه يُحلل المجمّع فوراً
+text_buffer = {}  # chat -> [أجزاء النص، الطول]
 buffer_timers = {}
+_buf_lock = threading.Lock()
+
+def buffer_text(cid, text):
+    with _buf_lock:
+        t = buffer_timers.pop(cid, None)
+        if t: t.cancel()
+        buf = text_buffer.setdefault(cid, [[], 0])
+        buf[0].append(text + "\n")
+        buf[1] += len(text) + 1
+        if buf[1] < TEXT_BUFFER_MAX:
+            buffer_timers[cid] = timers.call_later(TEXT_DEBOUNCE, process_buffered_text, cid)
+            return
+        del text_buffer[cid]
+    # امتلأ المجمّع: يُفصل ويُحلل الآن، والرسائل التالية تبدأ مجمّعاً جديداً
+    timers.call_later(0, process_buffered_text, cid, buf)
 
-def process_buffered_text(chat_id):
+def process_buffered_text(chat_id, buf=None):
     try:
-        full_text = text_buffer.get(chat_id, "").strip()
-        if chat_id in text_buffer: del text_buffer[chat_id]
-        if chat_id in buffer_timers: del buffer_timers[chat_id]
+        if buf is None:
+            with _buf_lock:
+                buf = text_buffer.pop(chat_id, None)
+                buffer_timers.pop(chat_id, None)
+        full_text = "".join(buf[0]).strip() if buf else ""
         if len(full_text) < 5: return 
         
-        bot.send_message(chat_id, "⏳ **جاري التحليل...**")
-        qs = parse_questions_from_text(full_text)
+        tg.nowait.send_message(chat_id, "⏳ **جاري التحليل...**")
+        qs = parse_questions(full_text)
         if len(qs) >= 1:
-            save_to_history(chat_id, f"نص {datetime.now().strftime('%H:%M')}", qs)
+            qs = save_to_history(chat_id, f"نص {datetime.now().strftime('%H:%M')}", qs)
             # تحديث الإحصائيات مع الاسم الحالي (سيتم جلبه لاحقاً في التفاعلات)
             update_stats(chat_id, file_uploaded=True) 
-            user_sessions[chat_id] = {'questions': qs, 'current': 0, 'score': 0, 'wrong_indices': [], 'poll_map': {}}
-            bot.send_message(chat_id, f"✅ **تم!** ({len(qs)} سؤال)")
+            user_sessions.start(chat_id, qs)
+            tg.nowait.send_message(chat_id, f"✅ **تم!** ({len(qs)} سؤال)")
             send_question(chat_id)
-        else: bot.send_message(chat_id, "❌ فشل التحليل.", reply_markup=main_menu_markup(chat_id))
+        else: tg.nowait.send_message(chat_id, "❌ فشل التحليل.", reply_markup=main_menu_markup(chat_id))
     except Exception as e: logger.error(f"Buffer: {e}")
 
 # --- الأوامر ---
 @bot.message_handler(commands=['start', 'profile', 'settings', 'admin'])
+@instrumented('handle_cmds', lambda m: ((m.text or '').split() or [''])[0][:20])
 def handle_cmds(msg):
-    bot.set_my_commands([BotCommand("start", "الرئيسية"), BotCommand("profile", "إنجازاتي"), BotCommand("settings", "الإعدادات")])
+    tg.nowait.set_my_commands([BotCommand("start", "الرئيسية"), BotCommand("profile", "إنجازاتي"), BotCommand("settings", "الإعدادات"), BotCommand("search", "بحث في الأسئلة")])
     cid = msg.chat.id
     if not check_sub(cid, msg.from_user.id): return
 
     if msg.text.startswith('/start'):
         # تنظيف الكيبورد
-        tmp = bot.send_message(cid, "🔄", reply_markup=ReplyKeyboardRemove())
-        bot.delete_message(cid, tmp.message_id)
+        tmp = tg.nowait.send_message(cid, "🔄", reply_markup=ReplyKeyboardRemove())
+        tmp.add_done_callback(lambda f: f.exception() is None and tg.nowait.delete_message(cid, f.result().message_id))
 
         args = msg.text.split()
         if len(args) > 1:
             payload = args[1]
             if payload in shared_quizzes:
-                user_sessions[cid] = {'questions': shared_quizzes[payload], 'current': 0, 'score': 0, 'wrong_indices': [], 'poll_map': {}}
-                bot.send_message(cid, "⚔️ **قبلت التحدي!**")
+                user_sessions.start(cid, shared_quizzes[payload])
+                tg.nowait.send_message(cid, "⚔️ **قبلت التحدي!**")
                 send_question(cid)
                 return
-        bot.send_message(cid, get_welcome_msg(), reply_markup=main_menu_markup(cid), parse_mode="Markdown")
+        tg.nowait.send_message(cid, get_welcome_msg(), reply_markup=main_menu_markup(cid), parse_mode="Markdown")
         
     elif msg.text == '/profile': # يرسل رسالة جديدة لضمان العمل
         callback(type('obj', (object,), {'message': msg, 'data': 'my_profile', 'id': '0', 'from_user': msg.from_user})())
@@ -475,60 +3066,100 @@ def handle_cmds(msg):
         callback(type('obj', (object,), {'message': msg, 'data': 'settings_menu', 'id': '0', 'from_user': msg.from_user})())
 
 @bot.message_handler(content_types=['document'])
+@instrumented('doc_handler')
 def doc_handler(msg):
     cid = msg.chat.id
     if not check_sub(cid, msg.from_user.id): return
-    msg_wait = bot.send_message(cid, "⏳ **جاري قراءة الملف...**")
+    if (msg.document.file_size or 0) > MAX_FILE_MB * 1024 * 1024:
+        tg.nowait.send_message(cid, f"❌ الملف كبير جداً (الحد الأقصى {MAX_FILE_MB:g}MB)")
+        return
+    if str(msg.from_user.id) == str(ADMIN_ID) and (msg.caption or '').startswith('/import'):
+        # zip من الأدمن: يُحفظ مؤقتاً ويُستورد في الخلفية
+        data = api.download_file(api.get_file(msg.document.file_id).file_path)
+        tmp = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        tmp.write(data)
+        tmp.close()
+        _import_pool.submit(bulk_import, cid, tmp.name, True)
+        return
+    t0 = time.perf_counter()
+    msg_wait = tg.nowait.send_message(cid, "⏳ **جاري قراءة الملف...**")
+    prog = None
     try:
-        info = bot.get_file(msg.document.file_id)
-        data = bot.download_file(info.file_path)
-        text = ""
-        if msg.document.file_name.lower().endswith('.pdf'):
-            try:
-                reader = PyPDF2.PdfReader(io.BytesIO(data))
-                for p in reader.pages: text += p.extract_text() + "\n"
-            except: pass
-        else: text = data.decode('utf-8', 'ignore')
+        doc = msg.document
+        key = f"u_{doc.file_unique_id}" if doc.file_unique_id else None
+        entry = parse_cache_get(key) if key else None
+        if entry is None:
+            info = api.get_file(doc.file_id)
+            data = api.download_file(info.file_path)
+            if not key:
+                key = f"h_{hashlib.sha256(data).hexdigest()}"
+                entry = parse_cache_get(key)
+        path = 'cache' if entry else 'full'
+        if entry is None:
+            text, note = "", ""
+            if doc.file_name.lower().endswith('.pdf'):
+                if PROGRESSIVE and PARSER_ENGINE == 'fast': prog = ProgressiveStart(cid, msg_wait, t0)
+                text, pages = extract_pdf_text(data, on_chunk=prog)
+                if pages > MAX_PDF_PAGES: note = f"\n⚠️ تم قراءة أول {MAX_PDF_PAGES} صفحة من {pages}"
+            else: text = data.decode('utf-8', 'ignore')
+            entry = {'questions': parse_questions(text), 'note': note}
+            if entry['questions']: parse_cache_put(key, entry)
         
-        qs = parse_questions_from_text(text)
+        qs, note = entry['questions'], entry['note']
         if qs:
-            save_to_history(cid, msg.document.file_name, qs)
+            qs = save_to_history(cid, msg.document.file_name, qs)
             update_stats(cid, name=msg.from_user.first_name, file_uploaded=True)
-            user_sessions[cid] = {'questions': qs, 'current': 0, 'score': 0, 'wrong_indices': [], 'poll_map': {}}
-            bot.edit_message_text(f"✅ **تم التجهيز!** ({len(qs)} سؤال)", cid, msg_wait.message_id)
-            time.sleep(1)
+            edit_sent(cid, msg_wait, f"✅ **تم التجهيز!** ({len(qs)} سؤال){note}")
+            if prog and prog.finish(qs): return
+            user_sessions.start(cid, qs)
             send_question(cid)
-        else: bot.edit_message_text("❌ لم يتم العثور على أسئلة", cid, msg_wait.message_id)
-    except: bot.send_message(cid, "❌ خطأ في الملف")
+            TTFQ_SECONDS.observe(time.perf_counter() - t0, path)
+        else: edit_sent(cid, msg_wait, "❌ لم يتم العثور على أسئلة")
+    except: tg.nowait.send_message(cid, "❌ خطأ في الملف")
+    finally:
+        if prog: prog.stop()
 
 @bot.poll_answer_handler()
+@instrumented('poll_ans')
 def poll_ans(ans):
+    g = group_polls.get(ans.poll_id)
+    if g: return group_answer(g, ans)
     uid = ans.user.id
-    if uid in user_sessions and ans.poll_id in user_sessions[uid].get('poll_map', {}):
-        p_data = user_sessions[uid]['poll_map'][ans.poll_id]
-        if ans.option_ids[0] == p_data['correct']:
-            user_sessions[uid]['score'] += 1
+    s = user_sessions.get(uid)
+    if s and ans.poll_id in s.poll_map:
+        correct, q_index = s.poll_map[ans.poll_id]
+        if ans.option_ids[0] == correct:
+            s.score += 1
             # هنا لا نملك كائن User لتحديث الاسم، نحدث النقاط فقط
-            update_stats(uid, is_correct=True)
+            update_stats(uid, is_correct=True, answered=True)
         else:
-            if 'wrong_indices' not in user_sessions[uid]: user_sessions[uid]['wrong_indices'] = []
-            user_sessions[uid]['wrong_indices'].append(p_data['q_index'])
-            update_stats(uid, is_correct=False)
+            s.wrong_indices.append(q_index)
+            update_stats(uid, is_correct=False, answered=True)
+        user_sessions.changed(uid)
+
+# الأزرار التي تحمل معرفاً (load_<id>...) تُجمع تحت اسم واحد حتى لا تتضخم تسميات المقاييس
+_CB_PREFIXES = ('load_', 'fix_', 'del_', 'lfix_', 'srch_')
+def _cb_action(call):
+    d = call.data or ''
+    for p in _CB_PREFIXES:
+        if d.startswith(p): return p[:-1]
+    return d[:40]
 
 @bot.callback_query_handler(func=lambda c: True)
+@instrumented('callback', _cb_action)
 def callback(call):
     cid = call.message.chat.id
     d = call.data
     
     if d == "check_sub_again":
-        if check_sub(cid, call.from_user.id): bot.send_message(cid, "✅ أهلاً بك!", reply_markup=main_menu_markup(cid))
+        invalidate_sub(call.from_user.id)
+        if check_sub(cid, call.from_user.id): tg.nowait.send_message(cid, "✅ أهلاً بك!", reply_markup=main_menu_markup(cid))
         return
     if not check_sub(cid, call.from_user.id): return
 
     # --- التنقل ---
     if d == "main_menu":
-        try: bot.edit_message_text(get_welcome_msg(), cid, call.message.message_id, reply_markup=main_menu_markup(cid), parse_mode="Markdown")
-        except: bot.send_message(cid, get_welcome_msg(), reply_markup=main_menu_markup(cid), parse_mode="Markdown")
+        edit_or_send(cid, call.message.message_id, get_welcome_msg(), reply_markup=main_menu_markup(cid), parse_mode="Markdown")
 
     elif d == "my_profile":
         uid = str(cid)
@@ -552,163 +3183,527 @@ def callback(call):
         )
         mk = InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
         # إذا تم استدعاؤه من أمر /profile (رسالة جديدة) نرسل رسالة، وإلا نعدل
-        try: bot.edit_message_text(msg, cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
-        except: bot.send_message(cid, msg, reply_markup=mk, parse_mode="Markdown")
+        edit_or_send(cid, call.message.message_id, msg, reply_markup=mk, parse_mode="Markdown")
 
-    elif d == "leaderboard":
-        # ترتيب حسب XP
-        sorted_users = sorted(user_data.items(), key=lambda x: x[1].get('xp', 0), reverse=True)[:10]
-        msg = "🏆 **لوحة المتصدرين (توب 10):**\n━━━━━━━━━━━━\n"
+    elif d.startswith("leaderboard"):
+        # ترتيب حسب XP من الفهرس (كلي / يومي / أسبوعي)
+        period = d.split("_")[1] if "_" in d else 'all'
+        lb = get_leaderboard(period)
+        titles = {'all': "توب 10", 'day': "اليوم", 'week': "هذا الأسبوع"}
+        msg = f"🏆 **لوحة المتصدرين ({titles[period]}):**\n━━━━━━━━━━━━\n"
         
         medals = ["🥇", "🥈", "🥉"]
-        for i, (k, v) in enumerate(sorted_users):
+        for i, (k, xp) in enumerate(lb.top(10)):
             rank_icon = medals[i] if i < 3 else f"**{i+1}.**"
             # استخدام الاسم المحفوظ
-            u_name = v.get('name', 'User')
+            u_name = user_data.get(k, {}).get('name', 'User')
             # إذا الاسم طويل جداً نقصه
             if len(u_name) > 15: u_name = u_name[:12] + "..."
-            msg += f"{rank_icon} {u_name} — 💎 {v.get('xp', 0)}\n"
+            msg += f"{rank_icon} {u_name} — 💎 {xp}\n"
+        my_rank = lb.rank(str(cid))
+        if my_rank: msg += f"━━━━━━━━━━━━\n📍 ترتيبك: **{my_rank}** من {lb.total}"
             
-        mk = InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
-        bot.edit_message_text(msg, cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
+        mk = InlineKeyboardMarkup(row_width=3)
+        mk.add(*[InlineKeyboardButton(("• " if p == period else "") + t, callback_data="leaderboard" if p == 'all' else f"leaderboard_{p}") for p, t in titles.items()])
+        mk.add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
+        tg.nowait.edit_message_text(msg, cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
 
     # --- الأرشيف والملفات ---
     elif d == "my_files_archive":
         uid = str(cid)
         files = user_history.get(uid, [])
-        if not files: return bot.answer_callback_query(call.id, "📭 الأرشيف فارغ", show_alert=True)
+        if not files: return tg.nowait.answer_callback_query(call.id, "📭 الأرشيف فارغ", show_alert=True)
         mk = InlineKeyboardMarkup()
         for f in files: mk.add(InlineKeyboardButton(f"📄 {f['name']} ({f['count']})", callback_data=f"load_{f['id']}"))
         mk.add(InlineKeyboardButton("🗑 مسح الأرشيف", callback_data="clear_archive"))
         mk.add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
-        bot.edit_message_text("📂 **أرشيف ملفاتك (آخر 5):**", cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
+        tg.nowait.edit_message_text("📂 **أرشيف ملفاتك (آخر 5):**", cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
 
     elif d == "clear_archive":
         uid = str(cid)
+        old = user_history.get(uid, [])
+        for f in old: release_questions(f['questions'])
+        if old: counters.bump(files=-len(old))
         user_history[uid] = []
         save_data(FILES['history'], user_history)
-        bot.answer_callback_query(call.id, "تم مسح الأرشيف")
-        bot.edit_message_text("🗑 **تم مسح الأرشيف بنجاح.**", cid, call.message.message_id, reply_markup=main_menu_markup(cid), parse_mode="Markdown")
+        tg.nowait.answer_callback_query(call.id, "تم مسح الأرشيف")
+        tg.nowait.edit_message_text("🗑 **تم مسح الأرشيف بنجاح.**", cid, call.message.message_id, reply_markup=main_menu_markup(cid), parse_mode="Markdown")
 
     elif d.startswith("load_"):
         fid = d.split("_")[1]
         uid = str(cid)
         f = next((x for x in user_history.get(uid, []) if x['id'] == fid), None)
         if f:
-            user_sessions[cid] = {'questions': f['questions'], 'current': 0, 'score': 0, 'wrong_indices': [], 'poll_map': {}}
-            bot.send_message(cid, f"♻️ **تم استرجاع:** {f['name']}")
+            user_sessions.start(cid, f['questions'])
+            tg.nowait.send_message(cid, f"♻️ **تم استرجاع:** {f['name']}")
             send_question(cid)
 
     # --- باقي الوظائف (كما هي) ---
     elif d == "settings_menu":
-        bot.edit_message_text("⚙️ **الإعدادات:**", cid, call.message.message_id, reply_markup=settings_markup(cid))
+        tg.nowait.edit_message_text("⚙️ **الإعدادات:**", cid, call.message.message_id, reply_markup=settings_markup(cid))
     elif d in ["toggle_timer", "toggle_clean"]:
         user_settings.setdefault(cid, default_settings.copy())
         k = 'timer' if d == "toggle_timer" else 'clean_mode'
         user_settings[cid][k] = not user_settings[cid][k]
-        bot.edit_message_reply_markup(cid, call.message.message_id, reply_markup=settings_markup(cid))
+        tg.nowait.edit_message_reply_markup(cid, call.message.message_id, reply_markup=settings_markup(cid))
     elif d == "toggle_save":
-        if cid not in user_sessions: return
-        q = user_sessions[cid]['questions'][user_sessions[cid]['current']]
-        uid = str(cid)
-        if uid not in user_saved: user_saved[uid] = []
-        found = False
-        for i, s in enumerate(user_saved[uid]):
-            if s['q'] == q['q']: user_saved[uid].pop(i); found = True; break
-        if not found: user_saved[uid].append(q); bot.answer_callback_query(call.id, "✅ تم الحفظ")
-        else: bot.answer_callback_query(call.id, "🗑 تم الإلغاء")
-        save_data(FILES['saved'], user_saved)
+        s = user_sessions.get(cid)
+        if not s or s.current >= len(s.questions): return
+        q = s.questions[s.current]
+        found = not toggle_saved(str(cid), q)
+        tg.nowait.answer_callback_query(call.id, "🗑 تم الإلغاء" if found else "✅ تم الحفظ")
         try:
             new_mk = call.message.reply_markup
             new_mk.keyboard[1][0].text = "⭐️ حفظ" if found else "✅ محفوظ (إلغاء)"
-            bot.edit_message_reply_markup(cid, call.message.message_id, reply_markup=new_mk)
+            tg.nowait.edit_message_reply_markup(cid, call.message.message_id, reply_markup=new_mk)
         except: pass
     elif d == "trans_q":
-        if cid in user_sessions:
-            q = user_sessions[cid]['questions'][user_sessions[cid]['current']]
-            full_txt = q['q'] + "\n\n" + "\n".join(q['opts'])
-            bot.answer_callback_query(call.id, "جاري الترجمة...")
+        s = user_sessions.get(cid)
+        if s and s.current < len(s.questions):
+            q = s.questions[s.current]
+            full_txt = question_text(q)
+            tg.nowait.answer_callback_query(call.id, "جاري الترجمة...")
             tr = translate_text(full_txt)
-            bot.send_message(cid, f"🇮🇶 **الترجمة:**\n\n{tr}")
+            tg.nowait.send_message(cid, f"🇮🇶 **الترجمة:**\n\n{tr}")
     elif d == "create_challenge_link" or d == "share_current":
         if cid in user_sessions:
             qid = str(uuid.uuid4())[:8]
-            shared_quizzes[qid] = user_sessions[cid]['questions']
+            shared_quizzes[qid] = intern_questions(user_sessions[cid].questions)
             save_data(FILES['shared'], shared_quizzes)
-            bot.send_message(cid, f"⚔️ **رابط التحدي:**\n`https://t.me/{bot.get_me().username}?start={qid}`", parse_mode="Markdown")
-        else: bot.answer_callback_query(call.id, "يجب أن تكون في اختبار!", show_alert=True)
+            search_index.add('sh', qid, shared_quizzes[qid])
+            tg.bulk.nowait.send_message(cid, f"⚔️ **رابط التحدي:**\n`https://t.me/{bot_username()}?start={qid}`", parse_mode="Markdown")
+        else: tg.nowait.answer_callback_query(call.id, "يجب أن تكون في اختبار!", show_alert=True)
     elif d == "review_mistakes":
-        if cid in user_sessions:
-            s = user_sessions[cid]
-            wrong_qs = [s['questions'][i] for i in s.get('wrong_indices', [])]
+        s = user_sessions.get(cid)
+        if s:
+            wrong_qs = [s.questions[i] for i in s.wrong_indices]
             if wrong_qs:
-                user_sessions[cid] = {'questions': wrong_qs, 'current': 0, 'score': 0, 'poll_map': {}}
-                bot.send_message(cid, "🔁 **مراجعة الأخطاء:**")
+                user_sessions.start(cid, wrong_qs)
+                tg.nowait.send_message(cid, "🔁 **مراجعة الأخطاء:**")
                 send_question(cid)
-            else: bot.answer_callback_query(call.id, "لا توجد أخطاء!", show_alert=True)
+            else: tg.nowait.answer_callback_query(call.id, "لا توجد أخطاء!", show_alert=True)
     elif d == "open_saved":
-        s = user_saved.get(str(cid), [])
+        s = list(user_saved.get(str(cid), ()))
         if s: 
-            user_sessions[cid] = {'questions': s, 'current': 0, 'score': 0, 'poll_map': {}}
-            bot.send_message(cid, f"⭐️ **المفضلة:** {len(s)} سؤال")
+            user_sessions.start(cid, s)
+            tg.nowait.send_message(cid, f"⭐️ **المفضلة:** {len(s)} سؤال")
             send_question(cid)
-        else: bot.answer_callback_query(call.id, "المفضلة فارغة", show_alert=True)
+        else: tg.nowait.answer_callback_query(call.id, "المفضلة فارغة", show_alert=True)
     elif d == "skip":
-        user_sessions[cid]['current'] += 1
+        s = user_sessions.get(cid)
+        if not s: return tg.nowait.answer_callback_query(call.id, "انتهت الجلسة", show_alert=True)
+        s.current += 1
         if user_settings.get(cid, default_settings)['clean_mode']:
-            try: bot.delete_message(cid, call.message.message_id)
-            except: pass
+            tg.nowait.delete_message(cid, call.message.message_id)
         send_question(cid)
     elif d == "exit": show_results(cid)
     elif d == "export_pdf":
         if cid in user_sessions:
-            fname = f"Quizni_{cid}.pdf"
-            bot.answer_callback_query(call.id, "جاري التصدير...")
-            if create_pdf_file(user_sessions[cid]['questions'], fname):
-                with open(fname, 'rb') as f: bot.send_document(cid, f)
-                os.remove(fname)
-            else: bot.send_message(cid, "❌ مشكلة خطوط")
-        else: bot.answer_callback_query(call.id, "انتهت الجلسة", show_alert=True)
-    elif d == "new_quiz": bot.send_message(cid, "📂 **أرسل ملفك الآن:**")
-    elif d == "list_fixed":
-        if not fixed_quizzes: return bot.answer_callback_query(call.id, "فارغ", show_alert=True)
+            tg.nowait.answer_callback_query(call.id, "جاري التصدير...")
+            _export_pool.submit(export_pdf, cid, user_sessions[cid].questions)
+        else: tg.nowait.answer_callback_query(call.id, "انتهت الجلسة", show_alert=True)
+    elif d == "new_quiz": tg.nowait.send_message(cid, "📂 **أرسل ملفك الآن:**")
+    elif d == "list_fixed" or d.startswith("lfix_"):
+        # صفحات من FIXED_PAGE اختبار: نقرأ المفاتيح فقط ونحمّل سجلات الصفحة المعروضة
+        ids = list(fixed_quizzes)
+        if not ids: return tg.nowait.answer_callback_query(call.id, "فارغ", show_alert=True)
+        pages = -(-len(ids) // FIXED_PAGE)
+        page = min(int(d[5:]) if d.startswith("lfix_") else 0, pages - 1)
         mk = InlineKeyboardMarkup(row_width=1)
-        for qid, data in fixed_quizzes.items():
-            row = [InlineKeyboardButton(f"📑 {data['name']}", callback_data=f"fix_{qid}")]
+        for qid in ids[page * FIXED_PAGE:(page + 1) * FIXED_PAGE]:
+            row = [InlineKeyboardButton(f"📑 {fixed_quizzes[qid]['name']}", callback_data=f"fix_{qid}")]
             if str(call.from_user.id) == str(ADMIN_ID): row.append(InlineKeyboardButton("🗑", callback_data=f"del_{qid}"))
             mk.row(*row)
+        nav = []
+        if page > 0: nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"lfix_{page - 1}"))
+        if page < pages - 1: nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"lfix_{page + 1}"))
+        if nav: mk.row(*nav)
         mk.add(InlineKeyboardButton("🔙 رجوع", callback_data="main_menu"))
-        bot.edit_message_text("**📚 الاختبارات الجاهزة:**", cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
+        title = f"**📚 الاختبارات الجاهزة:** ({page + 1}/{pages})\n🔎 للبحث في الأسئلة: `/search كلمات`"
+        tg.nowait.edit_message_text(title, cid, call.message.message_id, reply_markup=mk, parse_mode="Markdown")
+    elif d.startswith("srch_"):
+        if cid not in search_results: return tg.nowait.answer_callback_query(call.id, "انتهى البحث، أعد المحاولة", show_alert=True)
+        arg = d[5:]
+        if arg.startswith("go_"):
+            qs = [q for q, _ in search_results[cid][1][:int(arg[3:])]]
+            user_sessions.start(cid, qs)
+            tg.nowait.send_message(cid, f"🚀 اختبار من نتائج البحث ({len(qs)} سؤال)")
+            send_question(cid)
+        else:
+            txt, mk = search_page(cid, int(arg))
+            tg.nowait.edit_message_text(txt, cid, call.message.message_id, reply_markup=mk)
     elif d.startswith("fix_"):
         qid = d.split("_")[1]
         if qid in fixed_quizzes:
-            user_sessions[cid] = {'questions': fixed_quizzes[qid]['questions'], 'current': 0, 'score': 0, 'wrong_indices': [], 'poll_map': {}}
-            bot.send_message(cid, f"🚀 **بدء: {fixed_quizzes[qid]['name']}**")
+            user_sessions.start(cid, fixed_quizzes[qid]['questions'])
+            tg.nowait.send_message(cid, f"🚀 **بدء: {fixed_quizzes[qid]['name']}**")
             send_question(cid)
     elif d.startswith("del_"):
         if str(call.from_user.id) != str(ADMIN_ID): return
         qid = d.split("_")[1]
         if qid in fixed_quizzes:
+            search_index.remove('fix', qid, fixed_quizzes[qid]['questions'])
+            release_questions(fixed_quizzes[qid]['questions'])
             del fixed_quizzes[qid]
             save_data(FILES['fixed'], fixed_quizzes)
-            bot.answer_callback_query(call.id, "تم الحذف")
+            counters.bump(fixed=-1)
+            tg.nowait.answer_callback_query(call.id, "تم الحذف")
             call.data = "list_fixed"
             callback(call)
 
 @bot.message_handler(func=lambda m: True)
+@instrumented('text_handler')
 def text_handler(msg):
     cid = msg.chat.id
     if not check_sub(cid, msg.from_user.id): return
     if len(msg.text.strip()) < 5: return 
 
-    if cid in buffer_timers: buffer_timers[cid].cancel()
-    if cid not in text_buffer: text_buffer[cid] = ""
-    text_buffer[cid] += msg.text.strip() + "\n"
-    t = threading.Timer(1.5, process_buffered_text, args=[cid])
-    buffer_timers[cid] = t
-    t.start()
+    buffer_text(cid, msg.text.strip())
+
+# ==============================
+# 🪝 وضع Webhook
+# ==============================
+# RUN_MODE=webhook: Telegram يرسل التحديثات لمسار /webhook على نفس تطبيق Flask.
+# كل تحديث يذهب لطابور عامل محدد حسب المحادثة (ترتيب مضمون لكل محادثة)، والطوابير محدودة:
+# عند الامتلاء نرجع 429 فيعيد Telegram المحاولة لاحقاً بدل تضخم الذاكرة
+RUN_MODE = os.getenv('RUN_MODE', 'polling')  # polling | async | webhook | sharded
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # العنوان العام مثل https://example.com (بدونه يعمل المسار محلياً فقط)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE = int(os.getenv('WEBHOOK_QUEUE', '500'))  # سعة طابور كل عامل
+
+webhook_stats = {'received': 0, 'rejected': 0, 'processed': 0, 'errors': 0, 'lat_ms': 0.0, 'max_lat_ms': 0.0}
+_wh_queues = []
+
+def _update_chat(u):
+    # جلسات الاختبار مفتاحها id المستخدم = id المحادثة الخاصة، فإجابات الاستطلاع تلحق بنفس الطابور
+    if u.message: return u.message.chat.id
+    if u.callback_query: return u.callback_query.message.chat.id if u.callback_query.message else u.callback_query.from_user.id
+    if u.poll_answer: return u.poll_answer.user.id
+    return 0
+
+def _wh_worker(q):
+    while True:
+        t_in, upd = q.get()
+        lat = (time.monotonic() - t_in) * 1000
+        try: bot.process_new_updates([upd])
+        except Exception:
+            webhook_stats['errors'] += 1
+            logger.exception("webhook update %s failed", upd.update_id)
+        finally: q.task_done()
+        webhook_stats['processed'] += 1
+        webhook_stats['lat_ms'] += lat
+        webhook_stats['max_lat_ms'] = max(webhook_stats['max_lat_ms'], round(lat, 1))
+
+@route('/webhook', methods=['POST'])
+def webhook():
+    if not _wh_queues: return "webhook mode off", 404
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return "forbidden", 403
+    try: upd = telebot.types.Update.de_json(request.get_data(as_text=True))
+    except: return "bad update", 400
+    try: enqueue_update(upd)
+    except queue.Full:
+        webhook_stats['rejected'] += 1
+        return "busy", 429, {'Retry-After': '1'}
+    webhook_stats['received'] += 1
+    return "ok"
+
+def drain_updates(timeout):
+    # عند الإيقاف: ينتظر معالجة كل التحديثات المستلمة في طوابير Webhook/الشارد
+    end = time.monotonic() + timeout
+    while any(q.unfinished_tasks for q in _wh_queues):
+        if time.monotonic() > end: return False
+        time.sleep(0.05)
+    return True
+
+def enqueue_update(upd, block=False):
+    _wh_queues[hash(_update_chat(upd)) % len(_wh_queues)].put((time.monotonic(), upd), block=block)
+
+def start_update_workers():
+    bot.threaded = False  # المعالج يعمل داخل عامل الطابور نفسه، وإلا ضاع ترتيب المحادثة في worker_pool
+    for i in range(WEBHOOK_WORKERS):
+        q = queue.Queue(WEBHOOK_QUEUE)
+        _wh_queues.append(q)
+        threading.Thread(target=_wh_worker, args=(q,), name=f"updates-{i}", daemon=True).start()
+
+def start_webhook():
+    start_update_workers()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + '/webhook', secret_token=WEBHOOK_SECRET or None, max_connections=100)
+
+# ==============================
+# 🧱 وضع التقسيم (عدة عمليات)
+# ==============================
+# RUN_MODE=sharded: العملية الرئيسية تستقبل التحديثات فقط وتوزعها على SHARDS عملية حسب المحادثة
+# (وإجابة الاستفتاء للعملية التي أرسلته). كل عملية تملك جلساتها ونصوصها المؤقتة ضمن نفس طوابير
+# الترتيب المستخدمة في Webhook، والبيانات الدائمة مشتركة عبر SQLite. العملية المنهارة يعاد تشغيلها وحدها
+SHARDS = int(os.getenv('SHARDS', str(os.cpu_count() or 2)))
+SHARD_QUEUE = int(os.getenv('SHARD_QUEUE', '1000'))
+SHARD_PARK_MAX = int(os.getenv('SHARD_PARK_MAX', '5000'))  # تحديثات تنتظر عند الموجه لشارد طابوره ممتلئ
+POLL_ROUTES_MAX = int(os.getenv('POLL_ROUTES_MAX', '200000'))
+LB_REFRESH = float(os.getenv('LB_REFRESH', '60'))  # المتصدرون يُعاد بناؤهم دورياً ليروا نقاط بقية العمليات
+
+_poll_report = None  # داخل العملية الفرعية: طابور يبلغ الموجه بـ (poll_id، رقم العملية)
+shard_stats = {'routed': 0, 'poll_routed': 0, 'restarts': 0, 'parked': 0, 'dropped': 0}
+
+def _raw_chat(u):
+    # نفس _update_chat لكن على JSON الخام قبل التحويل
+    if 'message' in u: return u['message']['chat']['id']
+    if 'callback_query' in u:
+        c = u['callback_query']
+        return c['message']['chat']['id'] if c.get('message') else c['from']['id']
+    if 'poll_answer' in u: return u['poll_answer']['user']['id']
+    return 0
+
+LB_SYNC_SLACK = float(os.getenv('LB_SYNC_SLACK', '5'))  # ثوانٍ تداخل بين مزامنتين لكتابات حُسب وقتها ولم تُثبت بعد
+
+def sync_leaderboards():
+    # نقاط العمليات الأخرى تصل عبر SQLite: نقرأ فقط من كُتبوا منذ آخر مزامنة (فهرس users_ts) بدل
+    # إعادة مسح كل المستخدمين. التداخل يعيد تطبيق بعض السجلات وهذا آمن لأن update يضع القيمة نفسها
+    global _lb_built
+    with lb_lock:
+        if not leaderboards: return  # لم يُبنَ بعد: أول get_leaderboard يبنيه كاملاً
+        since, now = _lb_built - LB_SYNC_SLACK, time.time()
+    rows = user_data.changed_since(since)
+    with lb_lock:
+        if not leaderboards: return
+        keys = _period_keys()
+        for uid, ud in rows: _lb_apply(uid, ud, keys)
+        _lb_built = now
+
+def shard_main(i, q, poll_q):
+    global _poll_report
+    _poll_report = poll_q
+    start_update_workers()
+    timers.every(LB_REFRESH, sync_leaderboards)
+    install_exit_handlers()
+    startup.ready()
+    logger.info(f"Shard {i} ready (pid {os.getpid()})")
+    bad = 0
+    try:
+        while True:
+            u = q.get()
+            if u is None: break
+            if 'group_xp' in u:
+                apply_group_xp(u['group_xp'])
+                continue
+            enqueue_update(telebot.types.Update.de_json(u), block=True)
+        bad = stop_workers()
+    finally: flush_data()
+    if bad: sys.exit(1)  # يراه الموجه في exitcode
+
+def run_sharded():
+    if STORAGE_BACKEND != 'sqlite': raise SystemExit("RUN_MODE=sharded يتطلب STORAGE_BACKEND=sqlite")
+    ctx = multiprocessing.get_context('spawn')
+    poll_q = ctx.Queue()
+    queues = _shard_queues
+    queues[:] = [ctx.Queue(SHARD_QUEUE) for _ in range(SHARDS)]
+    procs = _child_procs
+    procs[:] = [None] * SHARDS
+    # حد الإرسال العام وعمليات PDF تُقسم على العمليات الفرعية
+    child_env = {'SEND_GLOBAL_RATE': str(SEND_GLOBAL_RATE / SHARDS), 'PDF_WORKERS': str(max(1, PDF_WORKERS // SHARDS))}
+
+    def spawn(i):
+        env = dict(child_env, SHARD_ID=str(i))
+        old = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        try:
+            # ليست daemon: الشارد يشغل عمليات PDF_WORKERS، وإيقافه عبر stop_workers لا بموت الأب
+            procs[i] = ctx.Process(target=shard_main, args=(i, queues[i], poll_q), name=f"shard-{i}")
+            procs[i].start()
+        finally:
+            for k, v in old.items():
+                if v is None: os.environ.pop(k, None)
+                else: os.environ[k] = v
+
+    # الموجه لا يحجز أبداً على طابور شارد ممتلئ (فيتوقف الاستقبال للجميع): ما لا يتسع يُركن هنا بالترتيب
+    # ويُعاد قبل أي جديد. عند تجاوز SHARD_PARK_MAX تُسقط أقدم التحديثات، أما نقاط المجموعات فلا تُسقط
+    parked = [deque() for _ in range(SHARDS)]
+
+    def drain(i):
+        while parked[i]:
+            try: queues[i].put_nowait(parked[i][0])
+            except queue.Full: return
+            parked[i].popleft()
+
+    def route(i, item):
+        parked[i].append(item)
+        drain(i)
+        if not parked[i]: return
+        shard_stats['parked'] += 1
+        if len(parked[i]) > SHARD_PARK_MAX:
+            for j, x in enumerate(parked[i]):
+                if 'group_xp' in x: continue
+                del parked[i][j]
+                shard_stats['dropped'] += 1
+                logger.warning(f"Shard {i} queue full, dropped update {x.get('update_id')}")
+                break
+
+    gauge('quiz_shard_router', "الموجه: الموزع والمركون والمُسقط", lambda: [((k,), v) for k, v in shard_stats.items()], ('kind',))
+    gauge('quiz_shard_parked', "تحديثات مركونة لكل شارد", lambda: [((str(i),), len(d)) for i, d in enumerate(parked)], ('shard',))
+    for i in range(SHARDS): spawn(i)
+    routes = OrderedDict()
+    offset = None
+    try:
+        while not _stopping.is_set():
+            for i, p in enumerate(procs):
+                if not p.is_alive() and not _stopping.is_set():
+                    logger.error(f"Shard {i} exited ({p.exitcode}), restarting")
+                    shard_stats['restarts'] += 1
+                    spawn(i)
+            for i in range(SHARDS): drain(i)
+            # مع وجود مركون لا ننتظر 20 ثانية في long polling قبل المحاولة التالية
+            try: ups = telebot.apihelper.get_updates(TOKEN, offset, 100, 0 if any(parked) else 20)
+            except Exception as e:
+                logger.error(f"get_updates: {e}")
+                time.sleep(3)
+                continue
+            while True:
+                try: msg = poll_q.get_nowait()
+                except queue.Empty: break
+                if msg[0] == 'xp':
+                    route(msg[1], {'group_xp': msg[2]})
+                    continue
+                pid, i = msg
+                routes[pid] = i
+                if len(routes) > POLL_ROUTES_MAX: routes.popitem(last=False)
+            for u in ups:
+                offset = u['update_id'] + 1
+                i = routes.get(u['poll_answer']['poll_id']) if 'poll_answer' in u else None
+                if i is None: i = abs(_raw_chat(u)) % SHARDS
+                else: shard_stats['poll_routed'] += 1
+                route(i, u)
+                shard_stats['routed'] += 1
+    finally:
+        # خروج الموجه بخطأ: العمليات غير daemon تنتظر طوابيرها، فتُبلغ بالإيقاف (الإشارات تمر بـ stop_workers أصلاً)
+        if not _stopping.is_set(): stop_workers()
+
+# ==============================
+# ⚡ وضع asyncio (AsyncTeleBot)
+# ==============================
+# RUN_MODE=async: الاستقبال وكل طلبات HTTP على حلقة asyncio واحدة وجلسة اتصالات مشتركة.
+# - الإرسال (الأسئلة، الردود، إجابات الأزرار) يمر عبر tg: عمال Outbound يرسلون الطلب على الحلقة ولا
+#   ينتظرونه، والمعالج نفسه يستخدم tg.nowait، فلا خيط ينتظر رد الإرسال.
+# - فحص الاشتراك (get_chat_member) يتم على الحلقة قبل تسليم الرسالة/الزر للمعالج (check_sub_async).
+# - منطق المعالجات يبقى متزامناً (SQLite، التحليل) على منفذ محدود، و poll_ans على منفذ إجابات مستقل
+#   حتى لا تتأخر خلف المعالجات الثقيلة. المستثنى: تنزيل الملفات (get_file/download_file) وطلبات
+#   الاستيراد/التصدير في الخلفية ما زالت تنتظر ردها في خيطها
+ASYNC_WORKERS = int(os.getenv('ASYNC_WORKERS', '32'))
+ASYNC_ANSWER_WORKERS = int(os.getenv('ASYNC_ANSWER_WORKERS', '4'))
+ASYNC_HTTP_LIMIT = int(os.getenv('ASYNC_HTTP_LIMIT', '100'))  # أقصى اتصالات متزامنة في جلسة aiohttp
+
+_async_pool = None
+_answer_pool = None
+
+class AsyncBridge:
+    # يحول استدعاءات bot.xxx(...) إلى coroutines على الحلقة. submit يرجع Future دون انتظار (يستخدمه
+    # Outbound لكل الإرسال)، والاستدعاء المباشر (get_file/download_file) ينتظر النتيجة في خيطه
+    def __init__(self, abot, loop): self.abot, self.loop = abot, loop
+    def submit(self, method, *a, **k): return asyncio.run_coroutine_threadsafe(getattr(self.abot, method)(*a, **k), self.loop)
+    def __getattr__(self, method): return lambda *a, **k: self.submit(method, *a, **k).result()
+
+async def _is_member_async(ch, user_id):
+    sub_stats['api_calls'] += 1
+    t0 = time.perf_counter()
+    try: m = await api.abot.get_chat_member(ch, user_id)
+    except Exception as e:
+        API_ERRORS.inc('get_chat_member', str(getattr(e, 'error_code', None) or type(e).__name__))
+        return False
+    API_SECONDS.observe(time.perf_counter() - t0, 'get_chat_member')
+    return m.status in ['creator', 'administrator', 'member']
+
+async def check_sub_async(user_id):
+    # قبل تسليم التحديث للمعالج: القنوات غير المخزنة تُفحص على الحلقة، فيجدها check_sub في الكاش
+    now = time.monotonic()
+    missing = [ch for ch in REQUIRED_CHANNELS if (_sub_cache.get((ch, user_id)) or (0, 0))[1] <= now]
+    if not missing: return
+    sub_stats['prefetched'] += len(missing)
+    _sub_store(user_id, missing, await asyncio.gather(*(_is_member_async(ch, user_id) for ch in missing)), now)
+
+def build_async_bot(loop):
+    global api, _async_pool, _answer_pool
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_helper
+    asyncio_helper.REQUEST_LIMIT = ASYNC_HTTP_LIMIT
+    if TG_API_URL:
+        asyncio_helper.API_URL = telebot.apihelper.API_URL
+        asyncio_helper.FILE_URL = telebot.apihelper.FILE_URL
+    abot = AsyncTeleBot(TOKEN)
+    # polling يغلق جلسة aiohttp المشتركة عند توقفه بينما الإرسال المتبقي ما زال يستعملها: run_async يغلقها بعد التفريغ
+    async def keep_session(): pass
+    abot.close_session = keep_session
+    _async_pool = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix='quiz-handler')
+    _answer_pool = ThreadPoolExecutor(ASYNC_ANSWER_WORKERS, thread_name_prefix='quiz-answers')
+    api = tg.bot = AsyncBridge(abot, loop)
+    timers.pool = _async_pool  # المؤقتات (تجميع النصوص) تنفذ على نفس منفذ المعالجات
+
+    def offload(pool, sub=False):
+        def wrap(fn):
+            async def run(update):
+                if sub and REQUIRED_CHANNELS and update.from_user: await check_sub_async(update.from_user.id)
+                await loop.run_in_executor(pool, fn, update)
+            return run
+        return wrap
+
+    # نفس المعالجات المسجلة على bot وبنفس المرشحات والترتيب
+    for src, dst, wrap in ((bot.message_handlers, abot.message_handlers, offload(_async_pool, sub=True)),
+                           (bot.callback_query_handlers, abot.callback_query_handlers, offload(_async_pool, sub=True)),
+                           (bot.poll_answer_handlers, abot.poll_answer_handlers, offload(_answer_pool))):
+        for h in src: dst.append(abot._build_handler_dict(wrap(h['function']), **h['filters']))
+    return abot
+
+def run_async():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    abot = build_async_bot(loop)
+    try: loop.run_until_complete(abot.infinity_polling())
+    finally:
+        # التحديثات المستلمة قبل توقف الاستقبال ما زالت مهاماً على الحلقة: تُسلم للمنفذين أولاً. والحلقة
+        # تعمل أثناء الانتظار لأن المعالجات الجارية والإرسال المتبقي ينتظرون ردودهم عليها
+        pending = asyncio.all_tasks(loop)
+        if pending: loop.run_until_complete(asyncio.wait(pending, timeout=SEND_DRAIN_TIMEOUT))
+
+        def drain():
+            _async_pool.shutdown(wait=True)
+            _answer_pool.shutdown(wait=True)
+            tg.drain(SEND_DRAIN_TIMEOUT)
+        loop.run_until_complete(loop.run_in_executor(None, drain))
+        loop.run_until_complete(type(abot).close_session())
+        loop.close()
+
+# ==============================
+# 📊 مقاييس الحالة (gauges)
+# ==============================
+gauge('quiz_active_sessions', "الجلسات في الذاكرة", lambda: len(user_sessions))
+gauge('quiz_session_questions', "مجموع الأسئلة في الجلسات", lambda: user_sessions.n_questions)
+gauge('quiz_text_buffers', "محادثات لها نص قيد التجميع", lambda: len(text_buffer))
+gauge('quiz_text_buffer_chars', "حجم النصوص قيد التجميع", lambda: sum(b[1] for b in list(text_buffer.values())))
+gauge('quiz_send_queue_depth', "طلبات الإرسال المنتظرة", lambda: tg.depth())
+gauge('quiz_webhook_queue_depth', "تحديثات Webhook المنتظرة", lambda: sum(q.qsize() for q in _wh_queues))
+gauge('quiz_timers_pending', "المؤقتات المجدولة", lambda: timers.pending())
+gauge('quiz_save_pending', "ملفات بانتظار الحفظ", lambda: len(_pending))
+gauge('quiz_parse_cache_bytes', "حجم كاش التحليل", lambda: parse_cache_stats['bytes'])
+gauge('quiz_sub_cache', "إحصائيات كاش الاشتراك", lambda: [((k,), v) for k, v in sub_stats.items()], ('kind',))
+gauge('quiz_pdf_cache', "إحصائيات تصدير PDF", lambda: [((k,), v) for k, v in pdf_stats.items()], ('kind',))
+gauge('quiz_group_quizzes', "مسابقات المجموعات الجارية", lambda: len(group_boards))
+gauge('quiz_startup_seconds', "زمن الإقلاع لكل مكون (الاستيراد والتحميل)", lambda: [((n,), round(sec, 4)) for n, sec, _ in startup.steps], ('component',))
+
+if not LAZY_START and not WORKER_PROCESS:
+    for _m in ('fpdf', 'PyPDF2', 'deep_translator'): lazy_import(_m)
+    get_app()
 
 if __name__ == "__main__":
+    counters.persist()  # قبل تشغيل الشاردات: يقرؤون إجماليات rebuild من الجدول
+    install_exit_handlers()
+    startup.ready()
     keep_alive()
-    bot.infinity_polling()
+    try:
+        if RUN_MODE == 'async': run_async()
+        elif RUN_MODE == 'webhook':
+            start_webhook()
+            threading.Event().wait()
+        elif RUN_MODE == 'sharded': run_sharded()
+        else: bot.infinity_polling()
+    finally: flush_data()
       
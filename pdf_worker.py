@@ -0,0 +1,98 @@
+# دوال عمليات PDF_WORKERS (استخراج النص، رسم PDF، قراءة ملفات الاستيراد).
+# وحدة بلا آثار جانبية: لا تحميل بيانات ولا خيوط، والمكتبات الثقيلة تُستورد داخل الدوال
+import os
+import signal
+import tempfile
+import threading
+import zipfile
+
+_started = None  # طابور يبلغ البوت ببدء كل مهمة (انظر bot.submit_pdf)
+
+def init_worker(started):
+    global _started
+    _started = started
+
+def tracked(token, fn, *args):
+    # البوت يحسب مهلة المهمة من هذه اللحظة لا من وقت دخولها طابور الـ pool
+    if _started is not None:
+        try: _started.put(token)
+        except Exception: pass
+    return fn(*args)
+
+_PDF = None
+
+def pdf_doc():
+    # الصنف يُبنى عند أول تصدير حتى لا يُستورد fpdf عند الإقلاع
+    global _PDF
+    if _PDF is None:
+        from fpdf import FPDF
+
+        class PDF(FPDF):
+            def header(self):
+                try:
+                    self.set_font('Arial', 'B', 14)
+                    self.cell(0, 10, 'Quizni Exam', 0, 1, 'C')
+                    self.ln(5)
+                except: pass
+        _PDF = PDF
+    return _PDF()
+
+def render_pdf(questions):
+    # يُنفذ في العملية نفسها أو داخل PDF_WORKERS ويُرجع bytes
+    try:
+        pdf = pdf_doc()
+        pdf.add_page()
+        pdf.set_font("Arial", size=11)
+        for i, q in enumerate(questions):
+            try:
+                q_txt = q['q'].encode('latin-1', 'replace').decode('latin-1')
+                corr = q['correct_txt'].encode('latin-1', 'replace').decode('latin-1')
+                pdf.set_font("Arial", 'B', 11)
+                pdf.multi_cell(0, 8, f"Q{i+1}: {q_txt}")
+                pdf.set_font("Arial", size=10)
+                for opt in q['opts']:
+                    o_txt = opt.encode('latin-1', 'replace').decode('latin-1')
+                    pdf.cell(0, 5, f" - {o_txt}", 0, 1)
+                pdf.set_font("Arial", 'B', 10)
+                pdf.cell(0, 8, f" [Ans]: {corr}", 0, 1)
+                pdf.ln(3)
+            except: continue
+        return pdf.output(dest='S').encode('latin-1')
+    except: return None
+
+def _page_timeout(signum, frame): raise TimeoutError()
+
+def extract_range(path, start, end, timeout):
+    # كل صفحة لها مهلة خاصة وفشلها لا يضيع باقي الصفحات
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    alarm = timeout > 0 and hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+    if alarm: old = signal.signal(signal.SIGALRM, _page_timeout)
+    out = []
+    try:
+        for i in range(start, end):
+            try:
+                if alarm: signal.setitimer(signal.ITIMER_REAL, timeout)
+                out.append(reader.pages[i].extract_text() or "")
+            except BaseException: out.append("")
+            finally:
+                if alarm: signal.setitimer(signal.ITIMER_REAL, 0)
+    finally:
+        if alarm: signal.signal(signal.SIGALRM, old)
+    return out
+
+def import_file(src, member, max_pages, timeout):
+    # ملف من الاستيراد الجماعي: يرجع (النص، عدد الصفحات). التحليل يتم في البوت نفسه
+    if member is None:
+        with open(src, 'rb') as f: data = f.read()
+    else:
+        with zipfile.ZipFile(src) as z: data = z.read(member)
+    if not (member or src).lower().endswith('.pdf'): return data.decode('utf-8', 'ignore'), 0
+    from PyPDF2 import PdfReader
+    tmp = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        tmp.write(data)
+        tmp.close()
+        total = len(PdfReader(tmp.name).pages)
+        return "".join(t + "\n" for t in extract_range(tmp.name, 0, min(total, max_pages), timeout)), total
+    finally: os.remove(tmp.name)
@@ -0,0 +1,287 @@
+# قياس الأداء: مولد أسئلة اصطناعية (نص + PDF)، قياسات دقيقة، وتشغيل كامل ضد خادم Bot API وهمي
+# التشغيل: python tools/benchmark.py [--full] [--e2e-users 100] [--out bench.json] [--compare old.json]
+# النتائج تُحفظ JSON بنفس المفاتيح في كل تشغيل، و --compare يطبع النسبة مع تشغيل سابق
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+FORMATS = ('starred', 'arabic', 'trailing_key', 'inline_key')
+PDF_FORMATS = ('starred', 'trailing_key')  # FPDF بخط Arial لا يرسم العربية
+SIZES, FULL_SIZES = (10, 1000, 10000), (10, 1000, 10000, 100000)
+USERS, FULL_USERS = (1000, 100000), (1000, 100000, 1000000)
+
+WORDS = "cell atom gene enzyme protein heart liver kidney drug dose nerve blood tissue acid base membrane".split()
+AR_WORDS = "الخلية الذرة الجين الإنزيم البروتين القلب الكبد الكلية الدواء الجرعة العصب الدم النسيج".split()
+
+def gen_mcq(n, fmt='starred', seed=0):
+    r = random.Random(seed)
+    out, key = [], []
+    for i in range(1, n + 1):
+        k, words = r.randint(2, 5), r.randint(4, 12)
+        c = r.randrange(k)
+        if fmt == 'starred':
+            out.append(f"{i}. " + " ".join(r.choice(WORDS) for _ in range(words)) + "?")
+            out += [f"{'*' if j == c else ''}{'abcde'[j]}) option {j + 1}-{r.randint(1, 999)}" for j in range(k)]
+        elif fmt == 'arabic':
+            out.append(f"س{i}: " + " ".join(r.choice(AR_WORDS) for _ in range(words)) + "؟")
+            out += [f"{'*' if j == c else '-'} خيار {j + 1}-{r.randint(1, 999)}" for j in range(k)]
+        elif fmt == 'trailing_key':
+            out.append(f"{i}) " + " ".join(r.choice(WORDS) for _ in range(words)))
+            out += [f"{'ABCDE'[j]}) value {j + 1}-{r.randint(1, 999)}" for j in range(k)]
+            key.append(f"{i}. {'abcde'[c]}")
+        elif fmt == 'inline_key':
+            out.append(f"Q{i}) " + " ".join(r.choice(WORDS) for _ in range(words)) + "?")
+            out += [f"({'abcde'[j]}) item {j + 1}-{r.randint(1, 999)}" for j in range(k)]
+            key.append(f"{i}-{'abcde'[c]}")
+    if fmt == 'trailing_key': out += ["", "Answer Key"] + key
+    if fmt == 'inline_key': out.append(" ".join(key))
+    return "\n".join(out)
+
+def gen_pdf(text):
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=10)
+    for line in text.split("\n"): pdf.cell(0, 5, line.encode('latin-1', 'replace').decode('latin-1'), 0, 1)
+    return pdf.output(dest='S').encode('latin-1')
+
+def timed(fn, repeat=3):
+    best, res = float('inf'), None
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        res = fn()
+        best = min(best, time.perf_counter() - t0)
+    return round(best * 1000, 3), res
+
+# ==============================
+# قياسات دقيقة
+# ==============================
+def bench_parse(bot, sizes, results):
+    for fmt in FORMATS:
+        for n in sizes:
+            text = gen_mcq(n, fmt, seed=n)
+            for engine, fn in (('v4', bot.parse_questions_from_text), ('fast', bot.parse_questions_fast)):
+                ms, qs = timed(lambda: fn(text), repeat=1 if n >= 10000 else 3)
+                results[f"parse.{engine}.{fmt}.{n}"] = {'ms': ms, 'questions': len(qs), 'q_per_s': round(len(qs) / ms * 1000) if ms else 0}
+                print(f"parse {engine:>4} {fmt:<12} {n:>6}: {ms:10.2f}ms ({len(qs)} q)")
+
+def bench_pdf(bot, sizes, results):
+    for fmt in PDF_FORMATS:
+        for n in sizes:
+            data = gen_pdf(gen_mcq(n, fmt, seed=n))
+            ms, (text, pages) = timed(lambda: bot.extract_pdf_text(data), repeat=1)
+            qs = bot.parse_questions(text)
+            results[f"pdf.extract.{fmt}.{n}"] = {'ms': ms, 'pages': pages, 'questions': len(qs), 'bytes': len(data)}
+            print(f"pdf extract {fmt:<12} {n:>6}: {ms:10.2f}ms ({pages} pages, {len(qs)} q)")
+    for n in sizes:
+        qs = bot.parse_questions_fast(gen_mcq(n, 'starred', seed=n))
+        ms, data = timed(lambda: bot.render_pdf(qs), repeat=1)
+        results[f"pdf.render.{n}"] = {'ms': ms, 'bytes': len(data or b'')}
+        print(f"pdf render {n:>6}: {ms:10.2f}ms")
+
+def fill_users(bot, n, seed=0):
+    r = random.Random(seed)
+    bot.user_data.clear()
+    bot.leaderboards.clear()
+    for i in range(n):
+        xp = r.randint(0, 3000) * 10
+        bot.user_data[str(10 ** 6 + i)] = {'name': f"user{i}", 'xp': xp, 'total_correct': xp // 10, 'files_uploaded': r.randint(0, 20),
+                                           'streak': r.randint(0, 15), 'badges': [], 'last_active': '2024-01-01', 'active_days': r.randint(1, 300)}
+
+def bench_users(bot, sizes, results):
+    for n in sizes:
+        fill_users(bot, n, seed=n)
+        uids = list(bot.user_data)
+        f = bot.FILES['users']
+        ms, nbytes = timed(lambda: bot._write_file(f, bot.user_data), repeat=1)
+        results[f"save.users.{n}"] = {'ms': ms, 'bytes': nbytes}
+        print(f"save users {n:>8}: {ms:10.2f}ms ({nbytes // 1024}KB)")
+
+        ms, idx = timed(lambda: (bot.leaderboards.clear(), bot.get_leaderboard('all'))[1], repeat=1)
+        results[f"leaderboard.build.{n}"] = {'ms': ms}
+        ms, _ = timed(lambda: [idx.top(10) for _ in range(100)])
+        results[f"leaderboard.top10x100.{n}"] = {'ms': ms}
+        ms, _ = timed(lambda: [idx.rank(uids[i % n]) for i in range(1000)])
+        results[f"leaderboard.rank_x1000.{n}"] = {'ms': ms}
+        ms, _ = timed(lambda: sorted(bot.user_data.items(), key=lambda x: x[1].get('xp', 0), reverse=True)[:10], repeat=1)
+        results[f"leaderboard.sort_baseline.{n}"] = {'ms': ms}
+        print(f"leaderboard {n:>7}: build {results[f'leaderboard.build.{n}']['ms']:.1f}ms | top10x100 {results[f'leaderboard.top10x100.{n}']['ms']:.2f}ms | sort {ms:.1f}ms")
+
+        r = random.Random(n)
+        picks = [uids[r.randrange(n)] for _ in range(20000)]
+        ms, _ = timed(lambda: [bot.update_stats(u, name="Bench", is_correct=bool(i & 1)) for i, u in enumerate(picks)], repeat=1)
+        results[f"update_stats.{n}"] = {'ms': ms, 'ops_per_s': round(len(picks) / ms * 1000) if ms else 0}
+        print(f"update_stats {n:>6}: {ms:10.2f}ms for {len(picks)} calls")
+    bot.user_data.clear()
+    bot.leaderboards.clear()
+
+# ==============================
+# تشغيل كامل ضد Bot API وهمي
+# ==============================
+def _user(uid): return {'id': uid, 'is_bot': False, 'first_name': f"U{uid}"}
+
+def _msg(uid, text):
+    return {'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}, 'from': _user(uid), 'text': text}}
+
+def _doc(uid, file_id, name, size):
+    return {'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}, 'from': _user(uid),
+                        'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': name, 'file_size': size}}}
+
+def _cb(uid, data):
+    return {'callback_query': {'id': str(uid), 'from': _user(uid), 'chat_instance': '1', 'data': data,
+                               'message': {'message_id': 1, 'date': 0, 'chat': {'id': uid, 'type': 'private'}}}}
+
+def bench_e2e(bot, fake, users, qcount, mode, results, pdf_every=4, timeout=300, stall=30):
+    runner = {'async': bot.run_async, 'sharded': bot.run_sharded}.get(mode, lambda: bot.bot.infinity_polling(timeout=1))
+    runner = threading.Thread(target=runner, daemon=True)
+    runner.start()
+    uids = [5 * 10 ** 6 + i for i in range(users)]
+    expected = users * qcount
+    t0 = time.time()
+    for i, u in enumerate(uids):
+        fake.inject(_msg(u, "/start"))
+        if pdf_every and i % pdf_every == 0:
+            # جزء من المستخدمين يرفع PDF بدل النص: يمر بالتحميل والاستخراج والبدء التدريجي
+            fid = f"pdf{u}"
+            fake.files[fid] = gen_pdf(gen_mcq(qcount, 'starred', seed=u))
+            fake.inject(_doc(u, fid, f"quiz{u}.pdf", len(fake.files[fid])))
+        else: fake.inject(_msg(u, gen_mcq(qcount, 'starred', seed=u)))
+    injected, seen, skip_at, turn = 2 * users, 0, {}, []
+    t_first = {}
+    last = t0
+    while seen < expected and time.time() - t0 < timeout and time.time() - last < stall:  # stall: استفتاءات لن تصل
+        if not fake.polls:
+            time.sleep(0.002)
+            continue
+        chat, pid, correct = fake.polls.popleft()
+        now = last = time.time()
+        seen += 1
+        if chat in skip_at: turn.append(now - skip_at.pop(chat))
+        else: t_first[chat] = now - t0
+        fake.inject({'poll_answer': {'poll_id': pid, 'user': _user(chat), 'option_ids': [correct], 'option_persistent_ids': [str(correct)]}})
+        fake.inject(_cb(chat, "skip"))
+        skip_at[chat] = now
+        injected += 2
+    dt = time.time() - t0
+    turn.sort()
+    pct = lambda p: round(turn[min(len(turn) - 1, int(len(turn) * p))] * 1000, 1) if turn else None
+    results[f"e2e.{mode}.{users}x{qcount}"] = {
+        'seconds': round(dt, 3), 'pdf_users': len(range(0, users, pdf_every)) if pdf_every else 0, 'updates': injected, 'updates_per_s': round(injected / dt, 1), 'polls': seen, 'expected_polls': expected,
+        'first_question_ms_p50': round(sorted(t_first.values())[len(t_first) // 2] * 1000, 1) if t_first else None,
+        'turn_ms_p50': pct(0.5), 'turn_ms_p95': pct(0.95), 'turn_ms_p99': pct(0.99), 'api_calls': dict(fake.calls)}
+    print(f"e2e {mode} {users} users x {qcount} q: {dt:.2f}s, {injected / dt:.0f} updates/s, turn p50 {pct(0.5)}ms p95 {pct(0.95)}ms ({seen}/{expected} polls)")
+    return runner, expected - seen
+
+def _handler_errors(bot): return sum(bot.HANDLER_ERRORS.values.values()) + bot.webhook_stats['errors']
+
+def _pool_idle(pool):
+    # ThreadPool في telebot لا يتتبع المهام المنتهية: الطابور فارغ وكل عامل أنهى آخر مهمة استلمها
+    return pool.tasks.empty() and all(w.done_event.is_set() or not w.received_task_event.is_set() for w in pool.workers)
+
+def stop_bot(bot, mode, runner=None, timeout=15):
+    # os._exit لا ينهي العمليات الفرعية: عمليات PDF والشاردات تبقى يتيمة وتحجز stdout إن كان أنبوباً.
+    # الاستقبال يتوقف أولاً، ثم تُنهى المعالجات الجارية ويُفرغ الإرسال (هنا وفي كل شارد) قبل إيقاف العمال،
+    # والخادم الوهمي يبقى حتى النهاية. يرجع عدد المشاكل (رسائل لم تُرسل أو فشلت، أخطاء معالجات، شارد فشل)
+    errors = _handler_errors(bot) + bot.tg.stats['errors']
+    abot = getattr(bot.api, 'abot', None)
+    if mode == 'async' and abot is not None: abot._polling = False  # AsyncTeleBot بلا stop_polling علني
+    elif mode == 'polling': bot.bot.stop_polling()
+    if mode in ('async', 'polling') and runner is not None:
+        runner.join(timeout)  # async: run_async ينهي منفذي المعالجات ويفرغ الإرسال قبل إغلاق الجلسة
+        bad = runner.is_alive()
+    else: bad = 0
+    if mode == 'polling':
+        end = time.time() + timeout
+        while not _pool_idle(bot.bot.worker_pool) and time.time() < end: time.sleep(0.05)
+        bad += not _pool_idle(bot.bot.worker_pool)
+    bad += bot.stop_workers()
+    return bad + _handler_errors(bot) + bot.tg.stats['errors'] - errors
+
+# ==============================
+def compare(new, old_path, threshold):
+    old = json.load(open(old_path, encoding='utf-8'))['results']
+    worse = 0
+    for k, v in new.items():
+        o = old.get(k)
+        metric = 'ms' if 'ms' in v else 'seconds' if 'seconds' in v else None
+        if not o or not metric or not o.get(metric): continue
+        ratio = v[metric] / o[metric]
+        flag = "REGRESSION" if ratio > threshold else "faster" if ratio < 1 / threshold else ""
+        worse += flag == "REGRESSION"
+        print(f"{k:<45} {o[metric]:>10.2f} -> {v[metric]:>10.2f} {metric} x{ratio:5.2f} {flag}")
+    return worse
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--full', action='store_true', help="أحجام كبيرة: 100k سؤال و 1M مستخدم")
+    ap.add_argument('--only', default='parse,pdf,users,e2e')
+    ap.add_argument('--e2e-users', type=int, default=100)
+    ap.add_argument('--e2e-questions', type=int, default=5)
+    ap.add_argument('--e2e-pdf-every', type=int, default=4, help="كل N مستخدم يرفع PDF بدل النص (0 = نص فقط)")
+    ap.add_argument('--e2e-mode', default='polling', choices=['polling', 'async', 'sharded'])
+    ap.add_argument('--shards', type=int, default=2)
+    ap.add_argument('--api-latency-ms', type=float, default=20, help="زمن الرد المصطنع للخادم الوهمي")
+    ap.add_argument('--real-limits', action='store_true', help="إبقاء حدود الإرسال الحقيقية (وإلا تُرفع حتى يُقاس البوت نفسه)")
+    ap.add_argument('--out', default='bench_results.json')
+    ap.add_argument('--compare')
+    ap.add_argument('--threshold', type=float, default=1.2)
+    a = ap.parse_args()
+    only = set(a.only.split(','))
+    out = os.path.abspath(a.out)
+
+    from fake_bot_api import FakeBotAPI
+    fake = FakeBotAPI(latency_ms=a.api_latency_ms)
+    port = random.randint(20000, 40000)
+    os.environ['TG_API_URL'] = fake.serve(port)
+    os.environ.setdefault('BOT_TOKEN', '123:bench')
+    os.environ.setdefault('TEXT_DEBOUNCE', '0.05')
+    os.environ.setdefault('SAVE_INTERVAL', '3600')
+    os.environ.setdefault('SAVE_MAX_PENDING', str(10 ** 9))
+    if a.e2e_mode == 'sharded':
+        os.environ.update(STORAGE_BACKEND='sqlite', RUN_MODE='sharded', SHARDS=str(a.shards))
+    if not a.real_limits:
+        for k in ('SEND_GLOBAL_RATE', 'SEND_CHAT_RATE', 'SEND_GROUP_RATE', 'SEND_BURST'): os.environ.setdefault(k, '100000')
+    # ملفات البيانات تُكتب في مجلد مؤقت لا في المستودع
+    os.chdir(tempfile.mkdtemp(prefix='quiz-bench-'))
+    time.sleep(0.3)
+    import bot
+
+    results = {}
+    if 'parse' in only: bench_parse(bot, FULL_SIZES if a.full else SIZES, results)
+    if 'pdf' in only: bench_pdf(bot, (100, 1000, 10000) if a.full else (100, 1000), results)
+    if 'users' in only: bench_users(bot, FULL_USERS if a.full else USERS, results)
+    runner, missing = bench_e2e(bot, fake, a.e2e_users, a.e2e_questions, a.e2e_mode, results, a.e2e_pdf_every) if 'e2e' in only else (None, 0)
+
+    try: rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except Exception: rev = ''
+    meta = {'time': time.strftime("%Y-%m-%d %H:%M:%S"), 'git': rev, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'args': vars(a)}
+    with open(out, 'w', encoding='utf-8') as f: json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"saved {len(results)} results -> {out}")
+    code = 1 if a.compare and compare(results, a.compare, a.threshold) else 0
+    if missing:
+        print(f"e2e: FAILED ({missing} polls never sent)")
+        code = 1
+    problems = stop_bot(bot, a.e2e_mode if 'e2e' in only else None, runner)
+    if problems:
+        print(f"shutdown: FAILED ({problems} problems: unsent messages, handler errors or shard exit)")
+        code = 1
+    sys.stdout.flush()
+    os._exit(code)  # خيوط الاستقبال/الإرسال لا تتوقف من تلقاء نفسها
+
+if __name__ == "__main__":
+    main()
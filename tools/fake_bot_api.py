@@ -0,0 +1,138 @@
+# خادم Bot API وهمي محلي لاختبار الإرسال والضغط بدون Telegram
+# التشغيل: python tools/fake_bot_api.py --port 8081 --chat-rate 1 --global-rate 30
+# ثم: TG_API_URL=http://127.0.0.1:8081/bot{0}/{1} python bot.py
+import json
+import time
+import argparse
+import itertools
+import threading
+from collections import defaultdict, deque
+from flask import Flask, request, jsonify
+
+class FakeBotAPI:
+    def __init__(self, chat_rate=0, global_rate=0, latency_ms=0, retry_after=1):
+        self.chat_rate, self.global_rate = chat_rate, global_rate
+        self.latency = latency_ms / 1000
+        self.retry_after = retry_after
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.sent = defaultdict(deque)  # chat -> أوقات الإرسال في آخر ثانية
+        self.sent_all = deque()
+        self.calls = defaultdict(int)
+        self.limited = 0
+        self.updates = deque()  # تحديثات تُحقن عبر /inject وتُسلم عبر getUpdates
+        self.update_id = itertools.count(1)
+        self.files = {}
+        self.polls = deque()  # (chat, poll_id, الخيار الصحيح) لكل استفتاء أُرسل
+        self.log = []
+        self.app = self._build()
+
+    def _limited(self, chat):
+        # نفس فكرة حدود Telegram: أكثر من N رسالة بالثانية = 429
+        now = time.monotonic()
+        with self.lock:
+            for dq in (self.sent[chat], self.sent_all):
+                while dq and now - dq[0] > 1: dq.popleft()
+            if (self.chat_rate and len(self.sent[chat]) >= self.chat_rate) or (self.global_rate and len(self.sent_all) >= self.global_rate):
+                self.limited += 1
+                return True
+            self.sent[chat].append(now)
+            self.sent_all.append(now)
+        return False
+
+    @staticmethod
+    def _correct(p):
+        # telebot الحديث يرسل correct_option_ids (قائمة JSON) بدل correct_option_id
+        ids = p.get('correct_option_ids')
+        if ids: return int((json.loads(ids) if isinstance(ids, str) else ids)[0])
+        return int(p.get('correct_option_id', 0))
+
+    def _message(self, chat, **extra):
+        chat = int(chat)
+        msg = {'message_id': next(self.ids), 'date': int(time.time()),
+               'chat': {'id': chat, 'type': 'private' if chat > 0 else 'group'}}
+        msg.update(extra)
+        return msg
+
+    def handle(self, method, p):
+        self.calls[method] += 1
+        if self.latency: time.sleep(self.latency)
+        chat = p.get('chat_id')
+        if method.startswith(('send', 'edit')) and chat is not None and self._limited(chat):
+            return {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after}}, 429
+        self.log.append((time.time(), method, chat))
+        if method == 'getMe': res = {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_quiz_bot'}
+        elif method == 'getUpdates':
+            res = []
+            deadline = time.time() + min(float(p.get('timeout', 0) or 0), 2)
+            while True:
+                with self.lock:
+                    while self.updates and len(res) < int(p.get('limit', 100) or 100): res.append(self.updates.popleft())
+                if res or time.time() >= deadline: break
+                time.sleep(0.02)
+        elif method == 'sendMessage': res = self._message(chat, text=p.get('text', ''))
+        elif method == 'sendPoll':
+            opts = json.loads(p.get('options', '[]'))
+            poll = {'id': str(next(self.ids)), 'question': p.get('question', ''), 'total_voter_count': 0,
+                    'options': [{'persistent_id': str(i), 'text': o if isinstance(o, str) else o.get('text', ''), 'voter_count': 0} for i, o in enumerate(opts)],
+                    'is_closed': False, 'is_anonymous': False, 'type': p.get('type', 'regular'),
+                    'allows_multiple_answers': False, 'correct_option_id': self._correct(p)}
+            res = self._message(chat, poll=poll)
+            self.polls.append((int(chat), poll['id'], poll['correct_option_id']))
+        elif method == 'sendDocument':
+            n = next(self.ids)
+            res = self._message(chat, document={'file_id': f"doc{n}", 'file_unique_id': f"u{n}"})
+        elif method in ('editMessageText', 'editMessageReplyMarkup'): res = self._message(chat or 0, text=p.get('text', ''))
+        elif method == 'getChatMember': res = {'status': 'member', 'user': {'id': int(p.get('user_id', 0)), 'is_bot': False, 'first_name': 'U'}}
+        elif method == 'getFile':
+            fid = p.get('file_id')
+            res = {'file_id': fid, 'file_unique_id': fid, 'file_size': len(self.files.get(fid, b'')), 'file_path': fid}
+        else: res = True
+        return {'ok': True, 'result': res}, 200
+
+    def inject(self, update):
+        update = dict(update)
+        update.setdefault('update_id', next(self.update_id))
+        with self.lock: self.updates.append(update)
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'rate_limited': self.limited, 'pending_updates': len(self.updates)}
+
+    def _build(self):
+        app = Flask('fake_bot_api')
+
+        @app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+        def api(token, method):
+            p = request.values.to_dict()
+            if request.is_json: p.update(request.get_json(silent=True) or {})
+            body, code = self.handle(method, p)
+            return jsonify(body), code
+
+        @app.route('/file/bot<token>/<path:path>')
+        def file(token, path): return self.files.get(path, b'')
+
+        @app.route('/inject', methods=['POST'])
+        def inject():
+            data = request.get_json()
+            for u in (data if isinstance(data, list) else [data]): self.inject(u)
+            return jsonify(ok=True)
+
+        @app.route('/stats')
+        def stats(): return jsonify(self.stats())
+
+        return app
+
+    def serve(self, port=8081):
+        t = threading.Thread(target=lambda: self.app.run(host='127.0.0.1', port=port, threaded=True), daemon=True)
+        t.start()
+        return f"http://127.0.0.1:{port}/bot{{0}}/{{1}}"
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--port', type=int, default=8081)
+    ap.add_argument('--chat-rate', type=int, default=0, help="أقصى رسائل/ثانية لكل محادثة قبل 429 (0 = بلا حد)")
+    ap.add_argument('--global-rate', type=int, default=0)
+    ap.add_argument('--latency-ms', type=float, default=0)
+    a = ap.parse_args()
+    FakeBotAPI(a.chat_rate, a.global_rate, a.latency_ms).app.run(host='127.0.0.1', port=a.port, threaded=True)
@@ -0,0 +1,87 @@
+# فحص عزل المحادثات في جدولة الإرسال (Outbound): 429 على محادثة لا يؤخر غيرها
+# التشغيل: python tools/outbound_isolation.py
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:offline')
+os.chdir(tempfile.mkdtemp(prefix='quiz-outbound-'))  # ملفات البيانات لا تُكتب في المستودع
+import bot
+
+class RateLimited(Exception):
+    def __init__(self, retry):
+        self.error_code = 429
+        self.result_json = {'parameters': {'retry_after': retry}}
+
+class FakeBot:
+    # send_message تنجح فوراً، عدا المحادثات في limited: أول طلب يرجع 429
+    def __init__(self, limited=(), retry=3):
+        self.limited, self.retry = set(limited), retry
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        with self.lock:
+            if chat_id in self.limited:
+                self.limited.discard(chat_id)
+                raise RateLimited(self.retry)
+            self.sent.append((time.monotonic(), chat_id, text))
+        return text
+
+def timed_send(out, chat, text, res):
+    t0 = time.monotonic()
+    out.send_message(chat, text)
+    res[(chat, text)] = time.monotonic() - t0
+
+def check_429_isolation():
+    fake = FakeBot(limited={-100}, retry=3)
+    out = bot.Outbound(fake, workers=bot.SEND_WORKERS)
+    res = {}
+    # عدة رسائل للمجموعة أكثر من عدد العمال: في التصميم القديم كانت كل العمال تنام عليها
+    a = [threading.Thread(target=timed_send, args=(out, -100, f"group{i}", res)) for i in range(bot.SEND_WORKERS + 2)]
+    for t in a: t.start()
+    time.sleep(0.1)  # المجموعة الآن محظورة 3 ثوانٍ
+    b = [threading.Thread(target=timed_send, args=(out, 1000 + i, 'private', res)) for i in range(20)]
+    for t in b: t.start()
+    for t in b: t.join()
+    worst = max(v for (c, _), v in res.items() if c > 0)
+    assert worst < 0.5, f"private chats waited {worst:.2f}s behind a blocked group"
+    for t in a: t.join(timeout=60)
+    first = min(v for (c, _), v in res.items() if c < 0)
+    assert first >= 2.9, "the 429 retry_after was not respected"
+    print(f"429 isolation: OK (private max {worst * 1000:.0f}ms, group first {first:.1f}s)")
+
+def check_bulk_group_isolation():
+    # 30 رسالة لمجموعة (حد 20/دقيقة) لا تؤخر رسالة خاصة
+    fake = FakeBot()
+    out = bot.Outbound(fake, workers=bot.SEND_WORKERS)
+    res = {}
+    g = [threading.Thread(target=timed_send, args=(out, -200, f"g{i}", res), daemon=True) for i in range(30)]
+    for t in g: t.start()
+    time.sleep(0.2)
+    timed_send(out, 7, 'private', res)
+    assert res[(7, 'private')] < 0.5, f"private send waited {res[(7, 'private')]:.2f}s behind group bulk traffic"
+    print(f"bulk group isolation: OK (private {res[(7, 'private')] * 1000:.0f}ms)")
+
+def check_nowait():
+    # tg.nowait: المعالج لا ينتظر حد المجموعة، الانتظار يقع على خيوط الإرسال فقط
+    fake = FakeBot()
+    out = bot.Outbound(fake, workers=bot.SEND_WORKERS)
+    t0 = time.monotonic()
+    futs = [out.nowait.send_message(-300, f"n{i}") for i in range(30)]
+    dt = time.monotonic() - t0
+    assert dt < 0.2, f"nowait sends blocked the caller for {dt:.2f}s"
+    assert futs[0].result(timeout=5) == "n0", "nowait send did not go out"
+    assert not futs[-1].done(), "group bucket was not applied to nowait sends"
+    out.stop(0)
+    assert futs[-1].exception() is not None, "stop() left a queued nowait send pending"
+    print(f"nowait: OK (30 group sends queued in {dt * 1000:.0f}ms)")
+
+if __name__ == "__main__":
+    check_nowait()
+    check_bulk_group_isolation()
+    check_429_isolation()
+    os._exit(0)
@@ -0,0 +1,207 @@
+# مقارنة تفاضلية: parse_questions_fast يجب أن يعطي نفس مخرجات parse_questions_from_text (V4)
+# التشغيل: python tools/parser_equivalence.py [عدد_الحالات_العشوائية]
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:offline')
+os.chdir(tempfile.mkdtemp(prefix='quiz-parse-'))  # ملفات البيانات لا تُكتب في المستودع
+import bot
+
+CORPUS = {
+    'starred_en': """
+1. What is the capital of France?
+a) Berlin
+*b) Paris
+c) Rome
+d) Madrid
+2. Which planet is known as the red planet?
+*a) Mars
+b) Venus
+c) Jupiter
+""",
+    'arabic_sin': """
+س1: ما هي عاصمة العراق؟
+- البصرة
+* بغداد
+- الموصل
+س2- كم عدد أيام الأسبوع؟
+1) خمسة
+2) سبعة *
+3) عشرة
+س3) أكبر كوكب في المجموعة الشمسية هو
+a. الأرض
+b. المشتري
+""",
+    'trailing_key': """
+1) The heart has how many chambers?
+A) 2
+B) 3
+C) 4
+D) 5
+2) Normal body temperature in Celsius is
+A) 35
+B) 37
+C) 39
+3) Insulin is secreted by
+A) liver
+B) pancreas
+C) kidney
+
+Answer Key
+1. C
+2. B
+3. b
+""",
+    'inline_key': """
+Q1) Which gas do plants absorb?
+(a) Oxygen
+(b) Carbon dioxide
+(c) Nitrogen
+Q2) H2O is
+(a) salt
+(b) water
+1-b 2-b
+""",
+    'pdf_noise': """
+Pharmacology Final Exam
+Page 1
+1. Paracetamol is used as an
+a) antibiotic
+b) analgesic
+c) antiviral
+12
+2. Aspirin inhibits
+a) COX
+b) ACE
+c) MAO
+صفحة 2
+3. Which drug is a beta blocker
+a) propranolol
+b) amlodipine
+Key: 1 b, 2 a, 3 a
+""",
+    'multiline_and_resets': """
+Lecture 3 revision
+1. This question text
+continues on a second line
+and a third
+a) first
+b) second
+1. A new section restarts numbering
+a) yes
+b) no
+5. Out of order number
+a) one
+b) two
+3 items were counted
+a) maybe
+b) surely
+""",
+    'bom_crlf': "﻿1. Windows file\r\na) x\r\n*b) y\r\n2. Second\r\na) p\r\nb) q\r\n",
+    'no_answers': """
+1. Pick one
+a) left
+b) right
+2. Pick another
+a) up
+b) down
+c) sideways
+3. Only one option
+a) lonely
+""",
+    'key_out_of_range': """
+1. Two options only
+a) yes
+b) no
+2. Also two
+a) on
+b) off
+1. e
+2. d
+""",
+    'long_lines': "1. Long option test\na) " + "x" * 400 + "\nb) short\nc) " + "y" * 299 + "\n",
+    'arabic_digits': """
+س١: سؤال بأرقام عربية
+1) نعم
+2) لا
+س٢: سؤال ثاني
+1) صح
+2) خطأ
+""",
+    'empty_markers': "1. Blank content\na) \nb)  \n*c) .\n2. Next\n- a\n- b\n",
+}
+
+_LINES = [
+    lambda r, n: f"{n}. Question number {n} about topic {r.randint(1, 99)}",
+    lambda r, n: f"س{n}: سؤال رقم {n}",
+    lambda r, n: f"Q{n}) What about {r.choice(['cells', 'atoms', 'genes'])}?",
+    lambda r, n: f"{r.choice('abcdeABCDE')}) option {r.randint(1, 500)}",
+    lambda r, n: f"*{r.choice('abcd')}) starred option",
+    lambda r, n: f"({r.choice('abcd')}) bracket option",
+    lambda r, n: f"{r.randint(1, 5)}- numeric option",
+    lambda r, n: f"- dash option {r.random():.3f}",
+    lambda r, n: "continuation of the previous text",
+    lambda r, n: str(r.randint(1, 300)),
+    lambda r, n: r.choice(["Answer Key", "Page 7", "صفحة 3", "مفتاح الإجابة", "key"]),
+    lambda r, n: f"{r.randint(1, 40)}. {r.choice('abcdABCD12345')}",
+    lambda r, n: " ".join(f"{i}-{r.choice('abcd')}" for i in range(1, r.randint(2, 8))),
+    lambda r, n: "",
+    lambda r, n: "   \t  ",
+]
+
+def random_doc(r):
+    n, out = 1, []
+    for _ in range(r.randint(0, 80)):
+        line = r.choice(_LINES)(r, n)
+        if r.random() < 0.3: n += 1
+        if r.random() < 0.1: line = "  " + line
+        out.append(line)
+    return r.choice(["\n", "\r\n"]).join(out)
+
+def compare(text, seed=0):
+    random.seed(seed)
+    a = bot.parse_questions_from_text(text)
+    random.seed(seed)
+    b = bot.parse_questions_fast(text)
+    return a == b, a, b
+
+def big_dump(n):
+    parts = []
+    for i in range(1, n + 1):
+        parts.append(f"{i}. Generated question {i} with some text?\na) alpha\nb) beta\nc) gamma\nd) delta")
+    parts.append("Answer Key")
+    parts.extend(f"{i}. {'abcd'[i % 4]}" for i in range(1, n + 1))
+    return "\n".join(parts)
+
+def main():
+    fuzz = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    failed = 0
+    for name, text in CORPUS.items():
+        ok, a, b = compare(text)
+        if not ok:
+            failed += 1
+            print(f"MISMATCH {name}\n  v4:   {a}\n  fast: {b}")
+    r = random.Random(1234)
+    for i in range(fuzz):
+        text = random_doc(r)
+        ok, a, b = compare(text, seed=i)
+        if not ok:
+            failed += 1
+            print(f"MISMATCH fuzz#{i}\n{text!r}")
+            if failed > 10: break
+    print(f"corpus: {len(CORPUS)} | fuzz: {fuzz} | mismatches: {failed}")
+
+    for n in (1000, 10000):
+        text = big_dump(n)
+        for name, fn in (('v4', bot.parse_questions_from_text), ('fast', bot.parse_questions_fast)):
+            t0 = time.perf_counter()
+            qs = fn(text)
+            print(f"{name:>4} {n:>6} questions: {(time.perf_counter() - t0) * 1000:8.1f}ms ({len(qs)} parsed)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
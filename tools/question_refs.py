@@ -0,0 +1,60 @@
+# فحص عدّ المراجع في مخزن الأسئلة مع SQLite: intern/release من عدة خيوط معاً لا يفقد مراجع
+# التشغيل: python tools/question_refs.py [عدد_الخيوط] [عدد_الأسئلة]
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:offline')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SAVE_INTERVAL'] = '0.05'  # خيط الحفظ يعمل أثناء الفحص ويطرد السجلات من الذاكرة
+os.environ['DB_CACHE_MAX'] = '100'
+os.chdir(tempfile.mkdtemp(prefix='quiz-refs-'))
+import bot
+
+def make_questions(n, tag):
+    return [{'q': f"{tag} question {i}?", 'opts': ['a', 'b', 'c'], 'correct': 1, 'correct_txt': 'b'} for i in range(n)]
+
+def run_threads(n, fn):
+    start = threading.Barrier(n)
+    def go(i):
+        start.wait()
+        fn(i)
+    ts = [threading.Thread(target=go, args=(i,)) for i in range(n)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+
+def db_refs(qs):
+    bot.flush_data()
+    rows = dict(bot.db.read("SELECT h, refs FROM questions"))
+    return [rows.get(bot.q_hash(q), 0) for q in qs]
+
+def check_concurrent_intern(n_threads, n_q):
+    qs = make_questions(n_q, 'intern')
+    run_threads(n_threads, lambda i: bot.intern_questions(qs))
+    refs = db_refs(qs)
+    short = sum(r != n_threads for r in refs)
+    assert not short, f"{short}/{n_q} questions ended with the wrong reference count (expected {n_threads})"
+    run_threads(n_threads, lambda i: bot.release_questions(qs))
+    left = sum(1 for r in db_refs(qs) if r)
+    assert not left, f"{left}/{n_q} questions left after releasing every reference"
+    print(f"concurrent intern/release x{n_threads}: OK ({n_q} questions)")
+
+def check_mixed(n_threads, n_q):
+    # نصف الخيوط تضيف وتحرر، والنصف الآخر يحتفظ بمراجعه: أسئلته يجب أن تبقى كلها
+    qs = make_questions(n_q, 'mixed')
+    keep = n_threads // 2
+    run_threads(n_threads, lambda i: bot.intern_questions(qs) if i < keep else bot.release_questions(bot.intern_questions(qs)))
+    refs = db_refs(qs)
+    bad = sum(r != keep for r in refs)
+    assert not bad, f"{bad}/{n_q} questions lost references held by {keep} owners"
+    assert all(bot._resolve(bot.q_hash(q)) for q in qs), "a held question no longer resolves"
+    print(f"mixed intern/release x{n_threads}: OK ({keep} owners kept {n_q} questions)")
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    check_concurrent_intern(threads, n)
+    check_mixed(threads, n)
+    os._exit(0)
@@ -0,0 +1,36 @@
+# إعادة إرسال تحديثات مسجلة (JSON سطر لكل تحديث) لمسار /webhook محلياً وقياس القبول والرفض
+# التشغيل: RUN_MODE=webhook python bot.py  ثم: python tools/replay_updates.py updates.jsonl --url http://127.0.0.1:8080/webhook
+import json
+import time
+import argparse
+import urllib.request
+import urllib.error
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+def post(url, update, secret=None):
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), headers={'Content-Type': 'application/json'})
+    if secret: req.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as r: return r.status
+    except urllib.error.HTTPError as e: return e.code
+    except Exception: return 0
+
+def replay(url, updates, concurrency=16, secret=None):
+    t0 = time.time()
+    with ThreadPoolExecutor(concurrency) as ex:
+        codes = Counter(ex.map(lambda u: post(url, u, secret), updates))
+    dt = time.time() - t0
+    return {'updates': len(updates), 'seconds': round(dt, 3), 'per_sec': round(len(updates) / dt, 1) if dt else 0, 'status': dict(codes)}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument('file')
+    ap.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    ap.add_argument('--concurrency', type=int, default=16)
+    ap.add_argument('--repeat', type=int, default=1)
+    ap.add_argument('--secret')
+    a = ap.parse_args()
+    with open(a.file, encoding='utf-8') as f: ups = [json.loads(l) for l in f if l.strip()]
+    ups = [dict(u, update_id=i + 1) for i, u in enumerate(ups * a.repeat)]
+    print(json.dumps(replay(a.url, ups, a.concurrency, a.secret), indent=2))
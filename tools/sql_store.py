@@ -0,0 +1,112 @@
+# فحص SqlStore: القراءة لا تُكتب، والمتصدرون/العدادات/فهرس البحث تُحسب من SQLite بنفس نتائج المرور الكامل
+# التشغيل: python tools/sql_store.py [عدد_المستخدمين]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('BOT_TOKEN', '0:offline')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SAVE_INTERVAL'] = '3600'  # الحفظ يدوي (flush_data) أثناء الفحص
+os.chdir(tempfile.mkdtemp(prefix='quiz-sql-'))
+import bot
+
+def make_users(n):
+    for i in range(n):
+        uid = str(1000 + i)
+        bot.update_stats(uid, name=f"u{i}")
+        for _ in range(i % 7): bot.update_stats(uid, name=f"u{i}", is_correct=True, answered=True)
+    bot.flush_data()
+
+def check_reads_not_written():
+    ts = dict(bot.db.read("SELECT uid, ts FROM users"))
+    for uid in ts: bot.user_data[uid]
+    assert not bot.user_data.touched, f"{len(bot.user_data.touched)} records marked dirty by plain reads"
+    bot.update_stats('1000', name='u0')  # مثل فتح الملف الشخصي (بلا سلسلة إجابات تُصفّر)
+    bot.flush_data()
+    after = dict(bot.db.read("SELECT uid, ts FROM users"))
+    moved = sum(after[k] != v for k, v in ts.items())
+    assert not moved, f"{moved} users rewritten without any change"
+    print(f"reads are not written back: OK ({len(ts)} users)")
+
+def check_leaderboard(n):
+    expect = sorted(((k, v['xp']) for k, v in bot.user_data.items()), key=lambda x: -x[1])
+    lb = bot.get_leaderboard('all')
+    assert isinstance(lb, bot.SqlBoard), "the all-time board is not read from SQLite"
+    plan = bot.db.read("EXPLAIN QUERY PLAN SELECT uid, xp FROM users ORDER BY xp DESC LIMIT 10")
+    assert any('users_xp' in r[-1] for r in plan), f"top-10 does not use users_xp: {plan}"
+    assert [x for _, x in lb.top(10)] == [x for _, x in expect[:10]], "top-10 differs from a full sort"
+    assert lb.total == n
+    for k, xp in expect[::37]:
+        assert lb.rank(k) == 1 + sum(x > xp for _, x in expect), f"rank of {k} is wrong"
+    day = bot.get_leaderboard('day')
+    assert day.total == sum(1 for _, x in expect if x), "day board is missing active users"
+    # نقاط لم تُكتب بعد تظهر في اليومي فوراً، وفي الكلي بعد الحفظ
+    bot.update_stats('1000', name='u0', is_correct=True, answered=True)
+    assert day.xp['1000'] == 10
+    bot.flush_data()
+    assert lb.rank('1000') == 1 + sum(x > 10 for _, x in expect)
+    print(f"leaderboard from SQL: OK ({n} users)")
+
+def check_xp_index():
+    # نقاط ليست من مضاعفات 10 (سجلات مرحّلة أو معدّلة يدوياً) يجب أن تُرتب بدقة
+    idx, ref = bot.XPIndex(), {}
+    for i in range(300):
+        ref[str(i)] = (i * 7919) % 1003
+        idx.update(str(i), ref[str(i)])
+    for uid in list(ref)[::5]:
+        ref[uid] = (ref[uid] * 3 + 1) % 1009
+        idx.update(uid, ref[uid])
+    order = sorted(ref.values(), reverse=True)
+    assert [x for _, x in idx.top(10)] == order[:10], "top-10 differs from a full sort"
+    assert [x for _, x in idx.top(50)] == order[:50]
+    for uid, xp in ref.items():
+        assert idx.rank(uid) == 1 + sum(x > xp for x in order), f"rank of {uid} ({xp}) is wrong"
+    print(f"xp index with off-step points: OK ({len(ref)} users)")
+
+def check_counters(n):
+    c = bot.Counters()
+    c.rebuild()
+    assert c.totals['users'] == n, c.totals
+    assert c.day()['active'] == n, c.day()
+    print(f"counters rebuild from SQL: OK ({c.totals})")
+
+def check_search():
+    qs = [{'q': f"cell membrane question {i}?", 'opts': ['a', 'b'], 'correct': 1, 'correct_txt': 'b'} for i in range(30)]
+    bot.fixed_quizzes['f1'] = {'name': 'Bio', 'questions': bot.intern_questions(qs[:20]), 'date': ''}
+    bot.shared_quizzes['s1'] = bot.intern_questions(qs[10:])
+    bot.flush_data()
+    idx = bot.SearchIndex()
+    idx.ensure()
+    ref = bot.SearchIndex()
+    ref._add(('sh', 's1'), bot.shared_quizzes['s1'])
+    ref._add(('fix', 'f1'), bot.fixed_quizzes['f1']['questions'])
+    assert {h: d[1] for h, d in idx.docs.items()} == {h: d[1] for h, d in ref.docs.items()}, "sources differ"
+    assert dict(idx.postings) == dict(ref.postings), "postings differ"
+    assert idx.names == {('fix', 'f1'): 'Bio'}
+    assert len(idx.search("membrane")) == min(30, bot.SEARCH_MAX_RESULTS)
+    print(f"search index from SQL: OK ({len(idx.docs)} questions)")
+
+def check_saved():
+    qs = [{'q': f"saved question {i}?", 'opts': ['a', 'b'], 'correct': 0, 'correct_txt': 'a'} for i in range(200)]
+    for q in qs: assert bot.toggle_saved('1000', q)
+    for q in qs[::3]: assert not bot.toggle_saved('1000', q)
+    keep = [q['q'] for i, q in enumerate(qs) if i % 3]
+    assert [q['q'] for q in bot.user_saved['1000']] == keep, "un-saving changed the order"
+    bot.flush_data()
+    bot.user_saved.cache.clear()  # القراءة التالية من SQLite
+    sv = bot.user_saved['1000']
+    assert [q['q'] for q in sv] == keep, "order lost after reload"
+    assert bot.is_saved('1000', qs[1]) and not bot.is_saved('1000', qs[0])
+    print(f"saved toggles: OK ({len(sv)} kept in order)")
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    make_users(n)
+    check_reads_not_written()
+    check_leaderboard(n)
+    check_xp_index()
+    check_counters(n)
+    check_search()
+    check_saved()
+    os._exit(0)